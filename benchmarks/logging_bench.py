@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Measures the per-message cost of SosNode.log_debug(), compared to the
+inspect.stack() based implementation it replaced.
+
+Run from the top of the source tree with:
+
+    python benchmarks/logging_bench.py [iterations]
+'''
+
+from __future__ import print_function
+
+import inspect
+import logging
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from soscollector.configuration import Configuration  # noqa: E402
+from soscollector.sosnode import SosNode  # noqa: E402
+
+
+class OldLogNode(SosNode):
+    '''Reproduces log_debug() as it was before the caller lookup was made
+    cheap, for comparison'''
+
+    def _sanitize_log_msg(self, msg):
+        reg = r'(?P<var>(pass|key|secret|PASS|KEY|SECRET).*?=)(?P<value>.*?\s)'
+        return re.sub(reg, r'\g<var>****** ', msg)
+
+    def log_debug(self, msg):
+        caller = inspect.stack()[1][3]
+        msg = self._sanitize_log_msg(msg)
+        msg = '[%s:%s] %s' % (self._hostname, caller, msg)
+        self.logger.debug(msg)
+        if self.config['verbose']:
+            self.console.debug(msg)
+
+
+def make_node(cls, level):
+    for name in ('sos_collector', 'sos_collector_console'):
+        log = logging.getLogger(name)
+        log.handlers = [logging.NullHandler()]
+        log.propagate = False
+        log.setLevel(level)
+    config = Configuration(args={'nodes': 'localhost'})
+    config['verbose'] = False
+    return cls('localhost', config, load_facts=False)
+
+
+def bench(node, iterations):
+    cmd = 'sosreport --batch --case-id=01234567'
+
+    def log_old():
+        node.log_debug('Running command %s' % cmd)
+
+    def log_new():
+        node.log_debug('Running command %s', cmd)
+
+    func = log_old if isinstance(node, OldLogNode) else log_new
+    best = min(timeit.repeat(func, number=iterations, repeat=3))
+    return best / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print('%-28s %12s %12s' % ('', 'before (us)', 'after (us)'))
+    for label, level in (('debug log enabled', logging.DEBUG),
+                         ('debug log disabled', logging.INFO)):
+        old = bench(make_node(OldLogNode, level), iterations)
+        new = bench(make_node(SosNode, level), iterations)
+        print('%-28s %12.2f %12.2f' % (label, old, new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Measure how long sos-collector takes to start.
+
+Each case is run in a fresh interpreter a number of times, and the fastest,
+median and slowest wall clock times are reported. Run from the top of the
+source tree:
+
+    python benchmarks/startup_bench.py [-n RUNS]
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ('python startup', ['-c', 'pass']),
+    ('import sos_collector', ['-c', 'import soscollector.sos_collector']),
+    ('sos-collector -l', [os.path.join(TOP, 'sos-collector'), '-l']),
+    ('import paramiko', ['-c', 'import paramiko']),
+]
+
+
+def time_case(args, runs):
+    env = dict(os.environ, PYTHONPATH=TOP)
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable] + args, cwd=TOP, env=env,
+                                  stdout=devnull)
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=10,
+                        help='Times to run each case. Default 10')
+    args = parser.parse_args()
+    print('{:28} {:>8} {:>8} {:>8}'.format('Case', 'Min', 'Median', 'Max'))
+    for name, case in CASES:
+        times = time_case(case, args.runs)
+        print('{:28} {:>7.0f}ms {:>7.0f}ms {:>7.0f}ms'.format(
+            name, times[0] * 1000, times[len(times) // 2] * 1000,
+            times[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,10 @@ setup(
                  "(GPLv2)"),
                 ],
     packages=find_packages(),
+    # the asyncio collection engine, --engine=asyncio, needs python 3
+    extras_require={
+        'asyncio': ['asyncssh; python_version >= "3.6"']
+    },
     scripts=['sos-collector'],
     data_files=[
         ('share/man/man1/', ['man/en/sos-collector.1'])
@@ -22,6 +22,8 @@ BuildRequires: python3-devel
 BuildRequires: python3-paramiko
 Requires: python3-paramiko >= 2.0
 Requires: python3-six
+# needed only by the asyncio engine, --engine=asyncio
+Suggests: python3-asyncssh
 %endif
 
 
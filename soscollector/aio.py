@@ -0,0 +1,535 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''The asyncio collection engine, used with --engine=asyncio.
+
+Rather than a thread per node, every node is driven as a coroutine on a single
+event loop using asyncssh, so thousands of nodes may be collected from at once
+without a thread, or a paramiko transport thread, for each of them.
+
+This module requires python 3 and asyncssh, and is only imported when the
+engine is selected.
+'''
+
+import asyncio
+import hashlib
+import os
+import shutil
+import signal
+import socket
+import time
+
+import asyncssh
+
+from soscollector.sos_collector import CANCEL_GRACE
+from soscollector.sosnode import (CHECKSUM_SCRIPT, SOS_INFO_SCRIPT,
+                                  SOS_PACKAGE_QUERY, SosNode)
+from soscollector.transfer import ChecksumMismatch, file_digest
+from soscollector.transports import CHANNEL_READ_SIZE, PASSWORD_PROMPT
+
+# How many SFTP reads each transfer keeps in flight at once
+SFTP_REQUESTS = 128
+
+
+class AsyncSosNode(SosNode):
+    '''A SosNode whose connection, commands and transfers are coroutines run
+    on the event loop, rather than blocking calls made from a thread.
+
+    The methods that talk to the node are overridden here as coroutines, while
+    everything that only works on the output, such as building the sosreport
+    command or parsing the fact probe, is shared with SosNode.
+    '''
+
+    def __init__(self, address, config, known_hosts=None, force=False):
+        self.conn = None
+        self.known_hosts = known_hosts
+        SosNode.__init__(self, address, config, force=force, load_facts=False)
+
+    def open_ssh_session(self):
+        # the session is opened on the event loop by connect()
+        return False
+
+    def _get_known_hosts(self):
+        '''Verify the host key of nodes listed in known_hosts, and accept the
+        key of any other node, as the paramiko AutoAddPolicy does'''
+        if self.known_hosts is None:
+            return None
+        port = int(self.config['ssh_port'])
+        if any(self.known_hosts.match(self.address, '', port)):
+            return self.known_hosts
+        return None
+
+    async def connect(self):
+        '''Open the SSH session to the node and load its facts. Returns True
+        if the node is ready to collect a sosreport from'''
+        if not self.local and not await self.open_session():
+            return False
+        if await self.load_cached_facts():
+            return self.connected
+        if not await self.probe_host_facts():
+            self.log_error('Unable to determine facts for node')
+            self.connected = False
+        else:
+            self.cache_facts()
+        return self.connected
+
+    def _host_key_fingerprint(self):
+        if self.conn is None:
+            return None
+        key = self.conn.get_server_host_key()
+        return hashlib.sha256(key.public_data).hexdigest()
+
+    async def load_cached_facts(self):
+        entry = self._get_cached_facts()
+        if entry is None:
+            return False
+        try:
+            res = await self.run_command(SOS_PACKAGE_QUERY)
+        except Exception as err:
+            self.log_debug('Could not check cached facts: %s' % err)
+            return False
+        return self._load_cached_facts(entry, res)
+
+    async def open_session(self):
+        '''Open the SSH session to the node, returning True if connected'''
+        self.log_debug('Opening session to %s' % self.address)
+        try:
+            self.conn = await asyncio.wait_for(asyncssh.connect(
+                self.address,
+                port=int(self.config['ssh_port']),
+                username=self.config['ssh_user'],
+                password=self.config['password'] or None,
+                known_hosts=self._get_known_hosts()
+            ), 15)
+        except asyncssh.PermissionDenied:
+            if not self.config['password']:
+                self.log_error('Authentication failed. SSH keys installed?')
+            else:
+                self.log_error('Authentication failed. Incorrect password.')
+            return False
+        except asyncssh.HostKeyNotVerifiable:
+            self.log_error('Provided key was rejected by remote SSH client.'
+                           ' Check ~/.ssh/known_hosts.')
+            return False
+        except socket.gaierror:
+            self.log_error('Provided hostname did not resolve.')
+            return False
+        except Exception as err:
+            self.log_error('Exception caught while trying to connect: %s'
+                           % (err or type(err).__name__))
+            return False
+        self.connected = True
+        self.log_debug('%s successfully connected' % self._hostname)
+        return True
+
+    def close_ssh_session(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        self.connected = False
+        return True
+
+    async def disconnect(self):
+        '''Close the SSH session and wait for it to finish closing'''
+        conn = self.conn
+        self.close_ssh_session()
+        if conn:
+            await conn.wait_closed()
+
+    async def run_command(self, cmd, timeout=180, get_pty=False,
+                          need_root=False):
+        '''Runs a given cmd, either via the SSH session or locally'''
+        cmd, get_pty, password = self._prep_command(cmd, get_pty, need_root)
+        if self.local:
+            proc = await asyncio.create_subprocess_shell(
+                cmd, stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, start_new_session=True)
+            password = None
+        else:
+            proc = await self.conn.create_process(
+                cmd, encoding=None, term_type='xterm' if get_pty else None)
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                self._communicate(proc, password), timeout)
+        except asyncio.TimeoutError:
+            if self.local:
+                proc.kill()
+            else:
+                proc.close()
+            raise socket.timeout
+        except asyncio.CancelledError:
+            # the node has been given up on, so do not leave the command
+            # running, even locally
+            if not self.local:
+                proc.close()
+            elif proc.returncode is None:
+                os.killpg(proc.pid, signal.SIGTERM)
+            raise
+        return self._fmt_output(
+            stdout=b''.join(stdout).decode('utf-8', 'replace'),
+            stderr=b''.join(stderr).decode('utf-8', 'replace'),
+            rc=proc.returncode
+        )
+
+    async def _communicate(self, proc, password):
+        '''Read the output of proc until it exits, sending password the first
+        time a password prompt is seen'''
+        stdout = []
+        stderr = []
+        prompt = [password]
+
+        async def _read(stream, output):
+            tail = b''
+            while True:
+                data = await stream.read(CHANNEL_READ_SIZE)
+                if not data:
+                    return
+                output.append(data)
+                tail = (tail + data)[-256:]
+                if prompt[0] and PASSWORD_PROMPT.search(tail):
+                    proc.stdin.write((prompt[0] + '\n').encode('utf-8'))
+                    prompt[0] = None
+                    tail = b''
+
+        await asyncio.gather(_read(proc.stdout, stdout),
+                             _read(proc.stderr, stderr))
+        await proc.wait()
+        return stdout, stderr
+
+    async def probe_host_facts(self):
+        pkgs = self._probe_packages()
+        try:
+            res = await self.run_command(
+                self._fact_probe_script(pkgs),
+                need_root=self._fact_probe_need_root())
+        except Exception as err:
+            self.log_debug('Fact probe failed: %s' % err)
+            return False
+        if not self._load_fact_probe(res, pkgs):
+            return False
+        if self.host_facts['atomic'] and self.connected:
+            await self._load_sos_info()
+        elif self.connected and self.config['sos_info_registry']:
+            await self._load_shared_sos_info()
+        return True
+
+    async def _load_shared_sos_info(self):
+        registry = self.config['sos_info_registry']
+        key = self._sos_info_key()
+        future, owner = registry.claim(key)
+        if owner:
+            info = None
+            try:
+                info = await self._probe_sos_info()
+            finally:
+                registry.publish(key, future, info)
+            return
+        info = await asyncio.wrap_future(future)
+        if info is None:
+            await self._probe_sos_info()
+        else:
+            self._set_shared_sos_info(info)
+
+    async def _probe_sos_info(self):
+        try:
+            res = await self.run_command(self._fmt_script_cmd(SOS_INFO_SCRIPT),
+                                         need_root=True)
+        except Exception as err:
+            self.log_debug('sos info probe failed: %s' % err)
+            return None
+        return self._load_sos_info_probe(res)
+
+    async def _load_sos_info(self):
+        prefix = self.set_sos_prefix()
+        cmd = prefix + self.host_facts['package_manager']['query'] + 'sos'
+        res = await self.run_command(cmd)
+        if res['status'] != 0:
+            self.log_error('sos is not installed on this node')
+            self.connected = False
+            return False
+        ver = res['stdout'].splitlines()[-1].split('-')[1]
+        self.sos_info['version'] = ver
+        self.log_debug('sos version is %s' % self.sos_info['version'])
+        sosinfo = await self.run_command(prefix + 'sosreport -l')
+        if sosinfo['status'] == 0:
+            self._load_sos_plugins(sosinfo['stdout'])
+        if self.check_sos_version('3.6'):
+            res = await self.run_command(prefix + 'sosreport --list-presets')
+            if res['status'] == 0:
+                self._parse_sos_presets(res['stdout'])
+        return True
+
+    async def generate_sosreport(self):
+        self.finalize_sos_cmd()
+        self.log_debug('Final sos command set to %s', self.sos_cmd)
+        self.log_info('Generating sosreport...')
+        try:
+            res = await self.run_command(self.sos_cmd,
+                                         timeout=self.config['timeout'],
+                                         get_pty=True, need_root=True)
+            path = self._get_sos_path(res)
+            if path:
+                self.finalize_sos_path(path)
+            else:
+                self.log_error('Unable to determine path of sos archive')
+        except socket.timeout:
+            self.log_error('Timeout exceeded')
+        except Exception as err:
+            self.log_error('Error running sosreport: %s' % err)
+        return self.sos_path is not None
+
+    async def retrieve_sosreport(self):
+        if self.config['need_sudo'] or self.config['become_root']:
+            res = await self.run_command('chmod +r %s' % self.sos_path,
+                                         timeout=10, need_root=True)
+            if res['status'] != 0:
+                self.log_error('Failed to make archive readable')
+                return False
+        self.log_info('Retrieving sosreport...')
+        dest = os.path.join(self.config['tmp_dir'], self.archive)
+        loop = asyncio.get_event_loop()
+        try:
+            if self.local:
+                await loop.run_in_executor(None, shutil.move, self.sos_path,
+                                           dest)
+                self.verified = True
+                self.log_info('Successfully collected sosreport')
+            else:
+                start = time.time()
+                checksum = await self.get_transfer_checksum(self.sos_path)
+                await self.retrieve_file(self.sos_path, dest, checksum)
+                self.verified = checksum is not None
+                size = os.path.getsize(dest) / 1024.0 / 1024
+                self.log_info('Successfully collected sosreport (%.1f MB at '
+                              '%.1f MB/s)'
+                              % (size, size / (time.time() - start)))
+            return True
+        except Exception as err:
+            self.log_error('Failed to retrieve sosreport. %s' % err)
+            return False
+
+    async def get_remote_checksum(self, path):
+        cmd = self._fmt_script_cmd(CHECKSUM_SCRIPT % {'path': path})
+        try:
+            res = await self.run_command(cmd, need_root=True)
+        except Exception as err:
+            self.log_debug('Could not get checksum of %s: %s' % (path, err))
+            return None
+        return self._parse_checksum(path, res)
+
+    async def get_transfer_checksum(self, path):
+        if self.config['no_transfer_verify']:
+            return None
+        return await self.get_remote_checksum(path)
+
+    async def retrieve_file(self, path, dest, checksum=None):
+        '''Copy the file at path on the node to dest locally, verifying it
+        against checksum if one is given.
+
+        asyncssh keeps many reads in flight for a single transfer, so there is
+        no need for multiple streams here. A transfer that is interrupted is
+        started again from the beginning once reconnected.
+        '''
+        attempt = 0
+        while True:
+            try:
+                async with self.conn.start_sftp_client() as sftp:
+                    await sftp.get(path, dest, max_requests=SFTP_REQUESTS)
+                break
+            except (OSError, asyncssh.Error) as err:
+                attempt += 1
+                if attempt > self.config['transfer_retries']:
+                    if os.path.exists(dest):
+                        os.remove(dest)
+                    raise
+                self.log_info('Transfer interrupted: %s. Retrying...' % err)
+                self.close_ssh_session()
+                if not await self.open_session():
+                    raise
+        if checksum:
+            digest = await asyncio.get_event_loop().run_in_executor(
+                None, file_digest, dest, checksum[0])
+            if digest != checksum[1].lower():
+                os.remove(dest)
+                raise ChecksumMismatch('%s checksum of %s was %s, expected %s'
+                                       % (checksum[0], path, digest,
+                                          checksum[1]))
+            self.log_debug('Verified %s checksum of %s' % (checksum[0], path))
+
+    async def cleanup(self):
+        if self.retrieved and self.keep_remote_archive():
+            self.log_info('Sosreport could not be verified, leaving it on '
+                          'the node at %s' % self.sos_path)
+        elif self.retrieved:
+            try:
+                await self.run_command('rm -f %s %s.sha256 %s.md5'
+                                       % ((self.sos_path,) * 3))
+            except Exception as err:
+                self.log_error('Failed to remove sosreport on host: %s' % err)
+        elif self.sos_path and not self.local:
+            self.log_info('Sosreport was not retrieved, leaving it on the '
+                          'node at %s' % self.sos_path)
+        cleanup = self.config['cluster'].get_cleanup_cmd(self.host_facts)
+        if cleanup:
+            try:
+                await self.run_command(cleanup, timeout=15)
+            except Exception:
+                pass
+
+
+class AsyncCollector():
+    '''Collects sosreports from nodes on an event loop, for SosCollector.
+
+    Nodes that are already connected, such as the master, are plain SosNodes
+    and are collected using SosCollector's own methods on a thread. The stage
+    limits are asyncio semaphores of the same sizes as SosCollector's, except
+    that sosreport is run on every node at once unless --max-sos-runs is set,
+    as a running sosreport costs us nothing here.
+    '''
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.config = collector.config
+        self.known_hosts = None
+        self.nodes = []
+
+    def run(self, nodes):
+        '''Collect from the already connected clients and from nodes,
+        returning the number of sosreports retrieved'''
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._run(nodes))
+        finally:
+            loop.close()
+
+    def _load_known_hosts(self):
+        '''Read known_hosts once, rather than for each node'''
+        path = os.path.expanduser('~/.ssh/known_hosts')
+        try:
+            self.known_hosts = asyncssh.read_known_hosts(path)
+        except (OSError, ValueError):
+            self.known_hosts = None
+
+    async def _run(self, nodes):
+        self._load_known_hosts()
+        threads = self.config['threads']
+        total = len(nodes) + len(self.collector.client_list)
+        self.limits = {
+            'connect': asyncio.Semaphore(self.collector._get_max_connects()),
+            'sos': asyncio.Semaphore(self.config['max_sos_runs'] or total),
+            'transfer': asyncio.Semaphore(self.config['max_transfers'] or
+                                          threads)
+        }
+        loop = asyncio.get_event_loop()
+        tasks = set(loop.run_in_executor(None, self.collector._collect, client)
+                    for client in list(self.collector.client_list))
+        tasks.update(asyncio.ensure_future(self._collect_node(node))
+                     for node in nodes)
+        total = len(tasks)
+        finished = 0
+        self.retrieved = 0
+        while tasks:
+            done, tasks = await asyncio.wait(
+                tasks, timeout=self.collector._cutoff_wait(),
+                return_when=asyncio.FIRST_COMPLETED)
+            finished += self._count_results(done)
+            reason = self.collector._collection_cutoff(finished, total)
+            if reason and tasks:
+                await self._cut_collection(reason, tasks)
+                break
+        await asyncio.gather(*[node.disconnect() for node in self.nodes])
+        return self.retrieved
+
+    def _count_results(self, done):
+        for task in done:
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                self.collector.log_debug('Error during collection: %s'
+                                         % task.exception())
+            elif task.result():
+                self.retrieved += 1
+        return len(done)
+
+    async def _cut_collection(self, reason, tasks):
+        '''Give up on every node still being collected from, as with
+        SosCollector._cut_collection(). Nodes on the event loop are cancelled
+        outright, which closes their sessions, while clients collected on a
+        thread are cancelled there.
+        '''
+        col = self.collector
+        cancelled = set(col.manifest.cut(reason))
+        col.log_info('\nCollection stopped, %s. Cancelling collection from '
+                     'the remaining %s nodes' % (reason, len(cancelled)))
+        for task in tasks:
+            task.cancel()
+        with col.client_lock:
+            clients = [c for c in col.client_list if c.address in cancelled]
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, client.cancel)
+                               for client in clients
+                               if not isinstance(client, AsyncSosNode)])
+        done, tasks = await asyncio.wait(tasks, timeout=CANCEL_GRACE)
+        self._count_results(done)
+        if tasks:
+            col.log_debug('%s nodes had not stopped %ss after being '
+                          'cancelled' % (len(tasks), CANCEL_GRACE))
+        for client in clients:
+            col._discard_sosreport(client)
+
+    async def _connect(self, node):
+        async with self.limits['connect']:
+            connected = await node.connect()
+        if not connected:
+            await node.disconnect()
+            return False
+        with self.collector.client_lock:
+            self.collector.client_list.append(node)
+        return True
+
+    async def _collect_node(self, address):
+        node = AsyncSosNode(address, self.config, self.known_hosts)
+        self.nodes.append(node)
+        manifest = self.collector.manifest
+        jit = self.config['jit_sessions']
+        if not jit and not await self._connect(node):
+            manifest.missing(address, 'could not connect')
+            return False
+        try:
+            async with self.limits['sos']:
+                # with --jit-sessions, the session is only opened once the
+                # node may start its sosreport, and closed once we are done
+                if jit and not await self._connect(node):
+                    manifest.missing(address, 'could not connect')
+                    return False
+                generated = await node.generate_sosreport()
+            if generated:
+                async with self.limits['transfer']:
+                    node.retrieved = await node.retrieve_sosreport()
+                self.collector._keep_sosreport(node)
+            else:
+                manifest.missing(address, 'sosreport did not complete')
+        except asyncio.CancelledError:
+            # closing the session ends the sosreport or transfer on it
+            node.cancelled = True
+            node.close_ssh_session()
+            raise
+        finally:
+            if node.connected:
+                await node.cleanup()
+            if jit:
+                await node.disconnect()
+        return node.retrieved
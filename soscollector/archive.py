@@ -0,0 +1,119 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import gzip
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+
+from six.moves import queue
+from soscollector.compression import COMPRESSORS, ParallelCompressor
+
+# The tarfile mode and extension used for each --archive-compression type
+ARCHIVE_TYPES = {
+    'none': ('w', '.tar'),
+    'gzip': ('w:gz', '.tar.gz'),
+    'xz': ('w:xz', '.tar.xz')
+}
+
+
+class ArchiveWriter():
+    '''Builds the final sos-collector archive on a single writer thread.
+
+    Files may be queued for addition from any thread as soon as they are
+    available, so that the archive is assembled while collection is still
+    running rather than in one pass at the end of it. Everything is added
+    under a top level directory of arc_name.
+    '''
+
+    def __init__(self, path, arc_name, compression='none', workers=1):
+        self.path = path
+        self.arc_name = arc_name
+        self.compression = compression
+        self.workers = workers
+        self.logger = logging.getLogger('sos_collector')
+        self.compressor = None
+        if compression in COMPRESSORS and workers > 1:
+            self.compressor = ParallelCompressor(open(path, 'wb'),
+                                                 compression, workers)
+            self.tar = tarfile.open(fileobj=self.compressor, mode='w|')
+        else:
+            self.workers = 1
+            self.tar = tarfile.open(path, ARCHIVE_TYPES[compression][0])
+        self.errors = []
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, path, arcname, remove=False, compress=False):
+        '''Queue path to be added to the archive as arcname. If remove is
+        True, path is deleted once it has been added. If compress is True,
+        path is compressed with gzip on its own and added as arcname.gz'''
+        self.queue.put((path, arcname, remove, compress))
+
+    def wait(self):
+        '''Block until every file queued so far has been added'''
+        self.queue.join()
+
+    def close(self):
+        '''Add any files still queued, then finish writing the archive. Any
+        error encountered while adding files is raised here'''
+        self.queue.put(None)
+        self.thread.join()
+        self.tar.close()
+        if self.compressor:
+            self.compressor.close()
+        if self.errors:
+            raise self.errors[0]
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, arcname, remove, compress = item
+                if compress:
+                    arcname = self._add_compressed(path, arcname)
+                else:
+                    self.tar.add(path, arcname=self.arc_name + '/' + arcname)
+                self.logger.debug('Added %s to archive' % arcname)
+                if remove:
+                    os.remove(path)
+            except Exception as err:
+                self.logger.error('Could not add %s to archive: %s'
+                                  % (item[0], err))
+                self.errors.append(err)
+            finally:
+                self.queue.task_done()
+
+    def _add_compressed(self, path, arcname):
+        '''Add path to the archive compressed with gzip, returning the name
+        it was added as'''
+        arcname += '.gz'
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as tmpfile:
+                with open(path, 'rb') as src:
+                    with gzip.GzipFile(arcname, 'wb', fileobj=tmpfile) as dst:
+                        shutil.copyfileobj(src, dst)
+            self.tar.add(tmp, arcname=self.arc_name + '/' + arcname)
+        finally:
+            os.remove(tmp)
+        return arcname
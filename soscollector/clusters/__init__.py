@@ -13,11 +13,29 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import importlib
 import logging
 import subprocess
 
 from soscollector.configuration import ClusterOption
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# Every cluster profile, in the order they are checked for, with the module
+# under soscollector.clusters that defines it and the packages that indicate
+# it is in use. Profiles are only imported when they are used, so a new
+# profile must be added here, ahead of any profile it subclasses
+CLUSTER_PROFILES = [
+    ('openshift', 'kubernetes', ('atomic-openshift',)),
+    ('rhv', 'ovirt', ('rhevm', 'rhvm')),
+    ('kubernetes', 'kubernetes', ('kubernetes-master',)),
+    ('ovirt', 'ovirt', ('ovirt-engine',)),
+    ('pacemaker', 'pacemaker', ('pacemaker',))
+]
+
 
 class Cluster():
 
@@ -150,7 +168,10 @@ class Cluster():
         is meant to return True when the cluster type matches a criteria
         that indicates that is the cluster type is in use.
 
-        Only the first cluster type to determine a match is run
+        Only the first cluster type to determine a match is run. Profiles
+        are checked in the order of CLUSTER_PROFILES. The packages of
+        every profile are queried for on the master in one go before this is
+        called, so is_installed() does not usually need to run any commands
         '''
         for pkg in self.packages:
             if self.master.is_installed(pkg):
@@ -230,3 +251,35 @@ class Cluster():
             if node.startswith(('-', '_', '(', ')', '[', ']', '/', '\\')):
                 node_list.remove(node)
         return node_list
+
+
+class ClusterProfiles(Mapping):
+    '''The cluster profiles, by name, in the order of CLUSTER_PROFILES.
+
+    Each profile is imported and loaded the first time it is looked up, so
+    that a run only imports the profiles it checks for or is told to use.
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.modules = dict((name, module)
+                            for name, module, pkgs in CLUSTER_PROFILES)
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            module = importlib.import_module('soscollector.clusters.%s'
+                                             % self.modules[name])
+            self.loaded[name] = getattr(module, name)(self.config)
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(name for name, module, pkgs in CLUSTER_PROFILES)
+
+    def __len__(self):
+        return len(CLUSTER_PROFILES)
+
+    def packages(self):
+        '''Returns every package that any profile checks for'''
+        return sorted(set(pkg for name, module, pkgs in CLUSTER_PROFILES
+                          for pkg in pkgs if pkg))
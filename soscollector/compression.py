@@ -0,0 +1,104 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import zlib
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def compress_gzip(block):
+    '''Compress block into a complete gzip member'''
+    comp = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return comp.compress(block) + comp.flush()
+
+
+def compress_xz(block):
+    '''Compress block into a complete xz stream'''
+    return lzma.compress(block, format=lzma.FORMAT_XZ)
+
+
+COMPRESSORS = {
+    'gzip': compress_gzip,
+    'xz': compress_xz
+}
+
+
+class ParallelCompressor():
+    '''A write-only file object that compresses everything written to it
+    using a pool of processes.
+
+    Written data is split into blocks that are each compressed independently
+    as a complete gzip member or xz stream, and written out to fileobj in
+    order. Both formats allow members/streams to be concatenated, so the
+    result can be read by gzip, xz and tarfile as normal.
+    '''
+
+    def __init__(self, fileobj, compression, workers,
+                 block_size=BLOCK_SIZE):
+        if compression == 'xz' and lzma is None:
+            raise Exception('xz compression requires the lzma module')
+        self.fileobj = fileobj
+        self.compress = COMPRESSORS[compression]
+        self.workers = workers
+        self.block_size = block_size
+        self.pool = ProcessPoolExecutor(workers)
+        self.buf = []
+        self.buflen = 0
+        self.pending = deque()
+        self.closed = False
+
+    def write(self, data):
+        written = len(data)
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.block_size:
+            data = b''.join(self.buf)
+            end = len(data) - len(data) % self.block_size
+            for i in range(0, end, self.block_size):
+                self._submit(data[i:i + self.block_size])
+            self.buf = [data[end:]]
+            self.buflen = len(data) - end
+        return written
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(self.compress, block))
+        # keep a couple of blocks queued per worker so that none go idle, but
+        # do not let the queue grow without bound if the disk is slow
+        while len(self.pending) > self.workers * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        '''Compress anything still buffered, then wait for all blocks to be
+        written out before closing fileobj'''
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buflen:
+                self._submit(b''.join(self.buf))
+                self.buf = []
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown(wait=True)
+            self.fileobj.close()
@@ -17,6 +17,10 @@ import re
 import six
 import socket
 
+# Options for which 0 on the command line is a value of its own, to be
+# validated, rather than the same as not giving the option at all
+ZERO_OPTIONS = ('deadline', 'quorum')
+
 
 class Configuration(dict):
     """ Dict subclass that is used to handle configuration information
@@ -49,9 +53,16 @@ class Configuration(dict):
         self['label'] = None
         self['case_id'] = None
         self['timeout'] = 300
+        self['deadline'] = 0
+        self['quorum'] = 100
+        self['detach'] = False
+        self['engine'] = 'threads'
+        self['jit_sessions'] = False
         self['all_logs'] = False
         self['alloptions'] = False
         self['no_pkg_check'] = False
+        self['no_fact_probe'] = False
+        self['probe_packages'] = []
         self['hostname'] = socket.gethostname()
         ips = [i[4][0] for i in socket.getaddrinfo(socket.gethostname(), None)]
         self['ip_addrs'] = list(set(ips))
@@ -68,13 +79,31 @@ class Configuration(dict):
         self['become_root'] = False
         self['root_password'] = ''
         self['threads'] = 4
+        self['processes'] = 1
+        self['max_connects'] = 0
+        self['max_sos_runs'] = 0
+        self['max_transfers'] = 0
+        self['transfer_streams'] = 1
+        self['transport'] = 'paramiko'
+        self['transfer_retries'] = 3
+        self['no_transfer_verify'] = False
+        self['no_prescan'] = False
+        self['fact_cache'] = None
+        self['fact_cache_ttl'] = 24
+        self['refresh_facts'] = False
+        self['sos_info_registry'] = None
+        self['sos_planner'] = None
+        self['show_plan'] = False
         self['compression'] = ''
+        self['archive_compression'] = 'auto'
+        self['archive_workers'] = 1
         self['verify'] = False
         self['chroot'] = ''
         self['sysroot'] = ''
         self['sos_opt_line'] = ''
         self['batch'] = False
         self['verbose'] = False
+        self['debug_log_size'] = 0
         self['preset'] = ''
         self['insecure_sudo'] = False
         self['log_size'] = 0
@@ -112,7 +141,8 @@ class Configuration(dict):
 
     def parse_config(self):
         for k in self.args:
-            if self.args[k]:
+            if self.args[k] or (k in ZERO_OPTIONS and
+                                self.args[k] is not None):
                 self[k] = self.args[k]
 
     def parse_cluster_options(self):
@@ -0,0 +1,80 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+FACT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'sos-collector', 'facts'
+)
+
+
+class FactCache():
+    '''Facts about nodes from earlier runs, kept on disk so that nodes seen
+    recently do not need to be probed again.
+
+    Each node is kept in a file of its own, named for a hash of its key, and
+    files are replaced rather than rewritten, so that nodes can be read and
+    written from any thread or process without locking. Entries older than
+    ttl hours are ignored.
+    '''
+
+    def __init__(self, path=FACT_CACHE_DIR, ttl=24):
+        self.path = path
+        self.ttl = ttl * 3600
+
+    def _file(self, key):
+        return os.path.join(self.path,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        '''Returns the facts cached for key, or None if there are none that
+        are still current'''
+        try:
+            with open(self._file(key), 'r') as cached:
+                entry = json.load(cached)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('key') != key:
+            return None
+        if time.time() - entry.get('time', 0) > self.ttl:
+            return None
+        return entry
+
+    def put(self, key, entry):
+        '''Cache entry for key, returning True if it was written'''
+        entry = dict(entry, key=key, time=time.time())
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+        except OSError:
+            # created by another node in the meantime
+            pass
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+        except (IOError, OSError):
+            return False
+        try:
+            with os.fdopen(fd, 'w') as cached:
+                json.dump(entry, cached)
+            os.rename(tmp, self._file(key))
+        except (IOError, OSError, TypeError, ValueError):
+            os.remove(tmp)
+            return False
+        return True
@@ -0,0 +1,133 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import threading
+
+from six.moves import queue
+
+try:
+    from logging.handlers import QueueHandler
+except ImportError:
+    class QueueHandler(logging.Handler):
+        '''Minimal stand-in for logging.handlers.QueueHandler on python2'''
+
+        def __init__(self, log_queue):
+            logging.Handler.__init__(self)
+            self.queue = log_queue
+
+        def emit(self, record):
+            try:
+                record.msg = self.format(record)
+                record.args = None
+                record.exc_info = None
+                self.queue.put_nowait(record)
+            except Exception:
+                self.handleError(record)
+
+# The most records written out between flushes of the log files
+BATCH_SIZE = 256
+
+
+class CappedFileHandler(logging.StreamHandler):
+    '''Writes records to a file without flushing after every one, as the
+    LogListener flushes once per batch instead.
+
+    If max_bytes is set, once that much has been written only records of INFO
+    and above are written, so that debug logging from a large number of nodes
+    cannot grow the file without bound.
+    '''
+
+    def __init__(self, stream, max_bytes=0):
+        logging.StreamHandler.__init__(self, stream)
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.capped = False
+
+    def emit(self, record):
+        if self.capped and record.levelno < logging.INFO:
+            return
+        try:
+            msg = self.format(record) + '\n'
+            self.stream.write(msg)
+            self.written += len(msg)
+            if self.max_bytes and not self.capped:
+                if self.written >= self.max_bytes:
+                    self.capped = True
+                    self.stream.write('Log reached %s bytes, no further debug '
+                                      'messages will be written\n'
+                                      % self.max_bytes)
+        except Exception:
+            self.handleError(record)
+
+
+class LogListener():
+    '''Writes out records placed on a queue by QueueHandlers, on a thread of
+    its own, so that threads which log never wait on file I/O.
+
+    Records are passed to the handlers registered for the name of the logger
+    they came from. Records are taken from the queue in batches, and the
+    handlers are flushed once after each batch rather than per record.
+    '''
+
+    def __init__(self, log_queue, batch_size=BATCH_SIZE):
+        self.queue = log_queue
+        self.batch_size = batch_size
+        self.handlers = {}
+        self.thread = None
+
+    def add_handler(self, name, handler):
+        '''Send records from the logger called name to handler'''
+        self.handlers.setdefault(name, []).append(handler)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def flush(self):
+        '''Block until every record queued so far has been written out'''
+        if self.thread and self.thread.is_alive():
+            self.queue.join()
+
+    def stop(self):
+        '''Write out everything still queued, then stop the thread'''
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = False
+            for record in batch:
+                if record is None:
+                    stop = True
+                    continue
+                for hndlr in self.handlers.get(record.name, []):
+                    if record.levelno >= hndlr.level:
+                        hndlr.handle(record)
+            for hndlrs in self.handlers.values():
+                for hndlr in hndlrs:
+                    hndlr.flush()
+            for i in range(len(batch)):
+                self.queue.task_done()
+            if stop:
+                return
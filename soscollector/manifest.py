@@ -0,0 +1,104 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import threading
+
+from collections import OrderedDict
+
+PENDING = 'pending'
+COLLECTED = 'collected'
+MISSING = 'missing'
+
+
+class CollectionManifest():
+    '''Which nodes a sosreport was collected from, and why any others were
+    not. This is added to the final archive as manifest.json.
+
+    Each node is pending until it is either collected or missing, and only
+    its first outcome is kept. This decides between a node whose sosreport
+    arrives just as the collection is cut short and the cut itself, as
+    whichever is recorded first stands.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = OrderedDict()
+        self.cutoff = None
+
+    def pending(self, node):
+        '''Add node as one we are collecting from'''
+        with self.lock:
+            self.nodes.setdefault(node, (PENDING, None))
+
+    def _record(self, node, status, reason=None):
+        with self.lock:
+            if self.nodes.get(node, (PENDING,))[0] != PENDING:
+                return False
+            self.nodes[node] = (status, reason)
+            return True
+
+    def collected(self, node):
+        '''Record the sosreport of node as collected. Returns False if node
+        has already been given up on, in which case its sosreport should not
+        be kept'''
+        return self._record(node, COLLECTED)
+
+    def missing(self, node, reason):
+        '''Record that no sosreport was collected from node, and why'''
+        return self._record(node, MISSING, reason)
+
+    def cut(self, reason):
+        '''Give up on every node still pending, returning them'''
+        with self.lock:
+            self.cutoff = reason
+            nodes = [n for n, s in self.nodes.items() if s[0] == PENDING]
+            for node in nodes:
+                self.nodes[node] = (MISSING, 'cancelled, %s' % reason)
+        return nodes
+
+    def get_missing(self):
+        '''Returns a list of (node, reason) for each node that was not
+        collected from'''
+        with self.lock:
+            return [(n, s[1]) for n, s in self.nodes.items()
+                    if s[0] == MISSING]
+
+    def update(self, entries, cutoff=None):
+        '''Add the outcomes recorded by the manifest of a worker process,
+        along with why it cut its collection short, if it did'''
+        with self.lock:
+            for node, status in entries:
+                self.nodes[node] = tuple(status)
+            if cutoff and not self.cutoff:
+                self.cutoff = cutoff
+        return self
+
+    def entries(self):
+        with self.lock:
+            return list(self.nodes.items())
+
+    def write(self, path):
+        '''Write the manifest out as JSON to path'''
+        with self.lock:
+            manifest = {
+                'collected': [n for n, s in self.nodes.items()
+                              if s[0] == COLLECTED],
+                'missing': OrderedDict((n, s[1]) for n, s in self.nodes.items()
+                                       if s[0] != COLLECTED),
+                'cutoff': self.cutoff
+            }
+        with open(path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
@@ -0,0 +1,152 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import select
+import socket
+import threading
+import time
+
+from concurrent.futures import Future
+from six.moves import queue
+
+# How often, in seconds, we check for new nodes to watch and expired deadlines
+POLL_INTERVAL = 1
+# How long to wait between attempts to reconnect to a node
+RECONNECT_INTERVAL = 10
+
+
+class SosMonitor():
+    '''Waits for detached sosreports to exit on any number of nodes from a
+    single thread.
+
+    For each node, a wait is started on a channel over its existing SSH
+    session which produces output once sosreport exits. All of those channels
+    are poll()ed together, so nodes cost us nothing while their sosreport
+    runs. If the connection to a node is lost, it is reconnected using the
+    given executor and the wait started again, since sosreport carries on
+    regardless.
+    '''
+
+    def __init__(self, executor, timeout):
+        self.executor = executor
+        self.timeout = timeout
+        self.logger = logging.getLogger('sos_collector')
+        self.poller = select.poll()
+        self.incoming = queue.Queue()
+        # fd -> (client, future, deadline)
+        self.watched = {}
+        # (attempt, client, future, deadline) for nodes being reconnected
+        self.reconnecting = []
+        # (retry at, client, future, deadline) for nodes to reconnect later
+        self.retries = []
+        self.thread = None
+        self._stop = threading.Event()
+
+    def watch(self, client):
+        '''Watch the detached sosreport on client. Returns a future which is
+        resolved with the exit code of sosreport on the monitor thread, or
+        fails with socket.timeout if it has not exited within the timeout.
+        '''
+        future = Future()
+        self.incoming.put((client, future, time.time() + self.timeout))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        return future
+
+    def stop(self):
+        self._stop.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._add_incoming()
+            self._check_reconnects()
+            for fd, event in self.poller.poll(POLL_INTERVAL * 1000):
+                client, future, deadline = self.watched[fd]
+                try:
+                    rc = client.read_sos_watch()
+                    if rc is None:
+                        continue
+                    self._unwatch(fd)
+                    future.set_result(rc)
+                except EOFError as err:
+                    self._unwatch(fd)
+                    self.logger.debug('[%s] %s, reconnecting'
+                                      % (client.address, err))
+                    self._reconnect(client, future, deadline)
+                except Exception as err:
+                    self._unwatch(fd)
+                    future.set_exception(err)
+            self._check_deadlines()
+
+    def _add_incoming(self):
+        '''Start waiting on any nodes that have been handed to us, or have
+        been reconnected'''
+        while True:
+            try:
+                client, future, deadline = self.incoming.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fileobj = client.watch_sosreport()
+            except Exception as err:
+                self.logger.debug('[%s] Could not wait on sosreport: %s'
+                                  % (client.address, err))
+                self._reconnect(client, future, deadline)
+                continue
+            fd = fileobj.fileno()
+            self.watched[fd] = (client, future, deadline)
+            self.poller.register(fd, select.POLLIN | select.POLLHUP)
+
+    def _unwatch(self, fd):
+        self.poller.unregister(fd)
+        del self.watched[fd]
+
+    def _reconnect(self, client, future, deadline):
+        '''Reconnect to the node on the executor, since that blocks, then
+        wait on its sosreport again'''
+        self.reconnecting.append(
+            (self.executor.submit(client.reconnect), client, future, deadline)
+        )
+
+    def _check_reconnects(self):
+        now = time.time()
+        for item in list(self.retries):
+            if now >= item[0]:
+                self.retries.remove(item)
+                self._reconnect(*item[1:])
+        for item in list(self.reconnecting):
+            attempt, client, future, deadline = item
+            if not attempt.done():
+                continue
+            self.reconnecting.remove(item)
+            if attempt.exception() is None and attempt.result():
+                self.incoming.put((client, future, deadline))
+            elif now + RECONNECT_INTERVAL < deadline:
+                self.retries.append((now + RECONNECT_INTERVAL, client, future,
+                                     deadline))
+            else:
+                future.set_exception(socket.timeout())
+
+    def _check_deadlines(self):
+        now = time.time()
+        for fd, (client, future, deadline) in list(self.watched.items()):
+            if now > deadline:
+                self._unwatch(fd)
+                future.set_exception(socket.timeout())
@@ -0,0 +1,148 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import re
+import socket
+
+from collections import OrderedDict
+
+# A --nodes entry containing any of these is a regex to filter the nodes
+# reported by the cluster with, rather than the name of a node to add
+REGEX_CHARS = ('*', '\\', '?', '(', ')', '[', ']', '/')
+
+# Patterns that refer back to their own groups, or that set flags for the
+# whole pattern, cannot be joined with others into a single regex, as joining
+# them renumbers their groups
+UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+
+def is_regex(node):
+    '''Returns True if the --nodes entry node is a regex'''
+    return any(c in node for c in REGEX_CHARS)
+
+
+def is_ip(node):
+    '''Returns True if node is an IPv4 or IPv6 address'''
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, node)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+def short_name(node):
+    '''Returns the short hostname of node. Addresses are their own short
+    name'''
+    if is_ip(node):
+        return node
+    return node.split('.')[0]
+
+
+class NodeMatcher():
+    '''The --nodes patterns, compiled once to match node names against.
+
+    Where possible, the patterns are joined into a single regex, so that a
+    node is checked against all of them in one pass. A node matches if any
+    pattern matches the start of its name, as with re.match(). Patterns that
+    do not compile are left out, and kept in errors.
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = []
+        self.errors = []
+        for pattern in patterns or []:
+            try:
+                self.patterns.append(re.compile(pattern))
+            except re.error as err:
+                self.errors.append((pattern, err))
+        self.regex = None
+        if len(self.patterns) > 1 and not any(UNCOMBINABLE_RE.search(p.pattern)
+                                              for p in self.patterns):
+            try:
+                self.regex = re.compile('|'.join('(?:%s)' % p.pattern
+                                                 for p in self.patterns))
+            except re.error:
+                # such as patterns that each name a group the same
+                self.regex = None
+
+    def match(self, node):
+        '''Returns True if node matches any of the patterns'''
+        if self.regex is not None:
+            return self.regex.match(node) is not None
+        return any(p.match(node) for p in self.patterns)
+
+    def filter(self, nodes):
+        '''Returns the nodes that match any of the patterns, in order'''
+        return [n for n in nodes if self.match(n)]
+
+
+class NodeSet():
+    '''An ordered set of node names.
+
+    Nodes are also indexed by their short hostname, so that every form of a
+    host's name in the set can be found and removed without checking each
+    node in turn.
+    '''
+
+    def __init__(self, nodes=()):
+        self.nodes = OrderedDict()
+        self.short = {}
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        '''Add node, if it is not empty and not already in the set'''
+        if not node or node in self.nodes:
+            return
+        self.nodes[node] = None
+        self.short.setdefault(short_name(node), set()).add(node)
+
+    def discard(self, node):
+        '''Remove node if it is in the set'''
+        if node not in self.nodes:
+            return
+        del self.nodes[node]
+        names = self.short[short_name(node)]
+        names.discard(node)
+        if not names:
+            del self.short[short_name(node)]
+
+    def discard_short(self, node):
+        '''Remove every node with the same short hostname as node, whatever
+        its domain'''
+        for name in list(self.short.get(short_name(node), ())):
+            self.discard(name)
+
+    def discard_host(self, node):
+        '''Remove node, along with any other form of its name, such as its
+        short hostname if node is a FQDN, or any FQDN it could be short for
+        if it is not. Addresses only match themselves'''
+        self.discard(node)
+        if is_ip(node):
+            return
+        for name in list(self.short.get(short_name(node), ())):
+            if '.' not in name or '.' not in node:
+                self.discard(name)
@@ -0,0 +1,348 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import base64
+import hashlib
+import hmac
+import os
+import paramiko
+import select
+import socket
+import threading
+import time
+
+from soscollector.transfer import ChecksumMismatch, SftpTransfer
+from soscollector.transports import (CHANNEL_READ_SIZE, PASSWORD_PROMPT,
+                                     ChannelWatch, SosTransport)
+
+
+class HostKeyIndex():
+    '''The system host keys, parsed once and shared by every node.
+
+    paramiko.HostKeys checks each line it loads against every entry loaded
+    before it, and finds a host by checking every entry, which is slow with a
+    large known_hosts. Here entries are indexed by hostname, and hashed
+    hostnames are kept by their salt, so that a lookup computes the HMAC of
+    the hostname once per salt. Each lookup is cached. Keys accepted for new
+    hosts are added to the index, and are kept to be written out together by
+    save_new().
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.new = []
+        self._index = {}
+        self._hashed = {}
+        self._cache = {}
+
+    def load(self, filename):
+        with open(filename, 'r') as known_hosts:
+            for lineno, line in enumerate(known_hosts, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    entry = paramiko.hostkeys.HostKeyEntry.from_line(line,
+                                                                     lineno)
+                except paramiko.SSHException:
+                    continue
+                if entry is not None:
+                    self._add_entry(entry)
+
+    def _add_entry(self, entry):
+        for hostname in entry.hostnames:
+            if not hostname.startswith('|1|'):
+                self._index.setdefault(hostname, []).append(entry)
+                continue
+            try:
+                salt, digest = hostname[3:].split('|')
+                salt = base64.b64decode(salt)
+                digest = base64.b64decode(digest)
+            except (TypeError, ValueError):
+                continue
+            self._hashed.setdefault(salt, []).append((digest, entry))
+
+    def _hashed_entries(self, hostname):
+        '''The entries whose hashed hostnames match hostname'''
+        name = hostname.encode('utf-8')
+        entries = []
+        for salt, hashed in self._hashed.items():
+            digest = hmac.new(salt, name, hashlib.sha1).digest()
+            entries.extend(e for d, e in hashed
+                           if d == digest and e not in entries)
+        return entries
+
+    def lookup(self, hostname):
+        '''Returns the keys for hostname by key type, as
+        paramiko.HostKeys.lookup() does, or None if there are none'''
+        with self.lock:
+            entries = self._cache.get(hostname)
+            if entries is None:
+                entries = list(self._index.get(hostname, []))
+                entries.extend(e for e in self._hashed_entries(hostname)
+                               if e not in entries)
+                self._cache[hostname] = entries
+        if not entries:
+            return None
+        # let paramiko build the usual view of the keys for this host, where
+        # the first key of each type is the one used
+        keys = paramiko.HostKeys()
+        keytypes = set()
+        for entry in entries:
+            keytype = entry.key.get_name()
+            if keytype not in keytypes:
+                keytypes.add(keytype)
+                keys.add(hostname, keytype, entry.key)
+        return keys.lookup(hostname)
+
+    def check(self, hostname, key):
+        '''Returns True if key is the known key of its type for hostname'''
+        known = (self.lookup(hostname) or {}).get(key.get_name())
+        return known is not None and known.asbytes() == key.asbytes()
+
+    def add(self, hostname, keytype, key):
+        entry = paramiko.hostkeys.HostKeyEntry([hostname], key)
+        with self.lock:
+            self._add_entry(entry)
+            self._cache.pop(hostname, None)
+            self.new.append(entry)
+
+    def save_new(self, filename):
+        '''Append the keys added since the last save to filename, returning
+        how many were written'''
+        with self.lock:
+            new, self.new = self.new, []
+        if new:
+            with open(filename, 'a') as known_hosts:
+                known_hosts.write(''.join(e.to_line() for e in new))
+        return len(new)
+
+
+class IndexAddPolicy(paramiko.MissingHostKeyPolicy):
+    '''Accepts the keys of unknown hosts, as AutoAddPolicy does, adding them
+    to the shared HostKeyIndex rather than to each client'''
+
+    def __init__(self, index):
+        self.index = index
+
+    def missing_host_key(self, client, hostname, key):
+        self.index.add(hostname, key.get_name(), key)
+
+
+KNOWN_HOSTS = os.path.expanduser('~/.ssh/known_hosts')
+_host_keys = None
+_host_keys_lock = threading.Lock()
+
+
+def get_host_keys():
+    '''Returns the HostKeyIndex shared by every node, loading it from the
+    system known_hosts the first time'''
+    global _host_keys
+    with _host_keys_lock:
+        if _host_keys is None:
+            _host_keys = HostKeyIndex()
+            try:
+                _host_keys.load(KNOWN_HOSTS)
+            except IOError:
+                pass
+    return _host_keys
+
+
+def save_host_keys():
+    '''Write the host keys accepted for new nodes during this run out to the
+    system known_hosts, returning how many were written'''
+    if _host_keys is None:
+        return 0
+    return _host_keys.save_new(KNOWN_HOSTS)
+
+
+class ParamikoTransport(SosTransport):
+    '''Connects to nodes using paramiko. This is the default transport'''
+
+    name = 'paramiko'
+
+    def __init__(self, node):
+        SosTransport.__init__(self, node)
+        self.client = None
+
+    def _load_host_keys(self, host_keys):
+        '''Give the client the keys known for this node from the shared
+        index, rather than have it load every key in known_hosts itself'''
+        port = int(self.config['ssh_port'])
+        # the name SSHClient looks the node's key up by
+        name = self.address
+        if port != 22:
+            name = '[%s]:%d' % (self.address, port)
+        keys = self.client.get_host_keys()
+        for keytype, key in (host_keys.lookup(name) or {}).items():
+            keys.add(name, keytype, key)
+
+    def connect(self):
+        try:
+            host_keys = get_host_keys()
+            self.client = paramiko.SSHClient()
+            self._load_host_keys(host_keys)
+            self.client.set_missing_host_key_policy(IndexAddPolicy(host_keys))
+            if not self.config['password']:
+                self.node.log_debug(
+                    'Opening passwordless session to %s' % self.address)
+                self.client.connect(self.address,
+                                    port=int(self.config['ssh_port']),
+                                    username=self.config['ssh_user'],
+                                    timeout=15)
+            else:
+                self.node.log_debug(
+                    'Opening session to %s with password' % self.address)
+                self.client.connect(self.address,
+                                    port=int(self.config['ssh_port']),
+                                    username=self.config['ssh_user'],
+                                    password=self.config['password'],
+                                    timeout=15)
+            return True
+        except paramiko.AuthenticationException:
+            if not self.config['password']:
+                self.node.log_error('Authentication failed. SSH keys '
+                                    'installed?')
+            else:
+                self.node.log_error('Authentication failed. Incorrect '
+                                    'password.')
+        except paramiko.BadAuthenticationType:
+            self.node.log_error('Bad authentication type. The node rejected '
+                                'the authentication attempt.')
+        except paramiko.BadHostKeyException:
+            self.node.log_error('Provided key was rejected by remote SSH '
+                                'client. Check ~/.ssh/known_hosts.')
+        except socket.gaierror as err:
+            if err.errno == -2:
+                self.node.log_error('Provided hostname did not resolve.')
+            else:
+                self.node.log_error('Socket error trying to connect: %s'
+                                    % err)
+        except Exception as e:
+            self.node.log_error('Exception caught while trying to connect: %s'
+                                % e)
+        raise
+
+    def disconnect(self):
+        if self.client:
+            self.client.close()
+
+    def close_inherited(self):
+        # only our copy of the socket is closed, the transport's thread, and
+        # so anything that would talk to the node, does not exist after fork
+        transport = self.client.get_transport() if self.client else None
+        if transport:
+            transport.sock.close()
+        self.client = None
+
+    @classmethod
+    def save_host_keys(cls):
+        return save_host_keys()
+
+    def host_key_fingerprint(self):
+        key = self.client.get_transport().get_remote_server_key()
+        return hashlib.sha256(key.asbytes()).hexdigest()
+
+    def run_command(self, cmd, timeout, get_pty=False, password=None):
+        sin, sout, serr = self.client.exec_command(cmd, timeout=timeout,
+                                                   get_pty=get_pty)
+        return self._wait_for_channel(sout.channel, timeout, password)
+
+    def _wait_for_channel(self, chan, timeout, password=None):
+        '''Wait for the command running on chan to exit, reading its output
+        as it arrives.
+
+        Rather than polling the channel on an interval, we select() on it so
+        that we wake as soon as there is output to read or the remote side
+        closes the channel. If a password is given, it is sent the first time
+        a password prompt is seen in the output.
+        '''
+        stdout = []
+        stderr = []
+        tail = b''
+        deadline = time.time() + timeout
+        while True:
+            while chan.recv_ready():
+                data = chan.recv(CHANNEL_READ_SIZE)
+                stdout.append(data)
+                tail = (tail + data)[-256:]
+            while chan.recv_stderr_ready():
+                data = chan.recv_stderr(CHANNEL_READ_SIZE)
+                stderr.append(data)
+                tail = (tail + data)[-256:]
+            if password and PASSWORD_PROMPT.search(tail):
+                chan.sendall((password + '\n').encode('utf-8'))
+                password = None
+                tail = b''
+            if chan.eof_received or chan.closed:
+                if not (chan.recv_ready() or chan.recv_stderr_ready()):
+                    break
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout
+            select.select([chan], [], [], remaining)
+        if not chan.status_event.wait(max(deadline - time.time(), 0)):
+            raise socket.timeout
+        rc = chan.recv_exit_status()
+        return self.node._fmt_output(
+            stdout=b''.join(stdout).decode('utf-8', 'replace'),
+            stderr=b''.join(stderr).decode('utf-8', 'replace'),
+            rc=rc
+        )
+
+    def start_command(self, cmd):
+        chan = self.client.get_transport().open_session(timeout=30)
+        chan.exec_command(cmd)
+        return ChannelWatch(chan)
+
+    def file_exists(self, fname):
+        sftp = self.client.open_sftp()
+        try:
+            sftp.stat(fname)
+            return True
+        except Exception:
+            return False
+        finally:
+            sftp.close()
+
+    def retrieve_file(self, path, dest, checksum=None):
+        '''Copy path from the node over SFTP, returning the SftpTransfer used.
+
+        If the transfer is interrupted, we reconnect and resume it from where
+        it left off.
+        '''
+        xfer = SftpTransfer(self.client.get_transport(), path, dest,
+                            streams=self.config['transfer_streams'],
+                            checksum=checksum)
+        attempt = 0
+        while True:
+            try:
+                xfer.run()
+                return xfer
+            except ChecksumMismatch:
+                raise
+            except Exception as err:
+                attempt += 1
+                if attempt > self.config['transfer_retries']:
+                    if os.path.exists(dest):
+                        os.remove(dest)
+                    raise
+                self.node.log_info('Transfer interrupted at %s of %s bytes: '
+                                   '%s. Resuming...'
+                                   % (xfer.committed, xfer.size, err))
+                if not self.node.reconnect():
+                    raise
+                xfer.transport = self.client.get_transport()
@@ -0,0 +1,195 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+
+from collections import OrderedDict
+
+
+class SosInfoSets():
+    '''The plugins, options and presets of a node's sos, as sets to check
+    requested plugins and options against'''
+
+    def __init__(self, sos_info):
+        self.enabled = frozenset(sos_info['enabled'])
+        self.disabled = frozenset(sos_info['disabled'])
+        self.options = frozenset(sos_info['options'])
+        self.presets = frozenset(sos_info['presets'])
+        self.shared = bool(sos_info.get('shared'))
+        self.plugins = self.enabled | self.disabled
+
+    def signature(self):
+        return (self.enabled, self.disabled, self.options, self.presets,
+                self.shared)
+
+    def preset_exists(self, preset):
+        return preset in self.presets
+
+    def plugin_exists(self, plugin):
+        return plugin in self.plugins
+
+    def check_enabled(self, plugin):
+        '''Checks to see if the plugin is default enabled on node'''
+        if self.shared:
+            # the plugin lists came from another node, so whether the plugin
+            # is enabled on this one is not known. Passing it to sos is
+            # harmless either way
+            return self.plugin_exists(plugin)
+        return plugin in self.enabled
+
+    def check_disabled(self, plugin):
+        '''Checks to see if the plugin is default disabled on node'''
+        if self.shared:
+            return self.plugin_exists(plugin)
+        return plugin in self.disabled
+
+    def plugin_option_exists(self, opt, enable_plugins):
+        '''Attempts to verify that the given option is available on the node.
+        Note that we only get available options for enabled plugins, so if a
+        plugin has been force-enabled we cannot validate if the plugin option
+        is correct or not'''
+        plug = opt.split('.')[0]
+        if not self.plugin_exists(plug):
+            return False
+        if self.shared:
+            return opt in self.options or plug in enable_plugins
+        if self.check_disabled(plug) and plug not in enable_plugins:
+            return False
+        if self.check_enabled(plug):
+            return opt in self.options
+        # plugin exists, but is normally disabled. Assume user knows option is
+        # valid when enabling the plugin
+        return True
+
+    def fmt_opt_list(self, opts):
+        '''Returns a comma delimited list for sos plugins that are confirmed
+        to exist on the node'''
+        return ','.join(o for o in opts if self.plugin_exists(o))
+
+
+class SosCmdPlan():
+    '''The sosreport command for every node sharing a signature, along with
+    the debug messages from working it out'''
+
+    def __init__(self, signature, cmd, notes):
+        self.signature = signature
+        self.cmd = cmd
+        self.notes = notes
+        self.nodes = []
+
+
+class SosCmdPlanner():
+    '''Works out the sosreport command to run on each node.
+
+    The command only depends on the node's sos prefix, sosreport label and the
+    plugins, options and presets its sos has, so it is worked out once for
+    each distinct combination of these and shared by every node with the
+    same one. Most clusters end up with a single plan, or one for each sos
+    version in use.
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.plans = OrderedDict()
+
+    def plan(self, node):
+        '''Returns the SosCmdPlan for node, working it out if no other node
+        with the same signature has needed one yet'''
+        prefix = node.set_sos_prefix()
+        label = None
+        if not self.config['sos_opt_line']:
+            label = node.determine_sos_label()
+        info = SosInfoSets(node.sos_info)
+        signature = (prefix, label) + info.signature()
+        with self.lock:
+            plan = self.plans.get(signature)
+            if plan is None:
+                cmd, notes = self._build_cmd(prefix, label, info)
+                plan = SosCmdPlan(signature, cmd, notes)
+                self.plans[signature] = plan
+            plan.nodes.append(node.address)
+        for note in plan.notes:
+            node.log_debug(note)
+        return plan
+
+    def _build_cmd(self, prefix, label, info):
+        '''Returns the sosreport command for nodes with the given sos prefix,
+        label and sos info, and any debug messages about it'''
+        notes = []
+        sos_cmd = self.config['sos_cmd']
+        if prefix:
+            sos_cmd = prefix + sos_cmd
+
+        if self.config['sos_opt_line']:
+            sos_cmd += self.config['sos_opt_line']
+            return sos_cmd, notes
+
+        if label:
+            sos_cmd = ' %s %s' % (sos_cmd, label)
+
+        if self.config['only_plugins']:
+            plugs = [o for o in self.config['only_plugins']
+                     if info.plugin_exists(o)]
+            if len(plugs) != len(self.config['only_plugins']):
+                not_only = list(set(self.config['only_plugins']) - set(plugs))
+                notes.append('Requested plugins %s were requested to be '
+                             'enabled but do not exist' % not_only)
+            only = info.fmt_opt_list(self.config['only_plugins'])
+            if only:
+                sos_cmd += ' --only-plugins=%s' % only
+            return sos_cmd, notes
+
+        if self.config['skip_plugins']:
+            # only run skip-plugins for plugins that are enabled
+            skip = [o for o in self.config['skip_plugins']
+                    if info.check_enabled(o)]
+            if len(skip) != len(self.config['skip_plugins']):
+                not_skip = list(set(self.config['skip_plugins']) - set(skip))
+                notes.append('Requested to skip plugins %s, but plugins are '
+                             'already not enabled' % not_skip)
+            skipln = info.fmt_opt_list(skip)
+            if skipln:
+                sos_cmd += ' --skip-plugins=%s' % skipln
+
+        if self.config['enable_plugins']:
+            # only run enable for plugins that are disabled
+            skip = set(self.config['skip_plugins'])
+            opts = [o for o in self.config['enable_plugins']
+                    if o not in skip and info.check_disabled(o)
+                    and info.plugin_exists(o)]
+            if len(opts) != len(self.config['enable_plugins']):
+                not_on = list(set(self.config['enable_plugins']) - set(opts))
+                notes.append('Requested to enable plugins %s, but plugins '
+                             'are already enabled or do not exist' % not_on)
+            enable = info.fmt_opt_list(opts)
+            if enable:
+                sos_cmd += ' --enable-plugins=%s' % enable
+
+        if self.config['plugin_options']:
+            enable = set(self.config['enable_plugins'])
+            opts = [o for o in self.config['plugin_options']
+                    if info.plugin_exists(o.split('.')[0])
+                    and info.plugin_option_exists(o.split('=')[0], enable)]
+            if opts:
+                sos_cmd += ' -k %s' % ','.join(o for o in opts)
+
+        if self.config['preset']:
+            if info.preset_exists(self.config['preset']):
+                sos_cmd += ' --preset=%s' % self.config['preset']
+            else:
+                notes.append('Requested to enable preset %s but preset does '
+                             'not exist on node' % self.config['preset'])
+        return sos_cmd, notes
@@ -0,0 +1,134 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import errno
+import os
+import socket
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+# How long, in seconds, a node has to resolve and accept a connection
+PRESCAN_TIMEOUT = 5
+# How many connections are attempted at once, kept well under the usual
+# limit on open files
+MAX_PENDING = 512
+# getaddrinfo() blocks, so hostnames are resolved on this many threads
+RESOLVERS = 32
+
+IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def _resolve(address, port):
+    return socket.getaddrinfo(address, port, 0, socket.SOCK_STREAM)
+
+
+def _resolve_all(addresses, port, timeout, unreachable):
+    '''Resolve every address at once, returning a list of (address, family,
+    sockaddr) for each of the addresses they resolved to'''
+    targets = []
+    pool = ThreadPoolExecutor(min(RESOLVERS, len(addresses)))
+    futures = dict((pool.submit(_resolve, address, port), address)
+                   for address in addresses)
+    done, not_done = wait(futures, timeout)
+    # don't wait on any lookups that are still hung
+    pool.shutdown(wait=False)
+    for future in not_done:
+        unreachable[futures[future]] = 'timed out resolving hostname'
+    for future in done:
+        address = futures[future]
+        try:
+            infos = future.result()
+        except socket.gaierror as err:
+            unreachable[address] = 'hostname did not resolve (%s)' % err
+            continue
+        for family, stype, proto, cname, sockaddr in infos:
+            targets.append((address, family, sockaddr))
+    return targets
+
+
+def scan_nodes(addresses, port, timeout=PRESCAN_TIMEOUT):
+    '''Check that a TCP connection can be made to port on each of addresses,
+    before any SSH handshakes are started.
+
+    Connections are made without blocking and waited on together with a
+    selector, so that the scan takes only as long as the slowest node, rather
+    than the sum of every timeout. If an address resolves to several IPs, it
+    is reachable if any of them accept the connection. Returns a dict of the
+    addresses that could not be reached, with the reason for each.
+    '''
+    unreachable = {}
+    if not addresses or selectors is None:
+        return unreachable
+    targets = deque(_resolve_all(addresses, int(port), timeout, unreachable))
+    remaining = {}
+    for target in targets:
+        remaining[target[0]] = remaining.get(target[0], 0) + 1
+    reachable = set()
+    sel = selectors.DefaultSelector()
+
+    def _failed(address, reason):
+        remaining[address] -= 1
+        if not remaining[address] and address not in reachable:
+            unreachable[address] = reason
+
+    while targets or sel.get_map():
+        while targets and len(sel.get_map()) < MAX_PENDING:
+            address, family, sockaddr = targets.popleft()
+            if address in reachable:
+                continue
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            err = sock.connect_ex(sockaddr)
+            if err not in IN_PROGRESS:
+                sock.close()
+                _failed(address, os.strerror(err))
+                continue
+            sel.register(sock, selectors.EVENT_WRITE,
+                         (address, time.time() + timeout))
+        if not sel.get_map():
+            continue
+        wake = min(key.data[1] for key in sel.get_map().values())
+        for key, event in sel.select(max(wake - time.time(), 0)):
+            if key.fd not in sel.get_map():
+                # closed as another IP for the node connected first
+                continue
+            address = key.data[0]
+            sel.unregister(key.fileobj)
+            err = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            key.fileobj.close()
+            if err:
+                _failed(address, os.strerror(err))
+            else:
+                reachable.add(address)
+                # no need to wait on any other IPs for the same node
+                for other in list(sel.get_map().values()):
+                    if other.data[0] == address:
+                        sel.unregister(other.fileobj)
+                        other.fileobj.close()
+        now = time.time()
+        for key in list(sel.get_map().values()):
+            if key.data[1] <= now:
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+                _failed(key.data[0], 'timed out connecting')
+    sel.close()
+    return unreachable
@@ -0,0 +1,182 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import multiprocessing
+import os
+import threading
+import time
+
+from six.moves import queue
+from soscollector.logs import QueueHandler
+from soscollector.manifest import CollectionManifest
+
+# Workers are forked so that they inherit the collector as it is, cluster
+# profile and all, rather than having it pickled over to them. The nodes to
+# shard are only known once the master is connected to and logging is set
+# up, so workers cannot be forked before either, and instead close their
+# copies of what they inherit from them
+try:
+    mp = multiprocessing.get_context('fork')
+except AttributeError:
+    mp = multiprocessing
+
+
+class ShardedCollector():
+    '''Collects from nodes using a number of worker processes, for when a
+    single process cannot keep up with the encryption and packet handling
+    for every node at once.
+
+    The nodes are split between the workers, each of which collects from its
+    share using the configured engine, with its own thread pool and stage
+    limits. Workers send their log records and the name of each sosreport
+    they retrieve back to us, so that there is still a single log and a
+    single archive, which sosreports are added to as they arrive. Once done,
+    each worker sends back the outcome for each of its nodes for the
+    manifest. Clients that are already connected, such as the master, are
+    collected here.
+
+    --deadline applies to every worker alike, while --quorum is reached by
+    each worker for its own share of the nodes.
+    '''
+
+    def __init__(self, collector, processes):
+        self.collector = collector
+        self.config = collector.config
+        self.processes = processes
+        self.log_queue = mp.Queue()
+        self.results = mp.Queue()
+
+    def run(self, nodes):
+        '''Collect from the already connected clients and from nodes,
+        returning the number of nodes connected to by the workers and the
+        number of sosreports retrieved in total'''
+        shards = [nodes[i::self.processes] for i in range(self.processes)]
+        workers = {}
+        for index, shard in enumerate(s for s in shards if s):
+            proc = mp.Process(target=self._run_shard, args=(index, shard))
+            proc.start()
+            workers[index] = (proc, shard)
+        logs = threading.Thread(target=self._forward_logs)
+        logs.start()
+        local = threading.Thread(target=self._collect_local)
+        local.start()
+        self.connected = 0
+        self.retrieved = 0
+        while workers:
+            try:
+                self._handle_result(self.results.get(timeout=1), workers)
+            except queue.Empty:
+                self._check_workers(workers)
+        local.join()
+        self.log_queue.put(None)
+        logs.join()
+        return self.connected, self.retrieved
+
+    def _handle_result(self, msg, workers):
+        if msg[0] == 'archive':
+            self.collector._archive_file(msg[1])
+        elif msg[0] == 'done':
+            index, conns, count, elapsed, entries, cutoff = msg[1:]
+            proc, shard = workers.pop(index, (None, []))
+            if proc is not None:
+                proc.join()
+            self.collector.manifest.update(entries, cutoff)
+            self.collector.log_debug(
+                'Worker %s collected %s of %s sosreports from %s nodes in '
+                '%.2fs' % (index, count, conns, len(shard), elapsed))
+            self.connected += conns
+            self.retrieved += count
+
+    def _check_workers(self, workers):
+        '''Give up on the nodes of any worker that has exited without saying
+        it was done'''
+        exited = [i for i, (proc, shard) in workers.items()
+                  if not proc.is_alive()]
+        if not exited:
+            return
+        # a worker may have sent its last results just before exiting, so
+        # take everything already sent before deciding it exited early
+        while True:
+            try:
+                self._handle_result(self.results.get_nowait(), workers)
+            except queue.Empty:
+                break
+        for index in exited:
+            proc, shard = workers.pop(index, (None, None))
+            if proc is None:
+                continue
+            self.collector.log_error(
+                'Worker %s exited with %s, sosreports from its %s nodes were '
+                'not collected' % (index, proc.exitcode, len(shard)))
+            for node in shard:
+                self.collector.manifest.missing(node, 'worker process exited')
+
+    def _collect_local(self):
+        if self.collector.client_list:
+            if self.config['engine'] == 'asyncio':
+                self.collector._collect_async([])
+            else:
+                self.collector._collect_threaded([])
+
+    def _forward_logs(self):
+        '''Hand the records logged by the workers to our own log listener'''
+        for record in iter(self.log_queue.get, None):
+            self.collector.log_listener.queue.put(record)
+
+    def _run_shard(self, index, shard):
+        '''Collect from the nodes in shard. This is run in the worker'''
+        start = time.time()
+        col = self.collector
+        rc = 0
+        try:
+            # our log listener thread does not exist in the worker, so
+            # records are sent back to the parent's instead
+            for hndlr in col.logger.handlers + col.console.handlers:
+                if isinstance(hndlr, QueueHandler):
+                    hndlr.queue = self.log_queue
+            # the sessions to clients, such as the master, belong to the
+            # parent, which is still collecting over them
+            for client in col.client_list:
+                client.close_inherited_session()
+            col.client_list = []
+            col.retrieved = 0
+            col.shard_results = self.results
+            col.manifest = CollectionManifest()
+            for node in shard:
+                col.manifest.pending(node)
+            if self.config['engine'] == 'asyncio':
+                col._collect_async(shard)
+            else:
+                col._collect_threaded(shard)
+            col._save_host_keys()
+            self.results.put(('done', index, len(col.client_list),
+                              col.retrieved, time.time() - start,
+                              col.manifest.entries(), col.manifest.cutoff))
+        except KeyboardInterrupt:
+            rc = 130
+        except Exception as err:
+            col.log_error('Worker %s failed: %s' % (index, err))
+            rc = 1
+        finally:
+            try:
+                col.close_all_connections()
+            except Exception:
+                pass
+            for q in (self.results, self.log_queue):
+                q.close()
+                q.join_thread()
+            # skip the exit handlers, which belong to the parent and would
+            # remove files it is still using
+            os._exit(rc)
@@ -14,28 +14,51 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import fnmatch
-import inspect
 import logging
 import os
 import random
 import re
 import string
-import tarfile
 import threading
 import tempfile
 import shutil
+import socket
 import subprocess
 import sys
+import time
 
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
-from .sosnode import SosNode
-from distutils.sysconfig import get_python_lib
+from concurrent.futures import (Future, ThreadPoolExecutor, FIRST_COMPLETED,
+                                wait)
+from .archive import ARCHIVE_TYPES, ArchiveWriter
+from .clusters import ClusterProfiles
+from .factcache import FactCache
+from .logs import CappedFileHandler, LogListener, QueueHandler
+from .manifest import CollectionManifest
+from .monitor import SosMonitor
+from .nodeset import NodeMatcher, NodeSet, is_regex
+from .planner import SosCmdPlanner
+from .prescan import scan_nodes
+from .shards import ShardedCollector
+from .sosnode import SosInfoRegistry, SosNode
+from .transports import remove_control_dir, save_host_keys
 from getpass import getpass
-from six.moves import input
+from six.moves import input, queue
 from textwrap import fill
 from soscollector import __version__
 
+# Extensions of files that are already compressed, and gain nothing from being
+# compressed again in the final archive
+COMPRESSED_EXTS = ('.gz', '.bz2', '.xz', '.tgz', '.txz', '.zip', '.zst')
+
+# Files of our own, which are small enough to be left uncompressed in an
+# archive that is not compressed as a whole
+OWN_FILES = ('sos-collector.log', 'ui.log', 'manifest.json')
+
+# How long to wait for nodes to stop once their collection is cancelled by
+# --deadline or --quorum, before building the archive without them
+CANCEL_GRACE = 30
+
 
 class SosCollector():
     '''Main sos-collector class'''
@@ -46,8 +69,20 @@ class SosCollector():
         self.workers = []
         self.client_list = []
         self.node_list = []
+        self.node_matcher = None
         self.master = False
         self.retrieved = 0
+        self.report_num = 0
+        self.client_lock = threading.Lock()
+        self.archive_lock = threading.Lock()
+        self.archive_writer = None
+        self.stage_limits = {}
+        self.pool = None
+        self.monitor = None
+        self.shard_results = None
+        self.unreachable = {}
+        self.manifest = CollectionManifest()
+        self.deadline_at = None
         self.need_local_sudo = False
         if not self.config['list_options']:
             try:
@@ -64,17 +99,25 @@ class SosCollector():
             self._load_clusters()
 
     def _setup_logging(self):
+        # Both log files are written by a single listener thread, which the
+        # loggers hand records to via a queue, so that node threads do not
+        # contend with each other on file writes
+        max_bytes = self.config['debug_log_size'] * 1024 * 1024
+        log_queue = queue.Queue()
+        self.log_listener = LogListener(log_queue)
+
         # behind the scenes logging
         self.logger = logging.getLogger('sos_collector')
         self.logger.setLevel(logging.DEBUG)
         self.logfile = tempfile.NamedTemporaryFile(
             mode="w+",
             dir=self.config['tmp_dir'])
-        hndlr = logging.StreamHandler(self.logfile)
+        hndlr = CappedFileHandler(self.logfile, max_bytes)
         hndlr.setFormatter(logging.Formatter(
             '%(asctime)s %(levelname)s: %(message)s'))
         hndlr.setLevel(logging.DEBUG)
-        self.logger.addHandler(hndlr)
+        self.log_listener.add_handler('sos_collector', hndlr)
+        self.logger.addHandler(QueueHandler(log_queue))
 
         console = logging.StreamHandler(sys.stderr)
         console.setFormatter(logging.Formatter('%(message)s'))
@@ -85,12 +128,14 @@ class SosCollector():
         self.console_log_file = tempfile.NamedTemporaryFile(
             mode="w+",
             dir=self.config['tmp_dir'])
-        chandler = logging.StreamHandler(self.console_log_file)
+        chandler = CappedFileHandler(self.console_log_file, max_bytes)
         cfmt = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
         chandler.setFormatter(cfmt)
-        self.console.addHandler(chandler)
+        self.log_listener.add_handler('sos_collector_console', chandler)
+        self.console.addHandler(QueueHandler(log_queue))
 
-        # also print to console
+        # also print to console. This is left synchronous so that messages
+        # are always shown before any prompt that follows them
         ui = logging.StreamHandler()
         fmt = logging.Formatter('%(message)s')
         ui.setFormatter(fmt)
@@ -99,6 +144,7 @@ class SosCollector():
         else:
             ui.setLevel(logging.INFO)
         self.console.addHandler(ui)
+        self.log_listener.start()
 
     def _exit(self, msg, error=1):
         '''Used to safely terminate if sos-collector encounters an error'''
@@ -107,8 +153,16 @@ class SosCollector():
             self.close_all_connections()
         except Exception:
             pass
+        self.stop_logging()
         sys.exit(error)
 
+    def stop_logging(self):
+        '''Write out every record still queued for our logs and the console,
+        as the listener thread does not outlive us'''
+        listener = getattr(self, 'log_listener', None)
+        if listener:
+            listener.stop()
+
     def _parse_options(self):
         '''If there are cluster options set on the CLI, override the defaults
         '''
@@ -160,12 +214,17 @@ class SosCollector():
         self.logger.error(msg)
         self.console.error(msg)
 
-    def log_debug(self, msg):
+    def log_debug(self, msg, *args):
         '''Log debug message to both console and log file'''
-        caller = inspect.stack()[1][3]
+        verbose = self.config['verbose']
+        if not verbose and not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if args:
+            msg = msg % args
+        caller = sys._getframe(1).f_code.co_name
         msg = '[sos_collector:%s] %s' % (caller, msg)
         self.logger.debug(msg)
-        if self.config['verbose']:
+        if verbose:
             self.console.debug(msg)
 
     def create_tmp_dir(self):
@@ -203,25 +262,12 @@ class SosCollector():
         shutil.rmtree(self.config['tmp_dir'])
 
     def _load_clusters(self):
-        '''Load an instance of each cluster so that sos-collector can later
-        determine what type of cluster is in use
+        '''Set up the cluster profiles so that sos-collector can later
+        determine what type of cluster is in use. Profiles are only loaded
+        once they are needed
         '''
-        if 'soscollector' not in os.listdir(os.getcwd()):
-            p = get_python_lib()
-            path = p + '/soscollector/clusters/'
-        else:
-            path = 'soscollector/clusters'
-        self.clusters = {}
-        sys.path.insert(0, path)
-        for f in sorted(os.listdir(path)):
-            fname, ext = os.path.splitext(f)
-            if ext == '.py' and fname not in ['__init__', 'cluster']:
-                mods = inspect.getmembers(__import__(fname), inspect.isclass)
-                for cluster in mods[1:]:
-                    self.clusters[cluster[0]] = cluster[1](self.config)
-        self.log_debug('Found cluster profiles: %s'
-                       % list(self.clusters.keys()))
-        sys.path.pop(0)
+        self.clusters = ClusterProfiles(self.config)
+        self.config['probe_packages'] = self.clusters.packages()
 
     def _get_archive_name(self):
         '''Generates a name for the tarball archive'''
@@ -240,13 +286,33 @@ class SosCollector():
         rand = ''.join(random.choice(string.lowercase) for x in range(5))
         return '%s-%s-%s' % (nstr, dt, rand)
 
-    def _get_archive_path(self):
+    def _get_archive_path(self, compression):
         '''Returns the path, including filename, of the tarball we build
         that contains the collected sosreports
         '''
         self.arc_name = self._get_archive_name()
-        compr = 'gz'
-        return self.config['out_dir'] + self.arc_name + '.tar.' + compr
+        ext = ARCHIVE_TYPES[compression][1]
+        return self.config['out_dir'] + self.arc_name + ext
+
+    def _get_archive_compression(self):
+        '''Determine the compression to use for the final archive. When left
+        to auto, the archive is not compressed as a whole, since the
+        sosreports in it already are. Anything else added to it that is not
+        already compressed is compressed on its own instead, as it is added.
+        '''
+        compression = self.config['archive_compression']
+        if compression != 'auto':
+            return compression
+        return 'none'
+
+    def _add_to_archive(self, writer, path, arcname, remove=False):
+        '''Queue path to be added to the final archive as arcname,
+        compressing it on its own if the archive is not compressed and
+        neither is it'''
+        compress = (self.config['archive_compression'] == 'auto' and
+                    arcname not in OWN_FILES and
+                    not arcname.endswith(COMPRESSED_EXTS))
+        writer.add(path, arcname, remove=remove, compress=compress)
 
     def _fmt_msg(self, msg):
         width = 80
@@ -274,6 +340,16 @@ organization before being passed to any third party.
 No configuration changes will be made to the system running \
 this utility or remote systems that it connects to.
 """)
+        if self.config['engine'] == 'asyncio':
+            try:
+                from . import aio  # noqa
+            except (ImportError, SyntaxError):
+                self._exit('The asyncio engine requires python 3 and the '
+                           'asyncssh module')
+        if not 0 < self.config['quorum'] <= 100:
+            self._exit('--quorum must be a percentage between 1 and 100')
+        if self.config['deadline'] < 0:
+            self._exit('--deadline must not be negative')
         self.console.info("\nsos-collector (version %s)\n" % __version__)
         intro_msg = self._fmt_msg(disclaimer % self.config['tmp_dir'])
         self.console.info(intro_msg)
@@ -317,6 +393,10 @@ this utility or remote systems that it connects to.
                               ' Ignoring request to change user on node')
                 self.config['become_root'] = False
 
+        self.config['fact_cache'] = FactCache(
+            ttl=self.config['fact_cache_ttl'])
+        self.config['sos_info_registry'] = SosInfoRegistry()
+        self.config['sos_planner'] = SosCmdPlanner(self.config)
         if self.config['master']:
             self.connect_to_master()
             self.config['no_local'] = True
@@ -405,6 +485,9 @@ this utility or remote systems that it connects to.
         can still be run if the user sets a --cluster-type manually
         '''
 
+        # find out which of the packages every profile checks for are
+        # installed at once, rather than with a command per package
+        self.master.query_packages(self.config['probe_packages'])
         for clus in self.clusters:
             self.clusters[clus].master = self.master
             if self.clusters[clus].check_enabled():
@@ -424,32 +507,33 @@ this utility or remote systems that it connects to.
     def reduce_node_list(self):
         '''Reduce duplicate entries of the localhost and/or master node
         if applicable'''
-        if (self.config['hostname'] in self.node_list and
-                self.config['no_local']):
-            self.node_list.remove(self.config['hostname'])
+        nodes = NodeSet(self.node_list)
+        if self.config['no_local']:
+            nodes.discard(self.config['hostname'])
         for i in self.config['ip_addrs']:
-            if i in self.node_list:
-                self.node_list.remove(i)
+            nodes.discard(i)
         # remove the master node from the list, since we already have
         # an open session to it.
         if self.config['master']:
-            for n in self.node_list:
-                if n == self.master.hostname or n == self.config['master']:
-                    self.node_list.remove(n)
-        self.node_list = list(set(n for n in self.node_list if n))
+            nodes.discard_host(self.config['master'])
+            if self.master.hostname:
+                nodes.discard_host(self.master.hostname)
+        self.node_list = list(nodes)
         self.log_debug('Node list reduced to %s' % self.node_list)
 
     def compare_node_to_regex(self, node):
         '''Compares a discovered node name to a provided list of nodes from
         the user. If there is not a match, the node is removed from the list'''
-        for regex in self.config['nodes']:
-            try:
-                if re.match(regex, node):
-                    return True
-            except re.error as err:
-                msg = 'Error comparing %s to provided node regex %s: %s'
-                self.log_debug(msg % (node, regex, err))
-        return False
+        return self._get_node_matcher().match(node)
+
+    def _get_node_matcher(self):
+        '''Returns the --nodes patterns compiled into a NodeMatcher'''
+        if self.node_matcher is None:
+            self.node_matcher = NodeMatcher(self.config['nodes'])
+            for regex, err in self.node_matcher.errors:
+                self.log_debug('Error compiling provided node regex %s: %s'
+                               % (regex, err))
+        return self.node_matcher
 
     def get_nodes(self):
         ''' Sets the list of nodes to collect sosreports from '''
@@ -462,35 +546,28 @@ this utility or remote systems that it connects to.
         try:
             nodes = self.get_nodes_from_cluster()
             if self.config['nodes']:
-                for node in nodes:
-                    if self.compare_node_to_regex(node):
-                        self.node_list.append(node)
-            else:
-                self.node_list = nodes
+                nodes = self._get_node_matcher().filter(nodes)
+            nodes = NodeSet(nodes)
         except Exception as e:
             self.log_debug("Error parsing node list: %s" % e)
             self.log_debug('Setting node list to --nodes option')
-            self.node_list = self.config['nodes']
-            for node in self.node_list:
-                if any(i in node for i in ('*', '\\', '?', '(', ')', '/')):
-                    self.node_list.remove(node)
+            nodes = NodeSet(n for n in self.config['nodes'] or []
+                            if not is_regex(n))
 
         # force add any non-regex node strings from nodes option
         if self.config['nodes']:
             for node in self.config['nodes']:
-                if any(i in node for i in ('*', '\\', '?', '(', ')', '/')):
+                if is_regex(node):
                     continue
-                if node not in self.node_list:
+                if node not in nodes:
                     self.log_debug("Force adding %s to node list" % node)
-                    self.node_list.append(node)
+                    nodes.add(node)
 
         if not self.config['master']:
-            host = self.config['hostname'].split('.')[0]
             # trust the local hostname before the node report from cluster
-            for node in self.node_list:
-                if host == node.split('.')[0]:
-                    self.node_list.remove(node)
-            self.node_list.append(self.config['hostname'])
+            nodes.discard_short(self.config['hostname'])
+            nodes.add(self.config['hostname'])
+        self.node_list = list(nodes)
         self.reduce_node_list()
         try:
             self.config['hostlen'] = len(max(self.node_list, key=len))
@@ -513,48 +590,159 @@ this utility or remote systems that it connects to.
         self.log_debug('Able to collect local sos')
         return True
 
+    def _set_stage_limits(self):
+        '''Set how many nodes may be in each stage of collection at the same
+        time. Nodes move through the stages independently of each other, so
+        these are enforced per stage rather than by the size of the pool.
+        '''
+        threads = self.config['threads']
+        sos_runs = threads
+        if self.config['detach']:
+            # a detached sosreport does not hold a worker while it runs, so
+            # by default start it on every node at once
+            sos_runs = len(self.node_list) + 1
+        self.stage_limits = {
+            'connect': threading.BoundedSemaphore(self._get_max_connects()),
+            'sos': threading.BoundedSemaphore(
+                self.config['max_sos_runs'] or sos_runs),
+            'transfer': threading.BoundedSemaphore(
+                self.config['max_transfers'] or threads)
+        }
+
+    def _get_max_connects(self):
+        '''By default only half of the threads may be connecting to nodes at
+        once, so that connection storms to a large number of nodes are kept
+        down while the other threads are running and collecting sosreports'''
+        if self.config['max_connects']:
+            return self.config['max_connects']
+        return max(1, self.config['threads'] // 2)
+
+    def _get_pool_size(self):
+        '''The pool needs enough workers for the largest stage limit, since
+        a node holds a worker for the whole time it is in any stage'''
+        if self.config['detach']:
+            # except while a detached sosreport is running
+            return max(self.config['threads'], self.config['max_transfers'])
+        return max(self.config['threads'], self.config['max_sos_runs'],
+                   self.config['max_transfers'])
+
+    def _prescan_nodes(self, nodes):
+        '''Check that every node accepts connections on the SSH port before
+        we start connecting to them, so that nodes which are down do not each
+        hold a worker for the whole connection timeout. Returns the nodes that
+        were reachable.
+        '''
+        if self.config['transport'] == 'openssh':
+            # ~/.ssh/config may send the connection somewhere else entirely
+            self.log_debug('Skipping reachability scan for openssh transport')
+            return nodes
+        # nodes that are collected locally are not connected to
+        local = ['localhost', '127.0.0.1', self.config['hostname']]
+        port = self.config['ssh_port']
+        start = time.time()
+        self.unreachable = scan_nodes([n for n in nodes if n not in local],
+                                      port)
+        self.log_debug('Scanned %s nodes for reachability in %.2fs'
+                       % (len(nodes), time.time() - start))
+        for node in sorted(self.unreachable):
+            self.log_error('Unable to reach %s on port %s, it will not be '
+                           'collected: %s' % (node, port,
+                                              self.unreachable[node]))
+            self.manifest.missing(node, 'unreachable on port %s: %s'
+                                  % (port, self.unreachable[node]))
+        return [n for n in nodes if n not in self.unreachable]
+
     def _connect_to_node(self, node):
         '''Try to connect to the node, and if we can add to the client list to
-        run sosreport on
+        run sosreport on.
+
+        Returns the connected SosNode, or None if we could not connect
         '''
         try:
-            client = SosNode(node, self.config)
+            with self.stage_limits['connect']:
+                client = SosNode(node, self.config)
             if client.connected:
-                self.client_list.append(client)
-            else:
-                client.close_ssh_session()
+                with self.client_lock:
+                    self.client_list.append(client)
+                return client
+            client.close_ssh_session()
         except Exception:
             pass
+        return None
+
+    def _collect_node(self, node):
+        '''Connect to a node and collect a sosreport from it. This lets each
+        node start its sosreport as soon as it is connected, rather than
+        waiting for every other node to connect first.
+        '''
+        client = self._connect_to_node(node)
+        if client is None:
+            self.manifest.missing(node, 'could not connect')
+            return False
+        return self._collect(client)
 
     def collect(self):
         ''' For each node, start a collection thread and then tar all
         collected sosreports '''
         if self.master.connected:
             self.client_list.append(self.master)
-        self.console.info("\nConnecting to nodes...")
         filters = [self.master.address, self.master.hostname]
         nodes = [n for n in self.node_list if n not in filters]
+        if not self.config['no_prescan']:
+            nodes = self._prescan_nodes(nodes)
+        self._set_stage_limits()
+        if self.config['show_plan']:
+            self.show_plan(nodes)
+            return
 
-        try:
-            pool = ThreadPoolExecutor(self.config['threads'])
-            pool.map(self._connect_to_node, nodes, chunksize=1)
-            pool.shutdown(wait=True)
-
-            self.report_num = len(self.client_list)
-
-            self.console.info("\nBeginning collection of sosreports from %s "
-                              "nodes, collecting a maximum of %s "
-                              "concurrently\n"
-                              % (len(self.client_list), self.config['threads'])
-                              )
+        for client in self.client_list:
+            if not (client.local and self.config['no_local']):
+                self.manifest.pending(client.address)
+        for node in nodes:
+            self.manifest.pending(node)
+        if self.config['deadline']:
+            self.deadline_at = time.time() + self.config['deadline']
+
+        total = len(nodes) + len(self.client_list)
+        if self.config['detach'] or self.config['engine'] == 'asyncio':
+            concurrent = min(total, self.config['max_sos_runs'] or total)
+        else:
+            concurrent = self.config['max_sos_runs'] or self.config['threads']
+        if self.config['processes'] > 1:
+            concurrent = min(total, concurrent * self.config['processes'])
+        self.console.info("\nBeginning collection of sosreports from %s "
+                          "nodes, collecting a maximum of %s concurrently\n"
+                          % (total, concurrent)
+                          )
 
-            pool = ThreadPoolExecutor(self.config['threads'])
-            pool.map(self._collect, self.client_list, chunksize=1)
-            pool.shutdown(wait=True)
+        try:
+            if self.config['processes'] > 1 and nodes:
+                self._collect_sharded(nodes)
+            elif self.config['engine'] == 'asyncio':
+                self._collect_async(nodes)
+            else:
+                self._collect_threaded(nodes)
+            self.report_num += len(self.client_list)
+            self._save_host_keys()
         except KeyboardInterrupt:
             self.log_error('Exiting on user cancel\n')
+            # the exit handlers are skipped below, as they would wait on the
+            # workers, so close our connections and their sockets here
+            try:
+                self.close_all_connections()
+            except Exception:
+                pass
+            remove_control_dir()
+            self.stop_logging()
             os._exit(130)
 
+        missing = self.manifest.get_missing()
+        if missing:
+            self.log_info('\nSosreports were not collected from %s nodes:'
+                          % len(missing))
+            for node, reason in missing:
+                self.log_info('    %s: %s' % (node, reason))
+
         if hasattr(self.config['cluster'], 'run_extra_cmd'):
             self.console.info('Collecting additional data from master node...')
             f = self.config['cluster'].run_extra_cmd()
@@ -568,20 +756,337 @@ this utility or remote systems that it connects to.
             msg = 'No sosreports were collected, nothing to archive...'
             self._exit(msg, 1)
         self.close_all_connections()
+        self.stop_logging()
+
+    def show_plan(self, nodes):
+        '''Connect to every node and print the sosreport command that would
+        be run on each group of nodes, without running it'''
+        if self.config['processes'] > 1 or self.config['engine'] != 'threads':
+            self.log_info('Nodes are connected to using threads to show the '
+                          'plan, --processes and --engine are ignored')
+        self.console.info('\nConnecting to %s nodes to plan sosreport '
+                          'commands...\n' % len(nodes))
+        self.pool = ThreadPoolExecutor(self._get_pool_size())
+        clients = list(self.pool.map(self._connect_to_node, nodes))
+        self.pool.shutdown(wait=True)
+        self._save_host_keys()
+        unreachable = [n for n, c in zip(nodes, clients) if c is None]
+        for client in self.client_list:
+            if client.local and self.config['no_local']:
+                continue
+            client.finalize_sos_cmd()
+        plans = list(self.config['sos_planner'].plans.values())
+        self.console.info('The following sosreport commands would be run:')
+        for plan in plans:
+            self.console.info('\n\t%s' % plan.cmd.strip())
+            for node in sorted(plan.nodes):
+                self.console.info('\t\t%s' % node)
+        if unreachable:
+            self.console.info('\n\tCould not connect to:')
+            for node in sorted(unreachable):
+                self.console.info('\t\t%s' % node)
+        self.console.info('\n%s nodes in %s groups, %s could not be '
+                          'connected to'
+                          % (sum(len(p.nodes) for p in plans) +
+                             len(unreachable), len(plans), len(unreachable)))
+        self.close_all_connections()
+        self.stop_logging()
+        if self.config['tmp_dir_created']:
+            self.delete_tmp_dir()
+
+    def _collect_threaded(self, nodes):
+        '''Collect from every client and node using a pool of threads'''
+        self.pool = ThreadPoolExecutor(self._get_pool_size())
+        if self.config['detach']:
+            self.monitor = SosMonitor(self.pool, self.config['timeout'])
+        futures = set(self.pool.submit(self._collect, client)
+                      for client in self.client_list)
+        futures.update(self.pool.submit(self._collect_node, node)
+                       for node in nodes)
+        total = len(futures)
+        finished = 0
+        while futures:
+            done, futures = wait(futures, timeout=self._cutoff_wait(),
+                                 return_when=FIRST_COMPLETED)
+            finished += self._count_results(done, futures)
+            reason = self._collection_cutoff(finished, total)
+            if reason and futures:
+                self._cut_collection(reason, futures)
+                break
+        if self.monitor:
+            self.monitor.stop()
+        # nodes that did not stop when cancelled are not waited for
+        self.pool.shutdown(wait=not self.manifest.cutoff)
+
+    def _count_results(self, done, futures):
+        '''Count the results of the finished futures in done, returning how
+        many nodes are done with.
+
+        Results are only counted in the main thread, so that the count is not
+        raced by the workers. Nodes with a detached sosreport give back a
+        further future for the rest of their collection, which is added to
+        futures to be waited on in turn.
+        '''
+        finished = 0
+        for future in done:
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as err:
+                self.log_debug('Error during collection: %s' % err)
+                finished += 1
+                continue
+            if isinstance(result, Future):
+                futures.add(result)
+                continue
+            finished += 1
+            if result:
+                self.retrieved += 1
+        return finished
+
+    def _cutoff_wait(self):
+        '''Returns how long we may wait for nodes before --deadline is
+        reached, or None if there is no deadline'''
+        if self.deadline_at is None:
+            return None
+        return max(0, self.deadline_at - time.time())
+
+    def _collection_cutoff(self, finished, total):
+        '''Returns why collection should stop now that finished of total
+        nodes are done with, or None if it should carry on'''
+        if self.deadline_at is not None and time.time() >= self.deadline_at:
+            return 'deadline of %ss reached' % self.config['deadline']
+        quorum = self.config['quorum']
+        if quorum < 100 and finished * 100 >= total * quorum:
+            return 'quorum of %s%% reached' % quorum
+        return None
+
+    def _cut_collection(self, reason, futures):
+        '''Give up on every node still being collected from, so that the
+        archive can be made from the sosreports we already have.
+
+        Nodes that have not started yet are dropped, and the others are
+        cancelled all at once, since cancelling a node may mean running a
+        command on it. They are then given CANCEL_GRACE seconds to stop, so
+        that they are cleaned up where possible, and anything they left in the
+        tmp dir is removed.
+        '''
+        cancelled = set(self.manifest.cut(reason))
+        self.log_info('\nCollection stopped, %s. Cancelling collection from '
+                      'the remaining %s nodes' % (reason, len(cancelled)))
+        for future in futures:
+            future.cancel()
+        with self.client_lock:
+            clients = [c for c in self.client_list
+                       if c.address in cancelled]
+        if clients:
+            with ThreadPoolExecutor(len(clients)) as cancels:
+                list(cancels.map(lambda client: client.cancel(), clients))
+        grace = time.time() + CANCEL_GRACE
+        futures = set(f for f in futures if not f.cancelled())
+        while futures and time.time() < grace:
+            done, futures = wait(futures, timeout=grace - time.time(),
+                                 return_when=FIRST_COMPLETED)
+            self._count_results(done, futures)
+        if futures:
+            self.log_debug('%s nodes had not stopped %ss after being '
+                           'cancelled' % (len(futures), CANCEL_GRACE))
+        for client in clients:
+            self._discard_sosreport(client)
+
+    def _collect_async(self, nodes):
+        '''Collect from every client and node using the asyncio engine'''
+        from .aio import AsyncCollector
+        self.retrieved += AsyncCollector(self).run(nodes)
+
+    def _save_host_keys(self):
+        '''Add the keys of nodes we had not connected to before to
+        known_hosts, all at once now that we are done connecting'''
+        try:
+            saved = save_host_keys()
+            if saved:
+                self.log_debug('Added %s new host keys to known_hosts' % saved)
+        except Exception as err:
+            self.log_error('Unable to save new host keys: %s' % err)
+
+    def _collect_sharded(self, nodes):
+        '''Collect from nodes using --processes worker processes, and from
+        every client using this one'''
+        # save the keys learned so far, such as the master's, so that the
+        # workers do not each save them again
+        self._save_host_keys()
+        sharded = ShardedCollector(self, self.config['processes'])
+        connected, retrieved = sharded.run(nodes)
+        self.report_num += connected
+        self.retrieved += retrieved
 
     def _collect(self, client):
-        '''Runs sosreport on each node'''
-        if not client.local:
-            client.sosreport()
+        '''Runs sosreport on each node, returning True if the sosreport was
+        retrieved.
+
+        Generating the sosreport and transferring it are limited separately,
+        since they are bound by the nodes and by our own bandwidth
+        respectively. A transfer slot is only taken once the sosreport is done.
+        '''
+        if client.local and self.config['no_local']:
+            return False
+        if self.manifest.cutoff:
+            return False
+        if self.monitor:
+            return self._collect_detached(client)
+        try:
+            with self.stage_limits['sos']:
+                if self.manifest.cutoff:
+                    return False
+                generated = client.generate_sosreport()
+            if generated:
+                self._retrieve(client)
+            else:
+                self.manifest.missing(client.address,
+                                      'sosreport did not complete')
+        finally:
+            client.cleanup()
+            self._release_session(client)
+        return client.retrieved
+
+    def _retrieve(self, client):
+        with self.stage_limits['transfer']:
+            client.retrieved = client.retrieve_sosreport()
+        self._keep_sosreport(client)
+
+    def _keep_sosreport(self, client):
+        '''Add the sosreport retrieved from client to the archive and record
+        the node as collected. If the node was given up on while its
+        sosreport was being retrieved, it is removed again instead, so that
+        the archive matches the manifest.
+        '''
+        if not client.retrieved:
+            self.manifest.missing(client.address,
+                                  'sosreport could not be retrieved')
+        elif self.manifest.collected(client.address):
+            self._archive_sosreport(client)
         else:
-            if not self.config['no_local']:
-                client.sosreport()
-        if client.retrieved:
-            self.retrieved += 1
+            client.retrieved = False
+            self._discard_sosreport(client)
+
+    def _discard_sosreport(self, client):
+        '''Remove any sosreport of client from the tmp dir'''
+        if not client.archive:
+            return
+        path = os.path.join(self.config['tmp_dir'], client.archive)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as err:
+            self.log_debug('Could not remove %s: %s' % (path, err))
+
+    def _collect_detached(self, client):
+        '''Start sosreport on the node detached from its SSH session, and
+        hand it to the monitor to wait for. The worker is free as soon as
+        sosreport has started, and the rest of the collection is run on the
+        pool once it exits.
+
+        Returns a future for the result of the collection, or False if
+        sosreport could not be started.
+        '''
+        limit = self.stage_limits['sos']
+        limit.acquire()
+        if self.manifest.cutoff:
+            limit.release()
+            client.cleanup()
+            self._release_session(client)
+            return False
+        try:
+            started = client.start_sosreport()
+        except Exception:
+            started = False
+        if not started:
+            self.manifest.missing(client.address,
+                                  'sosreport could not be started')
+            limit.release()
+            client.cleanup()
+            self._release_session(client)
+            return False
+        result = Future()
+
+        def _exited(exited):
+            # runs on the monitor thread, so must not block
+            limit.release()
+            finish = self.pool.submit(self._finish_detached, client, exited)
+            finish.add_done_callback(
+                lambda f: result.set_result(not f.exception() and f.result())
+            )
+
+        self.monitor.watch(client).add_done_callback(_exited)
+        return result
+
+    def _finish_detached(self, client, exited):
+        '''Retrieve the sosreport from a node once its detached sosreport
+        has exited, as given by the future from the monitor'''
+        try:
+            try:
+                rc = exited.result()
+            except socket.timeout:
+                client.log_error('Timeout exceeded')
+                client.stop_sosreport()
+                self.manifest.missing(client.address, 'sosreport timed out')
+                return False
+            except Exception as err:
+                client.log_error('Error running sosreport: %s' % err)
+                self.manifest.missing(client.address,
+                                      'sosreport did not complete')
+                return False
+            if client.finish_sosreport(rc):
+                self._retrieve(client)
+            else:
+                self.manifest.missing(client.address,
+                                      'sosreport did not complete')
+        finally:
+            client.cleanup()
+            self._release_session(client)
+        return client.retrieved
+
+    def _release_session(self, client):
+        '''With --jit-sessions, close the session to a node as soon as we are
+        done with it, rather than holding it until the end of the run. The
+        master is kept, as the cluster profile may still need it.
+        '''
+        if self.config['jit_sessions'] and client is not self.master:
+            client.close_ssh_session()
+
+    def _get_archive_writer(self):
+        '''Returns the writer for the final archive, creating it if this is
+        the first file to be added to it'''
+        with self.archive_lock:
+            if self.archive_writer is None:
+                compression = self._get_archive_compression()
+                self.archive = self._get_archive_path(compression)
+                self.archive_start = time.time()
+                self.archive_writer = ArchiveWriter(
+                    self.archive, self.arc_name, compression,
+                    self.config['archive_workers'])
+        return self.archive_writer
+
+    def _archive_sosreport(self, client):
+        '''Queue a retrieved sosreport to be added to the final archive, and
+        removed from the tmp dir once it has been'''
+        if self.shard_results is not None:
+            # in a worker process, the parent adds it to the archive
+            self.shard_results.put(('archive', client.archive))
+            return
+        self._archive_file(client.archive)
+
+    def _archive_file(self, fname):
+        self._add_to_archive(self._get_archive_writer(),
+                             os.path.join(self.config['tmp_dir'], fname),
+                             fname, remove=True)
 
     def close_all_connections(self):
         '''Close all ssh sessions for nodes'''
         for client in self.client_list:
+            if not client.connected:
+                continue
             self.log_debug('Closing SSH connection to %s' % client.address)
             client.close_ssh_session()
 
@@ -598,19 +1103,38 @@ this utility or remote systems that it connects to.
             self.console.info('    %s' % self.archive)
 
     def create_sos_archive(self):
-        '''Creates a tar archive containing all collected sosreports'''
+        '''Finishes the tar archive containing all collected sosreports.
+
+        Sosreports are added to the archive as they are retrieved, so this
+        only needs to add what remains in the tmp dir, such as our logs.
+        '''
         try:
-            self.archive = self._get_archive_path()
-            with tarfile.open(self.archive, "w:gz") as tar:
-                for fname in os.listdir(self.config['tmp_dir']):
-                    arcname = fname
-                    if fname == self.logfile.name.split('/')[-1]:
-                        arcname = 'sos-collector.log'
-                    if fname == self.console_log_file.name.split('/')[-1]:
-                        arcname = 'ui.log'
-                    tar.add(os.path.join(self.config['tmp_dir'], fname),
-                            arcname=self.arc_name + '/' + arcname)
-                tar.close()
+            start = time.time()
+            if self.archive_writer:
+                self.archive_writer.wait()
+            # make sure our logs are complete on disk before archiving them
+            self.log_listener.flush()
+            self.manifest.write(os.path.join(self.config['tmp_dir'],
+                                             'manifest.json'))
+            members = os.listdir(self.config['tmp_dir'])
+            writer = self._get_archive_writer()
+            for fname in members:
+                arcname = fname
+                if fname == self.logfile.name.split('/')[-1]:
+                    arcname = 'sos-collector.log'
+                if fname == self.console_log_file.name.split('/')[-1]:
+                    arcname = 'ui.log'
+                self._add_to_archive(writer,
+                                     os.path.join(self.config['tmp_dir'],
+                                                  fname),
+                                     arcname)
+            writer.close()
+            self.logger.info('Archive finalized in %.2fs, %.2fs after the '
+                             'first sosreport was added. Used %s compression'
+                             ' with %s worker(s)'
+                             % (time.time() - start,
+                                time.time() - self.archive_start,
+                                writer.compression, writer.workers))
         except Exception as e:
             msg = 'Could not create archive: %s' % e
             self._exit(msg, 2)
@@ -13,20 +13,145 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import base64
 import fnmatch
-import inspect
 import logging
-import paramiko
+import os
 import re
 import shutil
+import signal
 import socket
 import subprocess
 import six
 import sys
+import threading
 import time
 
-from distutils.version import LooseVersion
+from concurrent.futures import Future
 from subprocess import Popen, PIPE
+from soscollector.planner import SosCmdPlanner
+from soscollector.transports import ProcessWatch, get_transport
+
+CHECKSUM_RE = re.compile(r'^(sha256|md5) ([0-9a-fA-F]+)', re.M)
+SANITIZE_RE = re.compile(
+    r'(?P<var>(pass|key|secret|PASS|KEY|SECRET).*?=)(?P<value>.*?\s)'
+)
+
+# Prefer the checksum that sos writes alongside the archive, and only hash the
+# archive on the node ourselves if there is not one
+CHECKSUM_SCRIPT = """\
+if [ -f %(path)s.sha256 ]; then
+    echo sha256 $(cat %(path)s.sha256)
+elif [ -f %(path)s.md5 ]; then
+    echo md5 $(cat %(path)s.md5)
+else
+    echo sha256 $(sha256sum %(path)s)
+fi
+"""
+
+# Gathers everything we need to know about a node in a single round trip. The
+# output of each step is preceeded by a marker line so that it can be split
+# back apart locally. The package list is filled in at runtime, as is the
+# sos info probe below unless it is shared between nodes.
+PROBE_MARKER = '@@sos-collector:'
+FACT_PROBE_SCRIPT = """\
+echo @@sos-collector:hostname
+hostname
+if [ -f /etc/redhat-release ]; then
+    relfile=/etc/redhat-release
+else
+    relfile=/etc/os-release
+fi
+echo @@sos-collector:release
+cat $relfile
+echo @@sos-collector:packages
+if command -v rpm >/dev/null; then
+    rpm -q --qf '%%{NAME} %%{VERSION}-%%{RELEASE}\\n' %(packages)s
+fi
+if ! grep -qi atomic $relfile; then
+%(sos_info)s
+fi
+echo @@sos-collector:end
+"""
+# Lists the plugins, options and presets of the installed sos. This loads
+# every sos plugin, so takes far longer than the rest of the fact probe
+SOS_INFO_SCRIPT = """\
+echo @@sos-collector:plugins
+/usr/sbin/sosreport -l
+echo @@sos-collector:presets
+/usr/sbin/sosreport --list-presets 2>/dev/null
+echo @@sos-collector:end
+"""
+
+# Gets the version-release of the installed sos package, in the same form as
+# the fact probe reports it, to check facts cached by an earlier run against
+SOS_PACKAGE_QUERY = "rpm -q --qf '%{VERSION}-%{RELEASE}\\n' sos"
+
+# Runs sosreport in a session of its own under nohup, so that it carries on if
+# our connection to the node is lost, recording its output and exit code in a
+# state directory. The state directory is left readable so that the wait below
+# does not need root.
+DETACH_SCRIPT = """\
+state=$(mktemp -d /var/tmp/sos-collector.XXXXXX) || exit 1
+chmod 755 $state
+cat > $state/run <<'@@SOS_COLLECTOR_EOF'
+(
+%(cmd)s
+) > $1/out 2>&1
+echo $? > $1/rc.tmp
+mv $1/rc.tmp $1/rc
+@@SOS_COLLECTOR_EOF
+setsid nohup sh $state/run $state </dev/null >/dev/null 2>&1 &
+echo $! > $state/pid
+echo @@sos-collector:state $state
+"""
+DETACH_STATE_RE = re.compile(r'@@sos-collector:state (\S+)')
+
+# Waits for a detached sosreport to exit, without holding anything open on our
+# side but the channel this runs on
+SOS_WAIT_SCRIPT = """\
+pid=$(cat %(state)s/pid)
+while [ ! -f %(state)s/rc ]; do
+    if [ ! -d /proc/$pid ] && [ ! -f %(state)s/rc ]; then
+        echo @@sos-collector:lost
+        exit 1
+    fi
+    sleep 2
+done
+echo @@sos-collector:rc $(cat %(state)s/rc)
+"""
+SOS_WAIT_RE = re.compile(r'@@sos-collector:(rc|lost) ?(\d*)')
+
+
+class SosInfoRegistry():
+    '''The plugins, options and presets listed by each version of sos.
+
+    These are the same on every node with the same sos package, so are only
+    probed for on the first of them, while any others wait for the result.
+    Entries are futures so that they can be waited on from either a thread
+    or the event loop.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def claim(self, key):
+        '''Returns the future for the sos info of key, and whether the caller
+        is to probe for it and publish() the result'''
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key], False
+            future = self.entries[key] = Future()
+            return future, True
+
+    def publish(self, key, future, info):
+        '''Hand the sos info for key to everyone waiting on it. If the probe
+        failed, info is None, and the next node with key may probe again'''
+        if info is None:
+            with self.lock:
+                del self.entries[key]
+        future.set_result(info)
 
 
 class SosNode():
@@ -37,14 +162,23 @@ class SosNode():
         self.hostname = None
         self.config = config
         self.sos_path = None
+        self.archive = None
+        self.sos_state = None
+        self.transport = None
         self.retrieved = False
+        self.verified = False
+        self.cancelled = False
+        self._local_proc = None
+        self._watch = None
+        self._watch_out = []
         self.host_facts = {'address': address}
         self.sos_info = {
             'version': None,
             'enabled': [],
             'disabled': [],
             'options': [],
-            'presets': []
+            'presets': [],
+            'shared': False
         }
         filt = ['localhost', '127.0.0.1', self.config['hostname']]
         self.logger = logging.getLogger('sos_collector')
@@ -54,10 +188,13 @@ class SosNode():
         else:
             self.connected = True
             self.local = True
-        if self.connected and load_facts:
-            self.get_hostname()
-            self.load_host_facts()
-            self._load_sos_info()
+        if self.connected and load_facts and not self.load_cached_facts():
+            if self.config['no_fact_probe'] or not self.probe_host_facts():
+                self.get_hostname()
+                self.load_host_facts()
+                self._load_sos_info()
+            else:
+                self.cache_facts()
 
     def _fmt_msg(self, msg):
         return '{:<{}} : {}'.format(self._hostname, self.config['hostlen'] + 1,
@@ -66,12 +203,7 @@ class SosNode():
     def file_exists(self, fname):
         '''Checks for the presence of fname on the remote node'''
         if not self.local:
-            sftp = self.client.open_sftp()
-            try:
-                sftp.stat(fname)
-                return True
-            except Exception:
-                return False
+            return self.transport.file_exists(fname)
         else:
             try:
                 os.stat(fname)
@@ -86,30 +218,40 @@ class SosNode():
     def _sanitize_log_msg(self, msg):
         '''Attempts to obfuscate sensitive information in log messages such as
         passwords'''
-        reg = r'(?P<var>(pass|key|secret|PASS|KEY|SECRET).*?=)(?P<value>.*?\s)'
-        return re.sub(reg, r'\g<var>****** ', msg)
+        return SANITIZE_RE.sub(r'\g<var>****** ', msg)
 
-    def log_info(self, msg):
+    # The log methods below accept optional args to be %-formatted into msg,
+    # so that callers on hot paths can avoid formatting messages that will
+    # not be logged. The caller's name is taken from its frame directly, as
+    # inspect.stack() would build context for every frame on the stack.
+
+    def log_info(self, msg, *args):
         '''Used to print and log info messages'''
-        caller = inspect.stack()[1][3]
-        lmsg = '[%s:%s] %s' % (self._hostname, caller, msg)
-        self.logger.info(lmsg)
+        if args:
+            msg = msg % args
+        caller = sys._getframe(1).f_code.co_name
+        self.logger.info('[%s:%s] %s', self._hostname, caller, msg)
         self.console.info(self._fmt_msg(msg))
 
-    def log_error(self, msg):
+    def log_error(self, msg, *args):
         '''Used to print and log error messages'''
-        caller = inspect.stack()[1][3]
-        lmsg = '[%s:%s] %s' % (self._hostname, caller, msg)
-        self.logger.error(lmsg)
+        if args:
+            msg = msg % args
+        caller = sys._getframe(1).f_code.co_name
+        self.logger.error('[%s:%s] %s', self._hostname, caller, msg)
         self.console.error(self._fmt_msg(msg))
 
-    def log_debug(self, msg):
+    def log_debug(self, msg, *args):
         '''Used to print and log debug messages'''
-        msg = self._sanitize_log_msg(msg)
-        caller = inspect.stack()[1][3]
-        msg = '[%s:%s] %s' % (self._hostname, caller, msg)
+        verbose = self.config['verbose']
+        if not verbose and not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if args:
+            msg = msg % args
+        msg = '[%s:%s] %s' % (self._hostname, sys._getframe(1).f_code.co_name,
+                              self._sanitize_log_msg(msg))
         self.logger.debug(msg)
-        if self.config['verbose']:
+        if verbose:
             self.console.debug(msg)
 
     def get_hostname(self):
@@ -172,10 +314,13 @@ class SosNode():
         cmd = prefix + 'sosreport --list-presets'
         res = self.run_command(cmd)
         if res['status'] == 0:
-            for line in res['stdout'].splitlines():
-                if line.strip().startswith('name:'):
-                    pname = line.split('name:')[1].strip()
-                    self.sos_info['presets'].append(pname)
+            self._parse_sos_presets(res['stdout'])
+
+    def _parse_sos_presets(self, output):
+        for line in output.splitlines():
+            if line.strip().startswith('name:'):
+                pname = line.split('name:')[1].strip()
+                self.sos_info['presets'].append(pname)
 
     def _load_sos_plugins(self, sosinfo):
         ENABLED = 'The following plugins are currently enabled:'
@@ -212,50 +357,85 @@ class SosNode():
         given ver. This means that if the installed version is greater than
         ver, this will still return True
         '''
+        # distutils takes longer to import than the rest of sos-collector,
+        # so is left until a version is first checked
+        from distutils.version import LooseVersion
         return LooseVersion(self.sos_info['version']) >= ver
 
     def is_installed(self, pkg):
         '''Checks if a given package is installed on the node'''
+        pkgs = self.host_facts.get('packages', {})
+        if pkg in pkgs:
+            return pkgs[pkg] is not None
         cmd = self.host_facts['package_manager']['query'] + pkg
         res = self.run_command(cmd)
         if res['status'] == 0:
             return True
         return False
 
-    def run_command(self, cmd, timeout=180, get_pty=False, need_root=False):
-        '''Runs a given cmd, either via the SSH session or locally'''
+    def query_packages(self, pkgs):
+        '''Query for every package in pkgs that is not already known with a
+        single command, so that checking each of them with is_installed() does
+        not need a command of its own'''
+        known = self.host_facts.setdefault('packages', {})
+        pkgs = sorted(set(p for p in pkgs if p and p not in known))
+        pkgmgr = self.host_facts.get('package_manager')
+        if not pkgs or not pkgmgr or pkgmgr['name'] != 'rpm':
+            return
+        cmd = "%s--qf '%%{NAME} %%{VERSION}-%%{RELEASE}\\n' %s" % (
+            pkgmgr['query'], ' '.join(pkgs))
+        try:
+            res = self.run_command(cmd)
+        except Exception as err:
+            self.log_debug('Package query failed: %s' % err)
+            return
+        # rpm exits with the number of packages not installed, so only trust
+        # output that accounts for all of them
+        lines = (res['stdout'] or '').strip().splitlines()
+        if len(lines) < len(pkgs):
+            self.log_debug('Package query returned %s lines for %s packages'
+                           % (len(lines), len(pkgs)))
+            return
+        known.update(self._parse_pkg_query('\n'.join(lines), pkgs))
+
+    def _prep_command(self, cmd, get_pty, need_root):
+        '''Returns the final form of cmd, whether it needs a pty, and the
+        password to send if it prompts for one'''
         if cmd.startswith('sosreport'):
             cmd = cmd.replace('sosreport', '/usr/sbin/sosreport')
             need_root = True
         if need_root:
             get_pty = True
             cmd = self._format_cmd(cmd)
-        self.log_debug('Running command %s' % cmd)
+        self.log_debug('Running command %s', cmd)
         if 'atomic' in cmd:
             get_pty = True
+        password = None
+        if need_root:
+            if self.config['become_root']:
+                password = self.config['root_password']
+            elif self.config['sudo_pw']:
+                password = self.config['sudo_pw']
+        return cmd, get_pty, password
+
+    def run_command(self, cmd, timeout=180, get_pty=False, need_root=False):
+        '''Runs a given cmd, either via the SSH session or locally'''
+        cmd, get_pty, password = self._prep_command(cmd, get_pty, need_root)
         if not self.local:
-            now = time.time()
-            sin, sout, serr = self.client.exec_command(cmd, timeout=timeout,
-                                                       get_pty=get_pty)
-            while time.time() < now + timeout:
-                if not sout.channel.exit_status_ready():
-                    time.sleep(0.1)
-                    if self.config['become_root'] and need_root:
-                        sin.write(self.config['root_password'] + '\n')
-                        sin.flush()
-                        need_root = False
-                    if self.config['sudo_pw'] and need_root:
-                        sin.write(self.config['sudo_pw'] + '\n')
-                        sin.flush()
-                        need_root = False
-                if sout.channel.exit_status_ready():
-                    rc = sout.channel.recv_exit_status()
-                    return self._fmt_output(sout, serr, rc)
-            else:
-                raise socket.timeout
+            return self.transport.run_command(cmd, timeout, get_pty=get_pty,
+                                              password=password)
         else:
-            proc = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = proc.communicate()
+            # run in a process group of its own, and keep the process, so
+            # that cancel() can stop a local sosreport and everything it runs
+            proc = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                         preexec_fn=os.setsid)
+            self._local_proc = proc
+            try:
+                stdout, stderr = proc.communicate()
+            finally:
+                self._local_proc = None
+            stdout = stdout.decode('utf-8', 'replace')
+            stderr = stderr.decode('utf-8', 'replace')
             if self.config['become_root']:
                 proc.communicate(input=self.config['root_password'] + '\n')
             if self.config['need_sudo']:
@@ -269,80 +449,310 @@ class SosNode():
 
     def sosreport(self):
         '''Run a sosreport on the node, then collect it'''
+        if self.generate_sosreport():
+            try:
+                self.retrieved = self.retrieve_sosreport()
+            except Exception:
+                pass
+        self.cleanup()
+
+    def generate_sosreport(self):
+        '''Run sosreport on the node and determine the path of the archive it
+        created. Returns True if there is an archive to retrieve.
+        '''
         self.finalize_sos_cmd()
-        self.log_debug('Final sos command set to %s' % self.sos_cmd)
+        self.log_debug('Final sos command set to %s', self.sos_cmd)
         try:
             path = self.execute_sos_command()
             if path:
                 self.finalize_sos_path(path)
             else:
                 self.log_error('Unable to determine path of sos archive')
-            if self.sos_path:
-                self.retrieved = self.retrieve_sosreport()
         except Exception:
             pass
-        self.cleanup()
+        return self.sos_path is not None
 
     def open_ssh_session(self):
-        '''Create the persistent ssh session we use on the node'''
+        '''Create the persistent ssh session we use on the node, using the
+        transport selected by --transport'''
+        if self.transport is None:
+            self.transport = get_transport(self.config['transport'])(self)
+        self.transport.connect()
+        self.log_debug('%s successfully connected' % self._hostname)
+        return True
+
+    def reconnect(self):
+        '''Close and reopen the SSH session to the node, returning True if
+        the node is connected again'''
+        if self.cancelled:
+            return False
+        self.log_debug('Reconnecting to %s' % self.address)
+        self.close_ssh_session()
         try:
-            msg = ''
-            self.client = paramiko.SSHClient()
-            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.client.load_system_host_keys()
-            if not self.config['password']:
-                self.log_debug(
-                    'Opening passwordless session to %s' % self.address)
-                self.client.connect(self.address,
-                                    username=self.config['ssh_user'],
-                                    timeout=15)
-            else:
-                self.log_debug(
-                    'Opening session to %s with password' % self.address)
-                self.client.connect(self.address,
-                                    username=self.config['ssh_user'],
-                                    password=self.config['password'],
-                                    timeout=15)
-            self.log_debug('%s successfully connected' % self._hostname)
-            return True
-        except paramiko.AuthenticationException:
-            if not self.config['password']:
-                self.log_error('Authentication failed. SSH keys installed?')
-            else:
-                self.log_error('Authentication failed. Incorrect password.')
-        except paramiko.BadAuthenticationType:
-            self.log_error('Bad authentication type. The node rejected the '
-                           'authentication attempt.')
-        except paramiko.BadHostKeyException:
-            self.log_error('Provided key was rejected by remote SSH client.'
-                           ' Check ~/.ssh/known_hosts.')
-        except socket.gaierror as err:
-            if err.errno == -2:
-                self.log_error('Provided hostname did not resolve.')
-            else:
-                self.log_error('Socket error trying to connect: %s' % err)
-        except Exception as e:
-            self.log_error('Exception caught while trying to connect: %s' % e)
-        raise
+            self.connected = self.open_ssh_session()
+        except Exception:
+            self.connected = False
+        return self.connected
 
     def close_ssh_session(self):
         '''Handle closing the SSH session'''
         if self.local:
             return True
         try:
-            self.client.close()
+            self.transport.disconnect()
             self.connected = False
             return True
         except Exception as e:
             self.log_error('Error closing SSH session: %s' % e)
             return False
 
+    def close_inherited_session(self):
+        '''Close the session inherited by a forked worker process, which the
+        parent is still using, and treat the node as disconnected here'''
+        if self.local or not self.transport:
+            return
+        self.transport.close_inherited()
+        self.connected = False
+
     def load_host_facts(self):
         '''Obtain information about the node which can be referneced by
         clusters to change the sosreport command'''
         self.get_release()
         self.set_package_manager()
-        self.log_debug('Facts found to be %s' % self.host_facts)
+        self.log_debug('Facts found to be %s', self.host_facts)
+
+    def probe_host_facts(self):
+        '''Load the host facts and sos information for the node using a single
+        composite command, rather than a separate command for each fact.
+
+        Returns True if the facts were loaded, or False if the probe did not
+        complete and the facts need to be loaded individually.
+        '''
+        pkgs = self._probe_packages()
+        try:
+            res = self.run_command(self._fact_probe_script(pkgs),
+                                   need_root=self._fact_probe_need_root())
+        except Exception as err:
+            self.log_debug('Fact probe failed: %s' % err)
+            return False
+        if not self._load_fact_probe(res, pkgs):
+            return False
+        if self.host_facts['atomic'] and self.connected:
+            # sos is run from a container on Atomic Hosts, so the probe cannot
+            # query it directly
+            self._load_sos_info()
+        elif self.connected and self.config['sos_info_registry']:
+            self._load_shared_sos_info()
+        return True
+
+    def _fact_probe_script(self, pkgs):
+        '''Returns the fact probe command for the node. The sos info is only
+        probed for along with the other facts if it is not shared'''
+        sos_info = ''
+        if not self.config['sos_info_registry']:
+            end = 'echo %send\n' % PROBE_MARKER
+            sos_info = SOS_INFO_SCRIPT.replace(end, '')
+        script = FACT_PROBE_SCRIPT % {'packages': ' '.join(pkgs),
+                                      'sos_info': sos_info.strip() or ':'}
+        return self._fmt_script_cmd(script)
+
+    def _fact_probe_need_root(self):
+        '''Only listing the sos plugins needs root, so the fact probe is run
+        as the ssh user unless the sos info is probed for along with it'''
+        return not self.config['sos_info_registry']
+
+    def _sos_info_key(self):
+        return self.host_facts['packages']['sos']
+
+    def _load_shared_sos_info(self):
+        '''Load the sos info for the node from the registry, probing for it
+        only if no other node with the same sos package has'''
+        registry = self.config['sos_info_registry']
+        key = self._sos_info_key()
+        future, owner = registry.claim(key)
+        if owner:
+            info = None
+            try:
+                info = self._probe_sos_info()
+            finally:
+                registry.publish(key, future, info)
+            return
+        info = future.result()
+        if info is None:
+            self._probe_sos_info()
+        else:
+            self._set_shared_sos_info(info)
+
+    def _probe_sos_info(self):
+        '''Probe the node for its sos plugins, options and presets, returning
+        them, or None if the probe did not complete'''
+        try:
+            res = self.run_command(self._fmt_script_cmd(SOS_INFO_SCRIPT),
+                                   need_root=True)
+        except Exception as err:
+            self.log_debug('sos info probe failed: %s' % err)
+            return None
+        return self._load_sos_info_probe(res)
+
+    def _load_sos_info_probe(self, res):
+        probe = self._parse_fact_probe(res['stdout'] or '')
+        if 'end' not in probe:
+            self.log_debug('sos info probe did not complete, rc %s'
+                           % res['status'])
+            return None
+        self._load_sos_plugins(probe['plugins'])
+        if self.check_sos_version('3.6'):
+            self._parse_sos_presets(probe['presets'])
+        return dict((k, v) for k, v in self.sos_info.items()
+                    if k not in ('version', 'shared'))
+
+    def _set_shared_sos_info(self, info):
+        for key, val in info.items():
+            self.sos_info[key] = list(val)
+        self.sos_info['shared'] = True
+        self.log_debug('Using sos info probed from another node with sos %s'
+                       % self._sos_info_key())
+
+    def _host_key_fingerprint(self):
+        if self.transport is None:
+            return None
+        return self.transport.host_key_fingerprint()
+
+    def _fact_cache_key(self):
+        return '%s:%s %s' % (self.address, self.config['ssh_port'],
+                             self._host_key_fingerprint() or '')
+
+    def _get_cached_facts(self):
+        '''Returns the facts cached for the node by an earlier run, if there
+        are any that may be used'''
+        cache = self.config['fact_cache']
+        if cache is None or self.config['refresh_facts']:
+            return None
+        return cache.get(self._fact_cache_key())
+
+    def load_cached_facts(self):
+        '''Load the facts cached for the node by an earlier run, if the
+        installed sos package has not changed since. Returns True if the
+        facts were loaded, in which case the node need not be probed.
+        '''
+        entry = self._get_cached_facts()
+        if entry is None:
+            return False
+        try:
+            res = self.run_command(SOS_PACKAGE_QUERY)
+        except Exception as err:
+            self.log_debug('Could not check cached facts: %s' % err)
+            return False
+        return self._load_cached_facts(entry, res)
+
+    def _load_cached_facts(self, entry, res):
+        lines = (res['stdout'] or '').splitlines()
+        sos = lines[-1].strip() if res['status'] == 0 and lines else None
+        if sos != entry['sos_package']:
+            self.log_debug('sos package changed from %s to %s since facts '
+                           'were cached' % (entry['sos_package'], sos))
+            return False
+        self.hostname = entry['hostname']
+        self.host_facts.update(entry['host_facts'])
+        self._set_release(self.host_facts['release'])
+        self.sos_info.update(entry['sos_info'])
+        self.log_debug('Loaded facts cached %d minutes ago: %s'
+                       % ((time.time() - entry['time']) / 60,
+                          self.host_facts))
+        return True
+
+    def cache_facts(self):
+        '''Cache the facts loaded by the fact probe for later runs. Atomic
+        Hosts are not cached, as their sos comes from a container image'''
+        cache = self.config['fact_cache']
+        sos = self.host_facts.get('packages', {}).get('sos')
+        if cache is None or not sos or not self.connected:
+            return
+        if self.host_facts['atomic']:
+            return
+        # only the sos package is kept, since it is checked before the cache
+        # is used. Whether the cluster packages are installed may change at
+        # any time, so they are queried afresh
+        host_facts = dict(self.host_facts, packages={'sos': sos})
+        entry = {
+            'hostname': self.hostname,
+            'host_facts': host_facts,
+            'sos_info': self.sos_info,
+            'sos_package': sos
+        }
+        if not cache.put(self._fact_cache_key(), entry):
+            self.log_debug('Unable to cache facts in %s' % cache.path)
+
+    def _probe_packages(self):
+        return ['sos'] + [p for p in self.config['probe_packages']
+                          if p != 'sos']
+
+    def _load_fact_probe(self, res, pkgs):
+        '''Load the facts from the output of the fact probe. Returns False if
+        the probe did not complete'''
+        probe = self._parse_fact_probe(res['stdout'] or '')
+        if 'end' not in probe:
+            self.log_debug('Fact probe did not complete, rc %s. Loading facts '
+                           'individually' % res['status'])
+            return False
+
+        self.hostname = probe['hostname'].strip()
+        self.log_debug('Hostname set to %s' % self.hostname)
+        self.host_facts['release'] = 'Unknown'
+        self.host_facts['atomic'] = False
+        self._set_release(probe['release'])
+        self.set_package_manager()
+        if self.host_facts['package_manager']:
+            self.host_facts['packages'] = self._parse_pkg_query(
+                probe['packages'], pkgs)
+        self.log_debug('Facts found to be %s', self.host_facts)
+
+        if self.host_facts['atomic']:
+            return True
+        sosver = self.host_facts.get('packages', {}).get('sos')
+        if not sosver:
+            self.log_error('sos is not installed on this node')
+            self.connected = False
+            return True
+        self.sos_info['version'] = sosver.split('-')[0]
+        self.log_debug('sos version is %s' % self.sos_info['version'])
+        if 'plugins' in probe:
+            self._load_sos_plugins(probe['plugins'])
+            if self.check_sos_version('3.6'):
+                self._parse_sos_presets(probe['presets'])
+        return True
+
+    def _fmt_script_cmd(self, script):
+        '''Wrap a shell script into a single command that can safely be
+        passed through sudo or su without worrying about quoting'''
+        enc = base64.b64encode(script.encode('utf-8')).decode('ascii')
+        return 'sh -c "echo %s | base64 -d | sh"' % enc
+
+    def _parse_fact_probe(self, output):
+        '''Split the output of the fact probe into its sections'''
+        sections = {}
+        section = None
+        for line in output.replace('\r\n', '\n').splitlines(True):
+            if line.startswith(PROBE_MARKER):
+                section = line[len(PROBE_MARKER):].strip()
+                sections[section] = ''
+            elif section:
+                sections[section] += line
+        for sect in ['hostname', 'release', 'packages']:
+            sections.setdefault(sect, '')
+        if 'plugins' in sections:
+            sections.setdefault('presets', '')
+        return sections
+
+    def _parse_pkg_query(self, output, pkgs):
+        '''Parse the package query from the fact probe into a dict of package
+        names and their version-release, which is None if not installed'''
+        installed = dict((p, None) for p in pkgs)
+        for line in output.splitlines():
+            pkg = line.split()
+            if len(pkg) == 2 and pkg[0] in installed:
+                installed[pkg[0]] = pkg[1]
+        return installed
 
     def set_sos_prefix(self):
         '''Sets a prefix to any sos related commands run on the node.
@@ -370,137 +780,43 @@ class SosNode():
             else:
                 relfile = '/etc/os-release'
             res = self.run_command('cat ' + relfile)
-            if len(res['stdout'].splitlines()) > 2:
-                for line in res['stdout'].splitlines():
-                    if line.startswith('NAME'):
-                        release = line.split('=')[1].lower().strip('"')
-            else:
-                release = res['stdout'].lower()
-            self.host_facts['release'] = release
-            rh = ['fedora', 'centos', 'red hat']
-            if any(rel in release for rel in rh):
-                self.host_facts['distro'] = 'Red Hat'
-                self.config['image'] = ('registry.access.redhat.com/rhel7/'
-                                        'support-tools ')
-            self.host_facts['atomic'] = 'atomic' in release
+            self._set_release(res['stdout'])
         except Exception as e:
             self.log_error(e)
 
+    def _set_release(self, relinfo):
+        '''Set the release related host facts from the content of the node's
+        release file'''
+        release = 'Unknown'
+        if len(relinfo.splitlines()) > 2:
+            for line in relinfo.splitlines():
+                if line.startswith('NAME'):
+                    release = line.split('=')[1].lower().strip('"')
+        else:
+            release = relinfo.lower()
+        self.host_facts['release'] = release
+        rh = ['fedora', 'centos', 'red hat']
+        if any(rel in release for rel in rh):
+            self.host_facts['distro'] = 'Red Hat'
+            self.config['image'] = ('registry.access.redhat.com/rhel7/'
+                                    'support-tools ')
+        self.host_facts['atomic'] = 'atomic' in release
+
     def set_package_manager(self):
         '''Based on the distribution of the node, set the package manager to
         use for checking system installations'''
         self.host_facts['package_manager'] = None
-        if self.host_facts['distro'] == 'Red Hat':
+        if self.host_facts.get('distro') == 'Red Hat':
             self.host_facts['package_manager'] = {'name': 'rpm',
                                                   'query': 'rpm -q '
                                                   }
 
-    def _preset_exists(self, preset):
-        '''Verifies if the given preset exists on the node'''
-        return preset in self.sos_info['presets']
-
-    def _plugin_exists(self, plugin):
-        '''Verifies if the given plugin exists on the node'''
-        return any(plugin in s for s in [self.sos_info['enabled'],
-                                         self.sos_info['disabled']])
-
-    def _check_enabled(self, plugin):
-        '''Checks to see if the plugin is default enabled on node'''
-        return plugin in self.sos_info['enabled']
-
-    def _check_disabled(self, plugin):
-        '''Checks to see if the plugin is default disabled on node'''
-        return plugin in self.sos_info['disabled']
-
-    def _plugin_option_exists(self, opt):
-        '''Attempts to verify that the given option is available on the node.
-        Note that we only get available options for enabled plugins, so if a
-        plugin has been force-enabled we cannot validate if the plugin option
-        is correct or not'''
-        plug = opt.split('.')[0]
-        if not self._plugin_exists(plug):
-            return False
-        if (self._check_disabled(plug) and
-                plug not in self.config['enable_plugins']):
-            return False
-        if self._check_enabled(plug):
-            return opt in self.sos_info['options']
-        # plugin exists, but is normally disabled. Assume user knows option is
-        # valid when enabling the plugin
-        return True
-
-    def _fmt_sos_opt_list(self, opts):
-        '''Returns a comma delimited list for sos plugins that are confirmed
-        to exist on the node'''
-        return ','.join(o for o in opts if self._plugin_exists(o))
-
     def finalize_sos_cmd(self):
         '''Use host facts and compare to the cluster type to modify the sos
-        command if needed'''
-        self.sos_cmd = self.config['sos_cmd']
-
-        prefix = self.set_sos_prefix()
-        if prefix:
-            self.sos_cmd = prefix + self.sos_cmd
-
-        if self.config['sos_opt_line']:
-            self.sos_cmd += self.config['sos_opt_line']
-            return True
-
-        label = self.determine_sos_label()
-        if label:
-            self.sos_cmd = ' %s %s' % (self.sos_cmd, label)
-
-        if self.config['only_plugins']:
-            plugs = [o for o in self.config['only_plugins']
-                     if self._plugin_exists(o)]
-            if len(plugs) != len(self.config['only_plugins']):
-                not_only = list(set(self.config['only_plugins']) - set(plugs))
-                self.log_debug('Requested plugins %s were requested to be '
-                               'enabled but do not exist' % not_only)
-            only = self._fmt_sos_opt_list(self.config['only_plugins'])
-            if only:
-                self.sos_cmd += ' --only-plugins=%s' % only
-            return True
-
-        if self.config['skip_plugins']:
-            # only run skip-plugins for plugins that are enabled
-            skip = [o for o in self.config['skip_plugins']
-                    if self._check_enabled(o)]
-            if len(skip) != len(self.config['skip_plugins']):
-                not_skip = list(set(self.config['skip_plugins']) - set(skip))
-                self.log_debug('Requested to skip plugins %s, but plugins are '
-                               'already not enabled' % not_skip)
-            skipln = self._fmt_sos_opt_list(skip)
-            if skipln:
-                self.sos_cmd += ' --skip-plugins=%s' % skipln
-
-        if self.config['enable_plugins']:
-            # only run enable for plugins that are disabled
-            opts = [o for o in self.config['enable_plugins']
-                    if o not in self.config['skip_plugins']
-                    and self._check_disabled(o) and self._plugin_exists(o)]
-            if len(opts) != len(self.config['enable_plugins']):
-                not_on = list(set(self.config['enable_plugins']) - set(opts))
-                self.log_debug('Requested to enable plugins %s, but plugins '
-                               'are already enabled or do not exist' % not_on)
-            enable = self._fmt_sos_opt_list(opts)
-            if enable:
-                self.sos_cmd += ' --enable-plugins=%s' % enable
-
-        if self.config['plugin_options']:
-            opts = [o for o in self.config['plugin_options']
-                    if self._plugin_exists(o.split('.')[0])
-                    and self._plugin_option_exists(o.split('=')[0])]
-            if opts:
-                self.sos_cmd += ' -k %s' % ','.join(o for o in opts)
-
-        if self.config['preset']:
-            if self._preset_exists(self.config['preset']):
-                self.sos_cmd += ' --preset=%s' % self.config['preset']
-            else:
-                self.log_debug('Requested to enable preset %s but preset does '
-                               'not exist on node' % self.config['preset'])
+        command if needed. Nodes with the same sos and label share a plan
+        for the command, which is only worked out once'''
+        planner = self.config['sos_planner'] or SosCmdPlanner(self.config)
+        self.sos_cmd = planner.plan(self).cmd
 
     def determine_sos_label(self):
         '''Determine what, if any, label should be added to the sosreport'''
@@ -550,21 +866,10 @@ class SosNode():
         '''Run sosreport and capture the resulting file path'''
         self.log_info("Generating sosreport...")
         try:
-            path = False
             res = self.run_command(self.sos_cmd,
                                    timeout=self.config['timeout'],
                                    get_pty=True, need_root=True)
-            if res['status'] == 0:
-                for line in res['stdout'].splitlines():
-                    if fnmatch.fnmatch(line, '*sosreport-*tar*'):
-                        path = line.strip()
-            else:
-                err = self.determine_sos_error(res['status'], res['stdout'])
-                self.log_debug("Error running sosreport. rc = %s msg = %s"
-                               % (res['status'], res['stdout'] or
-                                  res['stderr']))
-                raise Exception(err)
-            return path
+            return self._get_sos_path(res)
         except socket.timeout:
             self.log_error('Timeout exceeded')
             raise
@@ -572,8 +877,120 @@ class SosNode():
             self.log_error('Error running sosreport: %s' % e)
             raise
 
+    def _get_sos_path(self, res):
+        '''Find the path of the archive sosreport created in its output, or
+        raise an Exception if sosreport failed'''
+        path = False
+        if res['status'] == 0:
+            for line in res['stdout'].splitlines():
+                if fnmatch.fnmatch(line, '*sosreport-*tar*'):
+                    path = line.strip()
+        else:
+            err = self.determine_sos_error(res['status'], res['stdout'])
+            self.log_debug("Error running sosreport. rc = %s msg = %s"
+                           % (res['status'], res['stdout'] or
+                              res['stderr']))
+            raise Exception(err)
+        return path
+
+    def start_sosreport(self):
+        '''Start sosreport on the node detached from our session, so that we
+        do not need to hold a connection or a thread for the node while it
+        runs. Returns True if sosreport was started.
+        '''
+        self.finalize_sos_cmd()
+        self.log_debug('Final sos command set to %s', self.sos_cmd)
+        self.log_info('Generating sosreport...')
+        cmd = self.sos_cmd.strip()
+        if cmd.startswith('sosreport'):
+            cmd = cmd.replace('sosreport', '/usr/sbin/sosreport', 1)
+        script = self._fmt_script_cmd(DETACH_SCRIPT % {'cmd': cmd})
+        try:
+            res = self.run_command(script, timeout=60, need_root=True)
+            match = DETACH_STATE_RE.search(res['stdout'] or '')
+            if not match:
+                raise Exception(res['stderr'] or res['stdout'] or
+                                'no state directory created')
+            self.sos_state = match.group(1)
+            self.log_debug('Started detached sosreport, state kept in %s',
+                           self.sos_state)
+            return True
+        except Exception as err:
+            self.log_error('Error starting sosreport: %s' % err)
+            return False
+
+    def watch_sosreport(self):
+        '''Start waiting for the detached sosreport to exit. Returns an
+        object whose fileno() becomes readable when there is something for
+        read_sos_watch() to read.
+        '''
+        cmd = self._fmt_script_cmd(SOS_WAIT_SCRIPT % {'state': self.sos_state})
+        self._watch_out = []
+        if self.local:
+            self._watch = ProcessWatch(Popen(cmd, shell=True, stdout=PIPE))
+        else:
+            self._watch = self.transport.start_command(cmd)
+        return self._watch
+
+    def read_sos_watch(self):
+        '''Read what the wait started by watch_sosreport() has written.
+
+        Returns the exit code of sosreport once it has exited, or None if it is
+        still running. If the wait ended without a result, as it does when
+        the connection to the node is lost, EOFError is raised and the wait
+        may be started again once reconnected.
+        '''
+        data, done = self._watch.read()
+        self._watch_out.append(data)
+        if not done:
+            return None
+        self._watch.close()
+        self._watch = None
+        output = b''.join(self._watch_out).decode('utf-8', 'replace')
+        match = SOS_WAIT_RE.search(output)
+        if not match:
+            raise EOFError('Lost connection while waiting for sosreport')
+        if match.group(1) == 'lost':
+            raise Exception('sosreport exited without recording an exit code')
+        return int(match.group(2))
+
+    def finish_sosreport(self, rc):
+        '''Determine the path of the archive created by a detached sosreport
+        that exited with rc. Returns True if there is an archive to retrieve.
+        '''
+        try:
+            res = self.run_command('cat %s/out' % self.sos_state, timeout=60)
+            res['status'] = rc
+            path = self._get_sos_path(res)
+            if path:
+                self.finalize_sos_path(path)
+            else:
+                self.log_error('Unable to determine path of sos archive')
+        except Exception as err:
+            self.log_error('Error running sosreport: %s' % err)
+        return self.sos_path is not None
+
+    def stop_sosreport(self):
+        '''Kill a detached sosreport, along with anything it started'''
+        if self._watch:
+            self._watch.close()
+            self._watch = None
+        self.kill_sosreport()
+
+    def kill_sosreport(self):
+        '''Kill a detached sosreport without touching our wait on it, which
+        then ends as it does when sosreport exits by itself'''
+        try:
+            self.run_command('kill -TERM -$(cat %s/pid)' % self.sos_state,
+                             timeout=30, need_root=True)
+        except Exception as err:
+            self.log_error('Failed to stop sosreport: %s' % err)
+
     def retrieve_sosreport(self):
         '''Collect the sosreport archive from the node'''
+        if self.cancelled:
+            # the tmp dir may already be gone
+            return False
         if self.sos_path:
             if self.config['need_sudo'] or self.config['become_root']:
                 try:
@@ -586,13 +1003,17 @@ class SosNode():
             try:
                 dest = self.config['tmp_dir'] + '/' + self.archive
                 if not self.local:
-                    sftp = self.client.open_sftp()
-                    sftp.get(self.sos_path, dest)
-                    sftp.close()
+                    checksum = self.get_transfer_checksum(self.sos_path)
+                    xfer = self.retrieve_file(self.sos_path, dest, checksum)
+                    self.verified = checksum is not None
+                    self.log_info('Successfully collected sosreport '
+                                  '(%.1f MB at %.1f MB/s)'
+                                  % (xfer.size / 1024.0 / 1024, xfer.rate))
                 else:
                     shutil.move(self.sos_path, dest)
+                    self.verified = True
+                    self.log_info('Successfully collected sosreport')
                 self.retrieved = True
-                self.log_info('Successfully collected sosreport')
                 return True
             except Exception as err:
                 msg = 'Failed to retrieve sosreport from %s, error: %s'
@@ -616,17 +1037,73 @@ class SosNode():
         if self.sos_path is None:
             return
         try:
-            cmd = "rm -f %s" % self.sos_path
+            cmd = "rm -f %s %s.sha256 %s.md5" % ((self.sos_path,) * 3)
             res = self.run_command(cmd)
         except Exception as e:
             self.log_error('Failed to remove sosreport on host: %s' % e)
 
+    def cancel(self):
+        '''Stop collecting from the node, as it has been given up on.
+
+        A detached sosreport that is still running is killed, and the wait on
+        it is left to end as normal so that the node is still cleaned up.
+        Otherwise the session is closed, which ends a sosreport running on it
+        as well as any transfer. A local sosreport is stopped, as is anything
+        else running locally for the node.
+        '''
+        self.cancelled = True
+        self.log_info('Cancelling collection')
+        if self.sos_state and not self.sos_path:
+            self.kill_sosreport()
+        elif self.local:
+            self.stop_local_command()
+        else:
+            self.close_ssh_session()
+
+    def stop_local_command(self):
+        '''Stop the command being run locally for the node, if any'''
+        proc = self._local_proc
+        if proc is None or proc.poll() is not None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError as err:
+            self.log_error('Failed to stop local command: %s' % err)
+
     def cleanup(self):
         '''Remove the sos archive from the node once we have it locally'''
-        self.remove_sos_archive()
+        if self.cancelled and not self.connected:
+            # the session was closed by cancel(), leave the node as it is
+            return
+        if self.retrieved and self.keep_remote_archive():
+            self.log_info('Sosreport could not be verified, leaving it on '
+                          'the node at %s' % self.sos_path)
+        elif self.retrieved:
+            self.remove_sos_archive()
+        elif self.sos_path and not self.local:
+            self.log_info('Sosreport was not retrieved, leaving it on the '
+                          'node at %s' % self.sos_path)
+        if self.sos_state:
+            self.remove_sos_state()
         cleanup = self.config['cluster'].get_cleanup_cmd(self.host_facts)
         if cleanup:
-            sin, sout, serr = self.client.exec_command(cleanup, timeout=15)
+            try:
+                self.run_command(cleanup, timeout=15)
+            except Exception as err:
+                self.log_error('Failed to run cluster cleanup: %s' % err)
+
+    def keep_remote_archive(self):
+        '''A retrieved sosreport is only removed from the node if we compared
+        it to its checksum, or were told not to'''
+        return not (self.verified or self.config['no_transfer_verify'])
+
+    def remove_sos_state(self):
+        '''Remove the state directory of a detached sosreport'''
+        try:
+            self.run_command('rm -rf %s' % self.sos_state, need_root=True)
+            self.sos_state = None
+        except Exception as e:
+            self.log_error('Failed to remove sosreport state on host: %s' % e)
 
     def collect_extra_cmd(self, filename):
         '''Collect the file created by a cluster outside of sos'''
@@ -639,9 +1116,8 @@ class SosNode():
                     return False
             dest = self.config['tmp_dir'] + '/' + filename.split('/')[-1]
             if not self.local:
-                sftp = self.client.open_sftp()
-                sftp.get(filename, dest)
-                sftp.close()
+                self.retrieve_file(filename, dest,
+                                   self.get_transfer_checksum(filename))
             else:
                 shutil.move(filename, dest)
             return True
@@ -650,6 +1126,47 @@ class SosNode():
             self.log_error(msg)
             return False
 
+    def get_remote_checksum(self, path):
+        '''Get the checksum of path on the node as an (algorithm, hexdigest)
+        tuple, or None if it could not be determined'''
+        cmd = self._fmt_script_cmd(CHECKSUM_SCRIPT % {'path': path})
+        try:
+            res = self.run_command(cmd, need_root=True)
+        except Exception as err:
+            self.log_debug('Could not get checksum of %s: %s' % (path, err))
+            return None
+        return self._parse_checksum(path, res)
+
+    def _parse_checksum(self, path, res):
+        match = CHECKSUM_RE.search((res['stdout'] or '').replace('\r', ''))
+        if res['status'] != 0 or not match:
+            self.log_debug('Could not get checksum of %s: %s'
+                           % (path, res['stdout']))
+            return None
+        return match.group(1), match.group(2)
+
+    def get_transfer_checksum(self, path):
+        '''The checksum to verify the transfer of path against, which is None
+        if verification is disabled or no checksum could be found'''
+        if self.config['no_transfer_verify']:
+            return None
+        return self.get_remote_checksum(path)
+
+    def retrieve_file(self, path, dest, checksum=None):
+        '''Copy the file at path on the node to dest locally, returning the
+        transfer's stats so that its size and rate may be reported.
+
+        If the transfer is interrupted, the transport reconnects and resumes
+        it from where it left off. If a checksum is given, as from
+        get_transfer_checksum(), the file is verified against it.
+        '''
+        xfer = self.transport.retrieve_file(path, dest, checksum=checksum)
+        if checksum:
+            self.log_debug('Verified %s checksum of %s' % (checksum[0], path))
+        self.log_debug('Retrieved %s in %.2fs (%.1f MB/s)'
+                       % (path, xfer.elapsed, xfer.rate))
+        return xfer
+
     def make_archive_readable(self, filepath):
         '''Used to make the given archive world-readable, which is slightly
         better than changing the ownership outright.
@@ -0,0 +1,244 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import hashlib
+import os
+import threading
+import time
+
+# Each stream requests a whole segment at once, so this is also the amount of
+# data each stream has in flight
+SEGMENT_SIZE = 8 * 1024 * 1024
+# How much of a segment is handed back to us, and written, at a time
+WRITE_SIZE = 1024 * 1024
+
+
+def file_digest(path, algo):
+    '''Returns the hex digest of the local file at path, using algo'''
+    digest = hashlib.new(algo)
+    with open(path, 'rb') as archive:
+        for block in iter(lambda: archive.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ChecksumMismatch(Exception):
+    '''Raised when a transferred file does not match its remote checksum'''
+    pass
+
+
+class SftpTransfer():
+    '''Copies a single file from a node over SFTP.
+
+    SFTPClient.get() issues its reads as a single sequential stream, so on
+    large files its throughput is bound by the round trip time of each read
+    rather than by the link. Here the file is split into segments, and every
+    read for a segment is requested at once. Segments are shared out between
+    one or more SFTP channels on the same SSH transport, and are written into
+    place in a preallocated local file as they arrive.
+
+    Segments are committed in order once written, which tracks how much of the
+    file is known to be complete and lets a checksum be computed as the data
+    streams in. If the transfer fails, calling run() again, with a new
+    transport if the connection was lost, resumes from the last committed
+    offset. If a checksum is given as an (algorithm, hexdigest) tuple, the file
+    is verified against it once complete and ChecksumMismatch raised if it
+    does not match.
+
+    The committed offset and checksum state are only held here, not on disk,
+    so a transfer can be resumed for as long as sos-collector is running but
+    not by a later run. Each run collects into a new tmp dir in any case.
+    '''
+
+    def __init__(self, transport, remote, dest, streams=1,
+                 segment_size=SEGMENT_SIZE, checksum=None):
+        self.transport = transport
+        self.remote = remote
+        self.dest = dest
+        self.streams = max(1, streams)
+        self.segment_size = segment_size
+        self.checksum = checksum
+        self.hasher = hashlib.new(checksum[0]) if checksum else None
+        self.size = 0
+        self.committed = 0
+        self.transferred = 0
+        self.elapsed = 0
+        self._next_offset = 0
+        self._lock = threading.Lock()
+        self._committer = threading.Condition(self._lock)
+        self._errors = []
+
+    @property
+    def rate(self):
+        '''The transfer rate in MB/s'''
+        if not self.elapsed:
+            return 0.0
+        return self.transferred / self.elapsed / 1024 / 1024
+
+    def open_sftp(self):
+        '''Open a new SFTP channel on the transport'''
+        # transfer.py is also used without paramiko, by the other transports
+        import paramiko
+        return paramiko.SFTPClient.from_transport(self.transport)
+
+    def run(self):
+        '''Perform the transfer. Any error from any stream is raised once all
+        of the streams have stopped'''
+        start = time.time()
+        self._errors = []
+        sftp = self.open_sftp()
+        try:
+            size = sftp.stat(self.remote).st_size
+            if size != self.size:
+                # either a new transfer, or the file changed underneath us
+                self._reset()
+                self.size = size
+            flags = os.O_WRONLY | os.O_CREAT
+            if not self.committed:
+                flags |= os.O_TRUNC
+            fd = os.open(self.dest, flags, 0o644)
+            try:
+                if not self.committed:
+                    self._preallocate(fd)
+                self._next_offset = self.committed
+                remaining = self.size - self.committed
+                segments = -(-remaining // self.segment_size)
+                threads = []
+                for i in range(1, min(self.streams, segments)):
+                    t = threading.Thread(target=self._fetch, args=(None, fd))
+                    t.daemon = True
+                    t.start()
+                    threads.append(t)
+                self._fetch(sftp, fd)
+                for t in threads:
+                    t.join()
+            finally:
+                os.close(fd)
+        finally:
+            sftp.close()
+            self.elapsed += time.time() - start
+        if self._errors:
+            raise self._errors[0]
+        self._verify()
+        return True
+
+    def _reset(self):
+        self.committed = 0
+        if self.checksum:
+            self.hasher = hashlib.new(self.checksum[0])
+
+    def _verify(self):
+        '''Compare the checksum computed during the transfer to the expected
+        checksum. On a mismatch the local file is removed, and the next run()
+        will start over.'''
+        if not self.hasher:
+            return
+        digest = self.hasher.hexdigest()
+        if digest != self.checksum[1].lower():
+            os.remove(self.dest)
+            self._reset()
+            self.size = 0
+            raise ChecksumMismatch('%s checksum of %s was %s, expected %s'
+                                   % (self.checksum[0], self.remote, digest,
+                                      self.checksum[1]))
+
+    def _preallocate(self, fd):
+        '''Reserve the space for the whole file up front, so that the
+        segments written out of order do not fragment it'''
+        if not self.size:
+            return
+        try:
+            os.posix_fallocate(fd, 0, self.size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, self.size)
+
+    def _next_segment(self):
+        '''Returns the offset and length of the next segment to fetch, or None
+        once all segments have been handed out'''
+        with self._lock:
+            offset = self._next_offset
+            if offset >= self.size or self._errors:
+                return None
+            self._next_offset += self.segment_size
+        return offset, min(self.segment_size, self.size - offset)
+
+    def _commit(self, offset, length, pieces):
+        '''Wait for every segment before offset to be committed, then commit
+        this one, adding its data to the checksum. Returns False if the
+        transfer failed while waiting.
+
+        Streams only hold on to the data of their one uncommitted segment, so
+        the memory used here is bounded by streams * segment_size.
+        '''
+        with self._committer:
+            while self.committed != offset and not self._errors:
+                self._committer.wait()
+            if self._errors:
+                return False
+            for data in pieces:
+                self.hasher.update(data)
+            self.committed += length
+            self.transferred += length
+            self._committer.notify_all()
+        return True
+
+    def _write(self, fd, data, offset):
+        if not hasattr(os, 'pwrite'):
+            with self._lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+            return
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+
+    def _fetch(self, sftp, fd):
+        '''Fetch segments over the given SFTP channel, or a new one if None,
+        until there are none left'''
+        owned = sftp is None
+        try:
+            if owned:
+                sftp = self.open_sftp()
+            rfile = sftp.open(self.remote, 'rb')
+            try:
+                seg = self._next_segment()
+                while seg:
+                    offset, length = seg
+                    chunks = [(o, min(WRITE_SIZE, offset + length - o))
+                              for o in range(offset, offset + length,
+                                             WRITE_SIZE)]
+                    pieces = []
+                    # readv() sends every read request for the chunks before
+                    # waiting on any of them
+                    for chunk, data in zip(chunks, rfile.readv(chunks)):
+                        if len(data) != chunk[1]:
+                            raise EOFError('Short read from %s at offset %s'
+                                           % (self.remote, chunk[0]))
+                        self._write(fd, data, chunk[0])
+                        if self.hasher:
+                            pieces.append(data)
+                    if not self._commit(offset, length, pieces):
+                        break
+                    seg = self._next_segment()
+            finally:
+                rfile.close()
+        except Exception as err:
+            with self._committer:
+                self._errors.append(err)
+                self._committer.notify_all()
+        finally:
+            if owned and sftp:
+                sftp.close()
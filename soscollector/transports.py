@@ -0,0 +1,422 @@
+# Copyright Red Hat 2018, Jake Hunsaker <jhunsake@redhat.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import abc
+import atexit
+import hashlib
+import importlib
+import os
+import re
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import six
+import time
+
+from subprocess import Popen, PIPE
+from soscollector.transfer import ChecksumMismatch, file_digest
+
+# sudo and su both end their password prompts with a colon, and the prompt is
+# not followed by a newline since the password is read on the same line
+PASSWORD_PROMPT = re.compile(br'(?i)password[^\n]*:\s*$')
+CHANNEL_READ_SIZE = 32768
+# How long an OpenSSH ControlMaster stays up once nothing is using it, so
+# that masters left behind when sos-collector is killed exit by themselves
+CONTROL_PERSIST = 600
+
+try:
+    from subprocess import DEVNULL
+except ImportError:
+    DEVNULL = open(os.devnull, 'r+b')
+
+
+class ChannelWatch():
+    '''The output of a command started on a paramiko channel, for waiting on
+    alongside other commands'''
+
+    def __init__(self, chan):
+        self.chan = chan
+
+    def fileno(self):
+        return self.chan.fileno()
+
+    def read(self):
+        '''Returns whatever output is available, and whether the command has
+        finished'''
+        data = []
+        while self.chan.recv_ready():
+            data.append(self.chan.recv(CHANNEL_READ_SIZE))
+        done = ((self.chan.eof_received or self.chan.closed) and
+                not self.chan.recv_ready())
+        return b''.join(data), done
+
+    def close(self):
+        self.chan.close()
+
+
+class ProcessWatch():
+    '''The output of a command run by a local process, such as ssh, for
+    waiting on alongside other commands'''
+
+    def __init__(self, proc):
+        self.proc = proc
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def read(self):
+        data = os.read(self.fileno(), CHANNEL_READ_SIZE)
+        if data:
+            return data, False
+        self.proc.stdout.close()
+        self.proc.wait()
+        return b'', True
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if not self.proc.stdout.closed:
+            self.proc.stdout.close()
+
+
+class TransferStats():
+    '''The size and duration of a completed transfer'''
+
+    def __init__(self, size, elapsed):
+        self.size = size
+        self.elapsed = elapsed
+
+    @property
+    def rate(self):
+        '''The transfer rate in MB/s'''
+        if not self.elapsed:
+            return 0.0
+        return self.size / self.elapsed / 1024 / 1024
+
+
+@six.add_metaclass(abc.ABCMeta)
+class SosTransport():
+    '''Base class for the ways SosNode can reach a remote node.
+
+    A transport connects to the node, runs commands on it and copies files
+    from it. Everything else SosNode does is independent of the transport.
+    Transports are selected with --transport, by their name, and each must
+    be listed in TRANSPORTS.
+    '''
+
+    name = None
+
+    def __init__(self, node):
+        self.node = node
+        self.config = node.config
+        self.address = node.address
+
+    @abc.abstractmethod
+    def connect(self):
+        '''Connect to the node, returning True once connected. Failures are
+        logged on the node before the exception is raised'''
+
+    @abc.abstractmethod
+    def disconnect(self):
+        '''Close the connection to the node'''
+
+    def host_key_fingerprint(self):
+        '''The sha256 fingerprint of the node's host key, or None if it is
+        not known to the transport'''
+        return None
+
+    @abc.abstractmethod
+    def run_command(self, cmd, timeout, get_pty=False, password=None):
+        '''Run cmd on the node, returning its output formatted by the node.
+        If password is given, it is sent the first time the command prompts
+        for a password'''
+
+    @abc.abstractmethod
+    def start_command(self, cmd):
+        '''Start cmd on the node without waiting for it, returning a watch
+        whose fileno() becomes readable as the command produces output'''
+
+    @abc.abstractmethod
+    def retrieve_file(self, path, dest, checksum=None):
+        '''Copy path on the node to dest locally, verifying it against
+        checksum if one is given. Returns an object with the size, elapsed
+        time and rate of the transfer'''
+
+    def file_exists(self, fname):
+        '''Checks for the presence of fname on the node'''
+        res = self.run_command('test -e %s' % fname, 15)
+        return res['status'] == 0
+
+    def close_inherited(self):
+        '''Close a forked child's copy of the connection, which is still in
+        use by the parent, without ending the session itself'''
+        pass
+
+    @classmethod
+    def save_host_keys(cls):
+        '''Save the keys accepted for new hosts, for transports that keep
+        track of host keys themselves, returning how many were saved'''
+        return 0
+
+
+_control_dir = None
+_control_lock = threading.Lock()
+
+ASKPASS_SCRIPT = '''#!/bin/sh
+printf '%s\\n' "$SOS_COLLECTOR_PASSWORD"
+'''
+
+
+def _get_control_dir():
+    '''The directory holding our ControlMaster sockets. This is kept out of
+    the tmp dir, as everything in there ends up in the final archive, and
+    short, as socket paths are limited in length'''
+    global _control_dir
+    with _control_lock:
+        if _control_dir is None:
+            _control_dir = tempfile.mkdtemp(prefix='sos-collector-ssh-')
+            askpass = os.path.join(_control_dir, 'askpass')
+            with open(askpass, 'w') as script:
+                script.write(ASKPASS_SCRIPT)
+            os.chmod(askpass, 0o700)
+            atexit.register(remove_control_dir)
+    return _control_dir
+
+
+def remove_control_dir():
+    '''Remove the directory of ControlMaster sockets, if one was made. This
+    is run at exit, and should also be run before exiting without running
+    the atexit handlers, once the masters have been closed'''
+    global _control_dir
+    with _control_lock:
+        if _control_dir is not None:
+            shutil.rmtree(_control_dir, True)
+            _control_dir = None
+
+
+class OpenSSHTransport(SosTransport):
+    '''Connects to nodes using the OpenSSH client.
+
+    A ControlMaster connection is opened to each node, and every command and
+    transfer is run as a separate ssh or sftp process multiplexed over it. The
+    packet handling is done by OpenSSH rather than in python, and ~/.ssh/config
+    is honored as it would be by ssh itself.
+
+    Masters are started with a ControlPersist timeout, so that one that is
+    never closed by us exits once idle. If a master has gone by the time we
+    next use it, it is started again.
+    '''
+
+    name = 'openssh'
+
+    def __init__(self, node):
+        SosTransport.__init__(self, node)
+        ident = '%s@%s:%s' % (self.config['ssh_user'], self.address,
+                              self.config['ssh_port'])
+        self.control_path = os.path.join(
+            _get_control_dir(), hashlib.sha1(ident.encode()).hexdigest()[:16]
+        )
+
+    def _ssh_args(self, *args):
+        return (['ssh', '-p', str(self.config['ssh_port']),
+                 '-l', self.config['ssh_user'],
+                 '-o', 'ControlPath=%s' % self.control_path] +
+                list(args))
+
+    def connect(self):
+        args = self._ssh_args('-M', '-N', '-f',
+                              '-o', 'ControlPersist=%d' % CONTROL_PERSIST,
+                              '-o', 'ConnectTimeout=15',
+                              '-o', 'ServerAliveInterval=15',
+                              '-o', 'StrictHostKeyChecking=accept-new')
+        env = os.environ.copy()
+        if self.config['password']:
+            self.node.log_debug('Opening session to %s with password'
+                                % self.address)
+            env['SSH_ASKPASS'] = os.path.join(_get_control_dir(), 'askpass')
+            env['SSH_ASKPASS_REQUIRE'] = 'force'
+            env['SOS_COLLECTOR_PASSWORD'] = self.config['password']
+            env.setdefault('DISPLAY', 'sos-collector')
+        else:
+            self.node.log_debug('Opening passwordless session to %s'
+                                % self.address)
+            args += ['-o', 'BatchMode=yes']
+        # the master stays running in the background once connected, holding
+        # on to its stderr, so that goes to a file rather than a pipe
+        errfile = tempfile.TemporaryFile()
+        try:
+            proc = Popen(args + [self.address], stdin=DEVNULL, stdout=DEVNULL,
+                         stderr=errfile, env=env, preexec_fn=os.setsid)
+            rc = proc.wait()
+            errfile.seek(0)
+            err = errfile.read().decode('utf-8', 'replace').strip()
+        except OSError as e:
+            self.node.log_error('Unable to run ssh: %s' % e)
+            raise
+        finally:
+            errfile.close()
+        if rc != 0:
+            if 'Permission denied' in err:
+                if not self.config['password']:
+                    self.node.log_error('Authentication failed. SSH keys '
+                                        'installed?')
+                else:
+                    self.node.log_error('Authentication failed. Incorrect '
+                                        'password.')
+            elif 'Could not resolve hostname' in err:
+                self.node.log_error('Provided hostname did not resolve.')
+            elif 'Host key verification failed' in err:
+                self.node.log_error('Provided key was rejected by remote SSH '
+                                    'client. Check ~/.ssh/known_hosts.')
+            else:
+                self.node.log_error('Exception caught while trying to '
+                                    'connect: %s' % err)
+            raise Exception(err)
+        return True
+
+    def disconnect(self):
+        proc = Popen(self._ssh_args('-O', 'exit', self.address),
+                     stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        proc.wait()
+
+    def _check_master(self):
+        '''Start the master again if it has exited after being idle for
+        longer than ControlPersist, which removes its socket. A master we
+        closed ourselves is left closed'''
+        if self.node.connected and not os.path.exists(self.control_path):
+            self.node.log_debug('Master connection to %s has exited, '
+                                'reconnecting' % self.address)
+            self.connect()
+
+    def run_command(self, cmd, timeout, get_pty=False, password=None):
+        self._check_master()
+        args = self._ssh_args('-o', 'ControlMaster=no')
+        if get_pty:
+            args.append('-tt')
+        proc = Popen(args + ['--', self.address, cmd], stdin=PIPE,
+                     stdout=PIPE, stderr=PIPE)
+        try:
+            return self._wait_for_process(proc, timeout, password)
+        finally:
+            for pipe in (proc.stdin, proc.stdout, proc.stderr):
+                pipe.close()
+
+    def _wait_for_process(self, proc, timeout, password=None):
+        '''Wait for the ssh process running a command to exit, reading its
+        output as it arrives, and sending password the first time a password
+        prompt is seen'''
+        output = {proc.stdout.fileno(): [], proc.stderr.fileno(): []}
+        poller = select.poll()
+        for fd in output:
+            poller.register(fd, select.POLLIN | select.POLLHUP)
+        remaining_fds = len(output)
+        tail = b''
+        deadline = time.time() + timeout
+        while remaining_fds:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                proc.kill()
+                proc.wait()
+                raise socket.timeout
+            for fd, event in poller.poll(remaining * 1000):
+                data = os.read(fd, CHANNEL_READ_SIZE)
+                if not data:
+                    poller.unregister(fd)
+                    remaining_fds -= 1
+                    continue
+                output[fd].append(data)
+                tail = (tail + data)[-256:]
+            if password and PASSWORD_PROMPT.search(tail):
+                proc.stdin.write((password + '\n').encode('utf-8'))
+                proc.stdin.flush()
+                password = None
+                tail = b''
+        rc = proc.wait()
+        return self.node._fmt_output(
+            stdout=b''.join(output[proc.stdout.fileno()]).decode(
+                'utf-8', 'replace'),
+            stderr=b''.join(output[proc.stderr.fileno()]).decode(
+                'utf-8', 'replace'),
+            rc=rc
+        )
+
+    def start_command(self, cmd):
+        self._check_master()
+        args = self._ssh_args('-o', 'ControlMaster=no')
+        proc = Popen(args + ['--', self.address, cmd], stdin=DEVNULL,
+                     stdout=PIPE, stderr=DEVNULL)
+        return ProcessWatch(proc)
+
+    def retrieve_file(self, path, dest, checksum=None):
+        '''Copy path from the node with sftp over the master connection. If
+        the transfer is interrupted, we reconnect and resume it with reget'''
+        args = ['sftp', '-q', '-b', '-', '-P', str(self.config['ssh_port']),
+                '-o', 'ControlPath=%s' % self.control_path,
+                '-o', 'ControlMaster=no',
+                '%s@%s' % (self.config['ssh_user'], self.address)]
+        start = time.time()
+        attempt = 0
+        while True:
+            self._check_master()
+            get = 'reget' if attempt and os.path.exists(dest) else 'get'
+            proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            out, err = proc.communicate(
+                ('%s "%s" "%s"\n' % (get, path, dest)).encode('utf-8'))
+            if proc.returncode == 0:
+                break
+            err = err.decode('utf-8', 'replace').strip()
+            attempt += 1
+            if attempt > self.config['transfer_retries']:
+                if os.path.exists(dest):
+                    os.remove(dest)
+                raise Exception(err)
+            self.node.log_info('Transfer interrupted: %s. Resuming...' % err)
+            if not self.node.reconnect():
+                raise Exception(err)
+        if checksum:
+            digest = file_digest(dest, checksum[0])
+            if digest != checksum[1].lower():
+                os.remove(dest)
+                raise ChecksumMismatch('%s checksum of %s was %s, expected %s'
+                                       % (checksum[0], path, digest,
+                                          checksum[1]))
+        return TransferStats(os.path.getsize(dest), time.time() - start)
+
+
+# The module and class of each transport, by name. Transports are imported
+# the first time they are used, as paramiko alone takes longer to import than
+# the rest of sos-collector
+TRANSPORTS = {
+    'openssh': ('soscollector.transports', 'OpenSSHTransport'),
+    'paramiko': ('soscollector.paramiko_transport', 'ParamikoTransport')
+}
+_loaded = {}
+
+
+def get_transport(name):
+    '''Returns the transport class called name, importing it if needed'''
+    if name not in _loaded:
+        module, cls = TRANSPORTS[name]
+        _loaded[name] = getattr(importlib.import_module(module), cls)
+    return _loaded[name]
+
+
+def save_host_keys():
+    '''Write out the host keys accepted for new nodes by any transport used
+    during this run, returning how many were written'''
+    return sum(t.save_host_keys() for t in list(_loaded.values()))
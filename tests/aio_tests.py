@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from soscollector.configuration import Configuration
+
+try:
+    import asyncssh
+    from soscollector.aio import AsyncSosNode
+except (ImportError, SyntaxError):
+    asyncssh = None
+
+
+class FakeCluster():
+
+    def get_cleanup_cmd(self, facts):
+        return None
+
+
+async def _run_process(process):
+    '''Run commands sent to the test server locally'''
+    proc = await asyncio.create_subprocess_shell(
+        process.command, stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    await process.redirect(stdin=proc.stdin, stdout=proc.stdout,
+                           stderr=proc.stderr)
+    await process.stdout.drain()
+    await process.stderr.drain()
+    process.exit(await proc.wait())
+
+
+if asyncssh:
+    class NoAuthServer(asyncssh.SSHServer):
+
+        def begin_auth(self, username):
+            return False
+
+
+@unittest.skipIf(asyncssh is None, 'requires python 3 and asyncssh')
+class AsyncSosNodeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+        key = asyncssh.generate_private_key('ssh-ed25519')
+        self.server = self.loop.run_until_complete(asyncssh.create_server(
+            NoAuthServer, '127.0.0.1', 0, server_host_keys=[key],
+            process_factory=_run_process, sftp_factory=True))
+        port = self.server.sockets[0].getsockname()[1]
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.config['ssh_port'] = str(port)
+        self.config['tmp_dir'] = self.tmpdir
+        self.config['cluster'] = FakeCluster()
+        self.node = AsyncSosNode('127.0.0.1', self.config, force=True)
+        self.assertTrue(self._await(self.node.open_session()))
+
+    def tearDown(self):
+        self._await(self.node.disconnect())
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _await(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_run_command(self):
+        res = self._await(self.node.run_command('echo hello; exit 3'))
+        self.assertEquals(res['status'], 3)
+        self.assertEquals(res['stdout'], 'hello\n')
+
+    def test_password_prompt(self):
+        self.config['sudo_pw'] = 'secret'
+        cmd = "printf 'Password: ' >&2; read pw; echo got $pw"
+        res = self._await(self.node.run_command(cmd, timeout=5,
+                                                need_root=True))
+        self.assertEquals(res['status'], 0)
+        self.assertIn('got secret', res['stdout'])
+
+    def test_retrieve_file(self):
+        src = os.path.join(self.tmpdir, 'sosreport-test.tar.xz')
+        data = os.urandom(1024 * 1024 + 7)
+        with open(src, 'wb') as sos:
+            sos.write(data)
+        with open(src + '.sha256', 'w') as sha:
+            sha.write(hashlib.sha256(data).hexdigest())
+        dest = os.path.join(self.tmpdir, 'retrieved.tar.xz')
+        checksum = self._await(self.node.get_transfer_checksum(src))
+        self.assertEquals(checksum[0], 'sha256')
+        self._await(self.node.retrieve_file(src, dest, checksum))
+        with open(dest, 'rb') as retrieved:
+            self.assertEquals(retrieved.read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import gzip
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from soscollector.archive import ArchiveWriter
+
+
+class ArchiveWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for i in range(3):
+            fname = os.path.join(self.tmpdir, 'sosreport-node%s.tar.xz' % i)
+            with open(fname, 'wb') as sos:
+                sos.write(os.urandom(1024))
+            self.files.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_incremental_add(self):
+        path = os.path.join(self.tmpdir, 'sos-collector-test.tar')
+        writer = ArchiveWriter(path, 'sos-collector-test')
+        writer.add(self.files[0], 'sosreport-node0.tar.xz', remove=True)
+        writer.wait()
+        self.assertFalse(os.path.exists(self.files[0]))
+        writer.add(self.files[1], 'sosreport-node1.tar.xz')
+        writer.close()
+        self.assertTrue(os.path.exists(self.files[1]))
+        with tarfile.open(path) as tar:
+            self.assertEquals(tar.getnames(),
+                              ['sos-collector-test/sosreport-node0.tar.xz',
+                               'sos-collector-test/sosreport-node1.tar.xz'])
+
+    def test_add_compressed(self):
+        path = os.path.join(self.tmpdir, 'sos-collector-test.tar')
+        dbdump = os.path.join(self.tmpdir, 'dbdump.sql')
+        with open(dbdump, 'wb') as dump:
+            dump.write(b'select 1;\n' * 100)
+        writer = ArchiveWriter(path, 'sos-collector-test')
+        writer.add(dbdump, 'dbdump.sql', remove=True, compress=True)
+        writer.close()
+        self.assertFalse(os.path.exists(dbdump))
+        # nor is the compressed copy left behind
+        self.assertEquals(sorted(os.listdir(self.tmpdir)),
+                          sorted([os.path.basename(path)] +
+                                 [os.path.basename(f) for f in self.files]))
+        with tarfile.open(path) as tar:
+            self.assertEquals(tar.getnames(),
+                              ['sos-collector-test/dbdump.sql.gz'])
+            member = tar.extractfile('sos-collector-test/dbdump.sql.gz')
+            self.assertEquals(gzip.GzipFile(fileobj=member).read(),
+                              b'select 1;\n' * 100)
+
+    def test_add_error(self):
+        path = os.path.join(self.tmpdir, 'sos-collector-test.tar.gz')
+        writer = ArchiveWriter(path, 'sos-collector-test', 'gzip', 2)
+        writer.add(os.path.join(self.tmpdir, 'missing'), 'missing')
+        writer.add(self.files[2], 'sosreport-node2.tar.xz')
+        self.assertRaises(OSError, writer.close)
+        with tarfile.open(path) as tar:
+            self.assertEquals(tar.getnames(),
+                              ['sos-collector-test/sosreport-node2.tar.xz'])
@@ -0,0 +1,51 @@
+import importlib
+import inspect
+import os
+import sys
+import unittest
+
+from soscollector.clusters import CLUSTER_PROFILES, Cluster, ClusterProfiles
+from soscollector.configuration import Configuration
+
+
+class ClusterProfilesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.profiles = ClusterProfiles(self.config)
+
+    def test_index_lists_every_profile(self):
+        path = os.path.dirname(inspect.getfile(Cluster))
+        found = {}
+        for fname in os.listdir(path):
+            mod, ext = os.path.splitext(fname)
+            if ext != '.py' or mod == '__init__':
+                continue
+            module = importlib.import_module('soscollector.clusters.%s' % mod)
+            for name, cls in inspect.getmembers(module, inspect.isclass):
+                if issubclass(cls, Cluster) and cls is not Cluster:
+                    found[name] = (mod, cls.packages)
+        self.assertEquals(found, dict((name, (mod, pkgs))
+                                      for name, mod, pkgs in CLUSTER_PROFILES))
+
+    def test_subclasses_checked_first(self):
+        names = list(self.profiles)
+        for name in names:
+            for base in inspect.getmro(self.profiles[name].__class__)[1:]:
+                if base.__name__ in names:
+                    self.assertLess(names.index(name),
+                                    names.index(base.__name__))
+
+    def test_lazy_import(self):
+        sys.modules.pop('soscollector.clusters.pacemaker', None)
+        profiles = ClusterProfiles(self.config)
+        self.assertIn('pacemaker', profiles.packages())
+        self.assertNotIn('soscollector.clusters.pacemaker', sys.modules)
+        clus = profiles['pacemaker']
+        self.assertEquals(clus.cluster_type, 'pacemaker')
+        self.assertIs(profiles['pacemaker'], clus)
+        self.assertIn('soscollector.clusters.pacemaker', sys.modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
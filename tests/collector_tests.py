@@ -0,0 +1,220 @@
+import logging
+import threading
+import unittest
+
+from soscollector.manifest import CollectionManifest
+from soscollector.sos_collector import SosCollector
+
+
+class FakeLog():
+
+    def __init__(self, name):
+        self.name = name
+
+
+def _collector(config):
+    '''A SosCollector with only what is needed to build the final archive,
+    rather than one that goes through setup and prompts'''
+    collector = SosCollector.__new__(SosCollector)
+    collector.config = config
+    collector.logfile = FakeLog('/var/tmp/sos-collector-abc/sos-collector.log')
+    collector.console_log_file = FakeLog('/var/tmp/sos-collector-abc/ui.log')
+    return collector
+
+
+class FakeWriter():
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, path, arcname, remove=False, compress=False):
+        self.added.append((arcname, compress))
+
+
+class ArchiveCompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = _collector({'archive_compression': 'auto'})
+        self.members = ['sosreport-node1.tar.xz', 'sosreport-node2.tar.gz',
+                        'engine-db.sql', 'sos-collector.log', 'ui.log',
+                        'manifest.json']
+
+    def _added(self):
+        writer = FakeWriter()
+        for member in self.members:
+            self.collector._add_to_archive(writer, '/tmp/' + member, member)
+        return dict(writer.added)
+
+    def test_auto(self):
+        # the archive is never compressed as a whole, only the files in it
+        # that are not already compressed, other than our own
+        self.assertEquals(self.collector._get_archive_compression(), 'none')
+        added = self._added()
+        self.assertEquals([m for m in self.members if added[m]],
+                          ['engine-db.sql'])
+
+    def test_explicit(self):
+        for compression in ('none', 'gzip', 'xz'):
+            self.collector.config['archive_compression'] = compression
+            self.assertEquals(self.collector._get_archive_compression(),
+                              compression)
+            self.assertFalse(any(self._added().values()))
+
+
+class StageLimitTests(unittest.TestCase):
+
+    def test_max_connects(self):
+        collector = _collector({'threads': 4, 'max_connects': 0})
+        self.assertEquals(collector._get_max_connects(), 2)
+        collector.config['threads'] = 1
+        self.assertEquals(collector._get_max_connects(), 1)
+        collector.config['max_connects'] = 8
+        self.assertEquals(collector._get_max_connects(), 8)
+
+
+class FakeNode():
+
+    def __init__(self, address):
+        self.address = address
+        self.local = False
+        self.retrieved = False
+        self.events = []
+
+    def generate_sosreport(self):
+        self.events.append('sosreport')
+        return True
+
+    def retrieve_sosreport(self):
+        self.events.append('retrieve')
+        return True
+
+    def cleanup(self):
+        self.events.append('cleanup')
+
+    def close_ssh_session(self):
+        self.events.append('close')
+
+
+class JitSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = _collector({'no_local': False, 'jit_sessions': True})
+        self.collector.manifest = CollectionManifest()
+        self.collector.monitor = None
+        self.collector.stage_limits = {
+            'sos': threading.BoundedSemaphore(1),
+            'transfer': threading.BoundedSemaphore(1)
+        }
+        self.collector._archive_sosreport = lambda client: None
+        self.collector.master = FakeNode('master')
+        self.node = FakeNode('node1')
+
+    def test_session_released(self):
+        self.assertTrue(self.collector._collect(self.node))
+        self.assertEquals(self.node.events,
+                          ['sosreport', 'retrieve', 'cleanup', 'close'])
+
+    def test_master_kept(self):
+        self.collector._collect(self.collector.master)
+        self.assertNotIn('close', self.collector.master.events)
+
+    def test_sessions_kept(self):
+        self.collector.config['jit_sessions'] = False
+        self.collector._collect(self.node)
+        self.assertNotIn('close', self.node.events)
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class FakePlan():
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.nodes = []
+
+
+class FakePlanner():
+
+    def __init__(self):
+        self.plans = {}
+
+
+class PlannedNode():
+
+    def __init__(self, address, planner):
+        self.address = address
+        self.planner = planner
+        self.local = False
+        self.connected = False
+
+    def finalize_sos_cmd(self):
+        cmd = 'sosreport --batch'
+        if self.address.startswith('db'):
+            cmd += ' -o postgresql'
+        self.planner.plans.setdefault(cmd, FakePlan(cmd))
+        self.planner.plans[cmd].nodes.append(self.address)
+
+
+class ShowPlanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = _collector({
+            'processes': 1, 'engine': 'threads', 'threads': 2,
+            'detach': False, 'max_sos_runs': 0, 'max_transfers': 0,
+            'no_local': False, 'sos_planner': FakePlanner(),
+            'tmp_dir_created': False, 'verbose': False
+        })
+        self.collector.client_list = []
+        self.collector.client_lock = threading.Lock()
+        self.collector._connect_to_node = self._connect_to_node
+        self.saved = False
+        self.collector._save_host_keys = self._save_host_keys
+        self.log = ListHandler()
+        for name in ('collector_tests', 'collector_tests_console'):
+            logger = logging.getLogger(name)
+            logger.handlers = [self.log]
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+        self.collector.logger = logging.getLogger('collector_tests')
+        self.collector.console = logging.getLogger('collector_tests_console')
+
+    def _connect_to_node(self, node):
+        if node.startswith('down'):
+            return None
+        client = PlannedNode(node, self.collector.config['sos_planner'])
+        with self.collector.client_lock:
+            self.collector.client_list.append(client)
+        return client
+
+    def _save_host_keys(self):
+        self.saved = True
+
+    def test_show_plan(self):
+        self.collector.show_plan(['node1', 'db1', 'down1', 'node2',
+                                  'down2'])
+        self.assertTrue(self.saved)
+        messages = self.log.messages
+        unreachable = messages.index('\n\tCould not connect to:')
+        self.assertEquals(messages[unreachable + 1:unreachable + 3],
+                          ['\t\tdown1', '\t\tdown2'])
+        self.assertEquals(messages[-1],
+                          '\n5 nodes in 2 groups, 2 could not be connected '
+                          'to')
+
+    def test_ignored_options(self):
+        self.collector.config['processes'] = 4
+        self.collector.show_plan(['node1'])
+        self.assertIn('--processes and --engine are ignored',
+                      self.log.messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
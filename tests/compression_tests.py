@@ -0,0 +1,51 @@
+import gzip
+import io
+import lzma
+import tarfile
+import unittest
+
+from soscollector.compression import ParallelCompressor
+
+
+class UnclosedBytesIO(io.BytesIO):
+    '''Keeps the written value around after the compressor closes it'''
+
+    def close(self):
+        self.value = self.getvalue()
+        super(UnclosedBytesIO, self).close()
+
+
+class ParallelCompressorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b''.join(b'line %d of the test data\n' % i
+                             for i in range(200000))
+
+    def _compress(self, compression, data):
+        out = UnclosedBytesIO()
+        comp = ParallelCompressor(out, compression, 2, block_size=65536)
+        for i in range(0, len(data), 10000):
+            comp.write(data[i:i + 10000])
+        comp.close()
+        return out.value
+
+    def test_gzip_members(self):
+        out = self._compress('gzip', self.data)
+        self.assertEquals(gzip.decompress(out), self.data)
+        self.assertTrue(len(out) < len(self.data))
+
+    def test_xz_streams(self):
+        out = self._compress('xz', self.data)
+        self.assertEquals(lzma.decompress(out), self.data)
+
+    def test_tar_stream(self):
+        out = UnclosedBytesIO()
+        comp = ParallelCompressor(out, 'gzip', 2, block_size=65536)
+        with tarfile.open(fileobj=comp, mode='w|') as tar:
+            info = tarfile.TarInfo('sosreport-test.txt')
+            info.size = len(self.data)
+            tar.addfile(info, io.BytesIO(self.data))
+        comp.close()
+        with tarfile.open(fileobj=io.BytesIO(out.value), mode='r:gz') as tar:
+            member = tar.extractfile('sosreport-test.txt')
+            self.assertEquals(member.read(), self.data)
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from soscollector.factcache import FactCache
+
+
+class FactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = FactCache(os.path.join(self.tmpdir, 'facts'), ttl=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get(self):
+        self.assertEquals(self.cache.get('node1:22 abc'), None)
+        self.assertTrue(self.cache.put('node1:22 abc', {'hostname': 'node1'}))
+        entry = self.cache.get('node1:22 abc')
+        self.assertEquals(entry['hostname'], 'node1')
+        self.assertEquals(self.cache.get('node1:22 def'), None)
+
+    def test_expired(self):
+        self.cache.put('node1:22 abc', {'hostname': 'node1'})
+        self.cache.ttl = 0
+        time.sleep(0.01)
+        self.assertEquals(self.cache.get('node1:22 abc'), None)
+
+    def test_unwritable(self):
+        cache = FactCache(os.path.join(self.tmpdir, 'file', 'facts'))
+        open(os.path.join(self.tmpdir, 'file'), 'w').close()
+        self.assertFalse(cache.put('node1:22 abc', {'hostname': 'node1'}))
+        self.assertEquals(cache.get('node1:22 abc'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import logging
+import threading
+import unittest
+
+from six import StringIO
+from six.moves import queue
+from soscollector.logs import CappedFileHandler, LogListener, QueueHandler
+
+
+class LogListenerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.listener = LogListener(self.queue, batch_size=8)
+        self.streams = {}
+        self.loggers = {}
+        for name in ('logs-test', 'logs-test-ui'):
+            self.streams[name] = StringIO()
+            hndlr = CappedFileHandler(self.streams[name])
+            hndlr.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+            self.listener.add_handler(name, hndlr)
+            logger = logging.getLogger(name)
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+            logger.handlers = [QueueHandler(self.queue)]
+            self.loggers[name] = logger
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+        for logger in self.loggers.values():
+            logger.handlers = []
+
+    def test_records_routed_by_logger(self):
+        self.loggers['logs-test'].debug('to the %s log', 'debug')
+        self.loggers['logs-test-ui'].info('to the ui log')
+        self.listener.flush()
+        self.assertEquals(self.streams['logs-test'].getvalue(),
+                          'DEBUG to the debug log\n')
+        self.assertEquals(self.streams['logs-test-ui'].getvalue(),
+                          'INFO to the ui log\n')
+
+    def test_concurrent_writers(self):
+        def log(thread):
+            for i in range(100):
+                self.loggers['logs-test'].debug('%s %s', thread, i)
+
+        threads = [threading.Thread(target=log, args=(t,)) for t in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.listener.stop()
+        lines = self.streams['logs-test'].getvalue().splitlines()
+        self.assertEquals(len(lines), 400)
+        for t in range(4):
+            msgs = [line for line in lines if line.startswith('DEBUG %s ' % t)]
+            self.assertEquals(msgs, ['DEBUG %s %s' % (t, i)
+                                     for i in range(100)])
+
+
+class CappedFileHandlerTests(unittest.TestCase):
+
+    def test_cap(self):
+        stream = StringIO()
+        hndlr = CappedFileHandler(stream, max_bytes=20)
+        hndlr.setFormatter(logging.Formatter('%(message)s'))
+        logger = logging.getLogger('logs-test-capped')
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.handlers = [hndlr]
+        logger.debug('first debug message')
+        logger.debug('second debug message')
+        logger.error('an error')
+        logger.handlers = []
+        lines = stream.getvalue().splitlines()
+        self.assertEquals(lines[0], 'first debug message')
+        self.assertTrue(lines[1].startswith('Log reached 20 bytes'))
+        self.assertEquals(lines[2:], ['an error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
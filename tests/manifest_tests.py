@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from soscollector import sos_collector
+from soscollector.configuration import Configuration
+from soscollector.manifest import CollectionManifest
+from soscollector.sos_collector import SosCollector
+from soscollector.sosnode import SosNode
+
+
+class CollectionManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = CollectionManifest()
+        for node in ('node1', 'node2', 'node3'):
+            self.manifest.pending(node)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_first_outcome_stands(self):
+        self.assertTrue(self.manifest.collected('node1'))
+        self.assertFalse(self.manifest.missing('node1', 'too late'))
+        self.assertTrue(self.manifest.missing('node2', 'could not connect'))
+        self.assertFalse(self.manifest.collected('node2'))
+        self.assertEquals(self.manifest.get_missing(),
+                          [('node2', 'could not connect')])
+
+    def test_cut(self):
+        self.manifest.collected('node1')
+        self.assertEquals(self.manifest.cut('deadline of 10s reached'),
+                          ['node2', 'node3'])
+        self.assertEquals(self.manifest.cutoff, 'deadline of 10s reached')
+        # a sosreport arriving after the cut is not kept
+        self.assertFalse(self.manifest.collected('node2'))
+        self.assertEquals(self.manifest.get_missing(),
+                          [('node2', 'cancelled, deadline of 10s reached'),
+                           ('node3', 'cancelled, deadline of 10s reached')])
+
+    def test_update(self):
+        worker = CollectionManifest()
+        worker.pending('node2')
+        worker.pending('node3')
+        worker.collected('node2')
+        worker.cut('quorum of 50% reached')
+        self.manifest.collected('node1')
+        self.manifest.update(worker.entries(), worker.cutoff)
+        self.assertEquals(self.manifest.cutoff, 'quorum of 50% reached')
+        self.assertEquals(self.manifest.get_missing(),
+                          [('node3', 'cancelled, quorum of 50% reached')])
+
+    def test_write(self):
+        self.manifest.collected('node1')
+        self.manifest.missing('node2', 'sosreport did not complete')
+        path = os.path.join(self.tmpdir, 'manifest.json')
+        self.manifest.write(path)
+        with open(path) as manifest_file:
+            written = json.load(manifest_file)
+        self.assertEquals(written['collected'], ['node1'])
+        self.assertEquals(written['missing'],
+                          {'node2': 'sosreport did not complete',
+                           'node3': None})
+        self.assertEquals(written['cutoff'], None)
+
+
+class CutoffCollector(SosCollector):
+    '''A SosCollector that collects from nodes by waiting for them, where
+    slow nodes do not finish until released'''
+
+    def __init__(self, config):
+        self.config = config
+        self.client_list = []
+        self.client_lock = threading.Lock()
+        self.manifest = CollectionManifest()
+        self.deadline_at = None
+        self.retrieved = 0
+        self.pool = None
+        self.monitor = None
+        self.release = threading.Event()
+        self.logger = logging.getLogger('manifest_tests')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+        self.console = self.logger
+
+    def _collect_node(self, node):
+        if node.startswith('slow'):
+            self.release.wait(10)
+        return self.manifest.collected(node)
+
+
+class CollectionCutoffTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.grace = sos_collector.CANCEL_GRACE
+        sos_collector.CANCEL_GRACE = 0.1
+        self.collector = CutoffCollector({
+            'threads': 4, 'detach': False, 'max_sos_runs': 0,
+            'max_transfers': 0, 'deadline': 0, 'quorum': 100,
+            'verbose': False, 'tmp_dir': self.tmpdir
+        })
+        self.nodes = ['node1', 'node2', 'node3', 'slow1']
+        for node in self.nodes:
+            self.collector.manifest.pending(node)
+
+    def tearDown(self):
+        self.collector.release.set()
+        sos_collector.CANCEL_GRACE = self.grace
+        shutil.rmtree(self.tmpdir)
+
+    def test_quorum(self):
+        self.collector.config['quorum'] = 75
+        self.collector._collect_threaded(self.nodes)
+        self.assertEquals(self.collector.retrieved, 3)
+        self.assertEquals(self.collector.manifest.get_missing(),
+                          [('slow1', 'cancelled, quorum of 75% reached')])
+
+    def test_deadline(self):
+        self.collector.config['deadline'] = 1
+        self.collector.deadline_at = time.time() + 0.2
+        start = time.time()
+        self.collector._collect_threaded(self.nodes)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(self.collector.retrieved, 3)
+        self.assertEquals(self.collector.manifest.cutoff,
+                          'deadline of 1s reached')
+
+    def test_cut_collection(self):
+        config = Configuration(args={'nodes': 'localhost'})
+        config['tmp_dir'] = self.tmpdir
+        # sosreport is still running on one node, so its archive is not yet
+        # known, while the other was part way through being transferred
+        running = SosNode('localhost', config, load_facts=False)
+        transferring = SosNode('127.0.0.1', config, load_facts=False)
+        transferring.archive = 'sosreport-127.0.0.1.tar.xz'
+        partial = os.path.join(self.tmpdir, transferring.archive)
+        open(partial, 'w').close()
+        clients = [running, transferring]
+        self.collector.client_list = clients
+        for client in clients:
+            self.collector.manifest.pending(client.address)
+        pool = ThreadPoolExecutor(len(clients))
+        futures = set(pool.submit(self.collector.release.wait, 10)
+                      for client in clients)
+        self.collector._cut_collection('deadline of 1s reached', futures)
+        self.collector.release.set()
+        pool.shutdown(wait=True)
+        self.assertTrue(running.cancelled)
+        self.assertTrue(transferring.cancelled)
+        self.assertFalse(os.path.exists(partial))
+        missing = dict(self.collector.manifest.get_missing())
+        self.assertEquals(missing['localhost'],
+                          'cancelled, deadline of 1s reached')
+        self.assertEquals(missing['127.0.0.1'],
+                          'cancelled, deadline of 1s reached')
+
+    def test_cut_local_node(self):
+        # sosreport hangs on the local node, which must neither hold up the
+        # end of the run nor have its archive moved into the tmp dir once cut
+        config = Configuration(args={'nodes': 'localhost'})
+        config['tmp_dir'] = self.tmpdir
+        node = SosNode('localhost', config, load_facts=False)
+        node.archive = 'sosreport-localhost.tar.xz'
+        node.sos_path = os.path.join(self.tmpdir, 'sos', node.archive)
+        os.mkdir(os.path.dirname(node.sos_path))
+        open(node.sos_path, 'w').close()
+        self.collector.client_list = [node]
+        self.collector.manifest.pending(node.address)
+
+        def collect():
+            node.run_command('sleep 30')
+            return node.retrieve_sosreport()
+        pool = ThreadPoolExecutor(1)
+        future = pool.submit(collect)
+        for i in range(50):
+            if node._local_proc:
+                break
+            time.sleep(0.1)
+        start = time.time()
+        self.collector._cut_collection('deadline of 1s reached', set([future]))
+        pool.shutdown(wait=True)
+        self.assertTrue(time.time() - start < 10)
+        self.assertTrue(node.cancelled)
+        self.assertFalse(future.result())
+        self.assertTrue(os.path.exists(node.sos_path))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                     node.archive)))
+
+    def test_no_cutoff(self):
+        self.collector.release.set()
+        self.collector._collect_threaded(self.nodes)
+        self.assertEquals(self.collector.retrieved, 4)
+        self.assertEquals(self.collector.manifest.cutoff, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
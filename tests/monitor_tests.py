@@ -0,0 +1,97 @@
+import os
+import socket
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from soscollector import monitor
+from soscollector.monitor import SosMonitor
+
+
+class FakeWatch():
+    '''Stands in for the channel a node waits on its sosreport over'''
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+
+    def fileno(self):
+        return self.rfd
+
+    def finish(self, data=b''):
+        if data:
+            os.write(self.wfd, data)
+        os.close(self.wfd)
+
+
+class FakeClient():
+
+    def __init__(self, address):
+        self.address = address
+        self.watches = []
+        self.reconnects = 0
+        self.output = b''
+
+    def watch_sosreport(self):
+        self.watches.append(FakeWatch())
+        self.output = b''
+        return self.watches[-1]
+
+    def read_sos_watch(self):
+        data = os.read(self.watches[-1].rfd, 1024)
+        if data:
+            self.output += data
+            return None
+        os.close(self.watches[-1].rfd)
+        if not self.output:
+            raise EOFError('Lost connection')
+        return int(self.output)
+
+    def reconnect(self):
+        self.reconnects += 1
+        return True
+
+
+class SosMonitorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(2)
+        self.monitor = SosMonitor(self.pool, 30)
+        self.reconnect_interval = monitor.RECONNECT_INTERVAL
+
+    def tearDown(self):
+        monitor.RECONNECT_INTERVAL = self.reconnect_interval
+        self.monitor.stop()
+        self.pool.shutdown()
+
+    def _wait_for_watch(self, client, count=1):
+        for i in range(50):
+            if len(client.watches) >= count:
+                return client.watches[count - 1]
+            time.sleep(0.1)
+        self.fail('%s was never watched' % client.address)
+
+    def test_exit_codes(self):
+        clients = [FakeClient('node%s' % i) for i in range(3)]
+        futures = [self.monitor.watch(c) for c in clients]
+        for i, client in enumerate(reversed(clients)):
+            self._wait_for_watch(client).finish(str(i).encode())
+        self.assertEquals([f.result(timeout=5) for f in futures], [2, 1, 0])
+
+    def test_reconnect(self):
+        monitor.RECONNECT_INTERVAL = 0
+        client = FakeClient('node0')
+        future = self.monitor.watch(client)
+        self._wait_for_watch(client).finish()
+        self._wait_for_watch(client, 2).finish(b'0')
+        self.assertEquals(future.result(timeout=5), 0)
+        self.assertEquals(client.reconnects, 1)
+
+    def test_timeout(self):
+        self.monitor.timeout = 0.5
+        client = FakeClient('node0')
+        future = self.monitor.watch(client)
+        self.assertRaises(socket.timeout, future.result, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
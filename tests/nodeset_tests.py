@@ -0,0 +1,79 @@
+import unittest
+
+from soscollector.nodeset import NodeMatcher, NodeSet, is_regex, short_name
+
+
+class NodeMatcherTests(unittest.TestCase):
+
+    def test_combined_match(self):
+        matcher = NodeMatcher(['foo[1,3].example.com', 'bar.*'])
+        self.assertIsNotNone(matcher.regex)
+        nodes = ['foo1.example.com', 'foo2.example.com', 'bar9.example.com',
+                 'xbar']
+        self.assertEquals(matcher.filter(nodes),
+                          ['foo1.example.com', 'bar9.example.com'])
+
+    def test_uncombinable_patterns(self):
+        matcher = NodeMatcher(['(node)\\1', '(?i)FOO.*'])
+        self.assertIsNone(matcher.regex)
+        self.assertTrue(matcher.match('nodenode'))
+        self.assertTrue(matcher.match('foo1'))
+        self.assertFalse(matcher.match('node'))
+
+    def test_shared_group_name(self):
+        matcher = NodeMatcher(['(?P<n>a)1', '(?P<n>b)2'])
+        self.assertIsNone(matcher.regex)
+        self.assertEquals(matcher.filter(['a1', 'b2', 'a2']), ['a1', 'b2'])
+
+    def test_conditional_group(self):
+        matcher = NodeMatcher(['node(.*)', '(x)?(?(1)y|z)'])
+        self.assertIsNone(matcher.regex)
+        self.assertTrue(matcher.match('xy'))
+        self.assertTrue(matcher.match('z'))
+        self.assertTrue(matcher.match('node1'))
+
+    def test_invalid_pattern(self):
+        matcher = NodeMatcher(['foo(', 'bar.*'])
+        self.assertEquals([e[0] for e in matcher.errors], ['foo('])
+        self.assertTrue(matcher.match('bar1'))
+        self.assertFalse(matcher.match('foo('))
+
+    def test_is_regex(self):
+        self.assertTrue(is_regex('node*'))
+        self.assertTrue(is_regex('foo[1,3].example.com'))
+        self.assertFalse(is_regex('node1.example.com'))
+
+
+class NodeSetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = NodeSet(['node1.example.com', 'node1', 'node2', '',
+                              'node1.other.com', '10.0.0.1', 'node2'])
+
+    def test_order_and_dedup(self):
+        self.assertEquals(list(self.nodes),
+                          ['node1.example.com', 'node1', 'node2',
+                           'node1.other.com', '10.0.0.1'])
+
+    def test_discard_host(self):
+        self.nodes.discard_host('node1.example.com')
+        self.assertEquals(list(self.nodes),
+                          ['node2', 'node1.other.com', '10.0.0.1'])
+        self.nodes.discard_host('node2.example.com')
+        self.assertEquals(list(self.nodes), ['node1.other.com', '10.0.0.1'])
+
+    def test_discard_short(self):
+        self.nodes.discard_short('node1.example.com')
+        self.assertEquals(list(self.nodes), ['node2', '10.0.0.1'])
+
+    def test_addresses(self):
+        self.assertEquals(short_name('10.0.0.1'), '10.0.0.1')
+        self.nodes.discard_host('10.0.0.2')
+        self.nodes.discard_short('10.9.9.9')
+        self.assertIn('10.0.0.1', self.nodes)
+        self.nodes.discard_host('10.0.0.1')
+        self.assertNotIn('10.0.0.1', self.nodes)
+
+
+if __name__ == '__main__':
+    unittest.main()
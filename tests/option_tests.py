@@ -41,3 +41,17 @@ class OptionTests(unittest.TestCase):
         self.assertEquals(config['nodes'], ['foo[1,3].example.com',
                                             'bar*.example.com',
                                             'foo.example.com'])
+
+
+class ZeroOptionTests(unittest.TestCase):
+
+    def test_zero_kept(self):
+        config = Configuration({'nodes': 'localhost', 'quorum': 0,
+                                'deadline': 0, 'threads': 0})
+        self.assertEquals(config['quorum'], 0)
+        self.assertEquals(config['deadline'], 0)
+        self.assertEquals(config['threads'], 4)
+
+    def test_unset(self):
+        config = Configuration({'nodes': 'localhost', 'quorum': None})
+        self.assertEquals(config['quorum'], 100)
@@ -0,0 +1,81 @@
+import unittest
+
+from soscollector.configuration import Configuration
+from soscollector.planner import SosCmdPlanner
+
+
+class FakeNode():
+
+    def __init__(self, address, enabled, disabled, label=None, atomic=False):
+        self.address = address
+        self.label = label
+        self.atomic = atomic
+        self.sos_info = {
+            'enabled': list(enabled),
+            'disabled': list(disabled),
+            'options': ['kernel.with-timer', 'networking.traceroute'],
+            'presets': ['none', 'ocp'],
+            'shared': False
+        }
+        self.debug = []
+
+    def set_sos_prefix(self):
+        return 'atomic run sos ' if self.atomic else ''
+
+    def determine_sos_label(self):
+        return '--label=%s' % self.label if self.label else None
+
+    def log_debug(self, msg):
+        self.debug.append(msg)
+
+
+class SosCmdPlannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.config['enable_plugins'] = ['kubernetes', 'foo']
+        self.config['skip_plugins'] = ['networking']
+        self.config['plugin_options'] = ['kernel.with-timer=on',
+                                         'kernel.nope=on']
+        self.config['preset'] = 'ocp'
+        self.planner = SosCmdPlanner(self.config)
+
+    def _node(self, address, **kwargs):
+        return FakeNode(address, ['kernel', 'networking'], ['kubernetes'],
+                        **kwargs)
+
+    def test_cmd(self):
+        node = self._node('node1')
+        plan = self.planner.plan(node)
+        self.assertEquals(plan.cmd, 'sosreport --batch '
+                          '--skip-plugins=networking '
+                          '--enable-plugins=kubernetes '
+                          '-k kernel.with-timer=on --preset=ocp')
+        self.assertEquals(len(node.debug), 1)
+        self.assertIn("['foo']", node.debug[0])
+
+    def test_groups(self):
+        nodes = [self._node('node%s' % i) for i in range(5)]
+        nodes.append(self._node('labelled', label='foo'))
+        nodes.append(self._node('atomic', atomic=True))
+        other = FakeNode('other', ['kernel'], ['networking', 'kubernetes'])
+        nodes.append(other)
+        cmds = [self.planner.plan(node).cmd for node in nodes]
+        self.assertEquals(len(self.planner.plans), 4)
+        self.assertEquals(len(set(cmds[:5])), 1)
+        plans = list(self.planner.plans.values())
+        self.assertEquals(plans[0].nodes, ['node%s' % i for i in range(5)])
+        self.assertIn('--label=foo', cmds[5])
+        self.assertTrue(cmds[6].startswith('atomic run sos sosreport'))
+        self.assertNotIn('--skip-plugins', cmds[7])
+        # every node gets the debug messages, not only the first in a group
+        self.assertEquals(nodes[0].debug, nodes[4].debug)
+
+    def test_only_plugins(self):
+        self.config['only_plugins'] = ['kernel', 'bar']
+        plan = self.planner.plan(self._node('node1'))
+        self.assertEquals(plan.cmd, 'sosreport --batch --only-plugins=kernel')
+
+
+if __name__ == '__main__':
+    unittest.main()
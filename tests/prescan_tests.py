@@ -0,0 +1,49 @@
+import socket
+import time
+import unittest
+
+from soscollector import prescan
+from soscollector.prescan import scan_nodes
+
+
+@unittest.skipIf(prescan.selectors is None, 'requires selectors')
+class ScanNodesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def _closed_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_reachable(self):
+        self.assertEquals(scan_nodes(['127.0.0.1'] * 3, self.port), {})
+
+    def test_refused(self):
+        res = scan_nodes(['127.0.0.1'], self._closed_port())
+        self.assertEquals(list(res), ['127.0.0.1'])
+
+    def test_unresolved(self):
+        res = scan_nodes(['127.0.0.1', 'node.invalid'], str(self.port))
+        self.assertEquals(list(res), ['node.invalid'])
+        self.assertIn('did not resolve', res['node.invalid'])
+
+    def test_many_nodes(self):
+        start = time.time()
+        res = scan_nodes(['127.0.0.%s' % i for i in range(1, 255)],
+                         self._closed_port(), timeout=2)
+        self.assertEquals(len(res), 254)
+        self.assertTrue(time.time() - start < 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from six.moves import queue
+from soscollector.logs import LogListener, QueueHandler
+from soscollector.manifest import CollectionManifest
+from soscollector.shards import ShardedCollector
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class FakeNode():
+
+    def __init__(self, address):
+        self.address = address
+        self.archive = 'sosreport-%s.tar.xz' % address
+
+
+class InheritedNode(FakeNode):
+    '''A client connected to before the workers were forked, which each
+    worker notes closing its copy of in the tmp dir'''
+
+    def __init__(self, address, tmp_dir):
+        FakeNode.__init__(self, address)
+        self.tmp_dir = tmp_dir
+
+    def close_inherited_session(self):
+        open(os.path.join(self.tmp_dir, 'closed-%s' % os.getpid()),
+             'w').close()
+
+
+class ExitedProc():
+
+    exitcode = 0
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+
+class FakeCollector():
+    '''Stands in for SosCollector, collecting from nodes by writing their
+    archives into the tmp dir'''
+
+    def __init__(self, tmp_dir):
+        self.config = {'engine': 'threads', 'tmp_dir': tmp_dir}
+        self.client_list = []
+        self.retrieved = 0
+        self.shard_results = None
+        self.manifest = CollectionManifest()
+        self.archived = []
+        self.logger = logging.getLogger('shards_tests')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.console = logging.getLogger('shards_tests_console')
+        self.console.propagate = False
+        self.log_listener = LogListener(queue.Queue())
+        self.log = ListHandler()
+        self.log_listener.add_handler('shards_tests', self.log)
+        self.logger.addHandler(QueueHandler(self.log_listener.queue))
+        self.log_listener.start()
+
+    def close(self):
+        self.log_listener.stop()
+        self.logger.handlers = []
+
+    def log_error(self, msg):
+        self.logger.error(msg)
+
+    def log_debug(self, msg):
+        self.logger.debug(msg)
+
+    def _collect_threaded(self, nodes):
+        for address in nodes:
+            if address == 'crash':
+                os._exit(3)
+            self.logger.info('collecting %s' % address)
+            if address.startswith('down'):
+                self.manifest.missing(address, 'could not connect')
+                continue
+            node = FakeNode(address)
+            self.client_list.append(node)
+            with open(os.path.join(self.config['tmp_dir'],
+                                   node.archive), 'w') as archive:
+                archive.write(address)
+            self.retrieved += 1
+            self.manifest.collected(address)
+            self._archive_sosreport(node)
+
+    def _save_host_keys(self):
+        pass
+
+    def close_all_connections(self):
+        for node in self.client_list:
+            open(os.path.join(self.config['tmp_dir'],
+                              'disconnected-%s' % node.address), 'w').close()
+
+    def _archive_sosreport(self, node):
+        self.shard_results.put(('archive', node.archive))
+
+    def _archive_file(self, fname):
+        self.archived.append(fname)
+
+
+class ShardedCollectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.collector = FakeCollector(self.tmpdir)
+
+    def tearDown(self):
+        self.collector.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_results_from_workers(self):
+        nodes = ['node%s' % i for i in range(10)] + ['down1', 'down2']
+        sharded = ShardedCollector(self.collector, 3)
+        connected, retrieved = sharded.run(nodes)
+        self.assertEquals(connected, 10)
+        self.assertEquals(retrieved, 10)
+        self.assertEquals(sorted(self.collector.archived),
+                          sorted('sosreport-node%s.tar.xz' % i
+                                 for i in range(10)))
+        self.collector.log_listener.flush()
+        for node in nodes:
+            self.assertIn('collecting %s' % node,
+                          self.collector.log.messages)
+        self.assertEquals(sorted(self.collector.manifest.get_missing()),
+                          [('down1', 'could not connect'),
+                           ('down2', 'could not connect')])
+
+    def test_inherited_sessions(self):
+        self.collector.client_list.append(
+            InheritedNode('master', self.tmpdir))
+        ShardedCollector(self.collector, 2).run(['node1', 'node2'])
+        files = os.listdir(self.tmpdir)
+        self.assertEquals(len([f for f in files if f.startswith('closed-')]),
+                          2)
+        # each worker closes the sessions it opened, and only those
+        self.assertEquals(sorted(f for f in files
+                                 if f.startswith('disconnected-')),
+                          ['disconnected-node1', 'disconnected-node2'])
+
+    def test_worker_exit(self):
+        sharded = ShardedCollector(self.collector, 2)
+        connected, retrieved = sharded.run(['node1', 'crash', 'node2'])
+        # node1 and node2 share a worker, which is not the one that exits
+        self.assertEquals(connected, 2)
+        self.assertEquals(retrieved, 2)
+        self.collector.log_listener.flush()
+        self.assertTrue(any('exited with 3' in msg
+                            for msg in self.collector.log.messages))
+        self.assertEquals(self.collector.manifest.get_missing(),
+                          [('crash', 'worker process exited')])
+
+    def test_done_before_exit(self):
+        # the worker's last results arrive only after it has exited
+        sharded = ShardedCollector(self.collector, 2)
+        sharded.results = queue.Queue()
+        sharded.connected = sharded.retrieved = 0
+        workers = {0: (ExitedProc(), ['node1']),
+                   1: (ExitedProc(), ['node2'])}
+        for node in ('node1', 'node2'):
+            self.collector.manifest.pending(node)
+        sharded.results.put(('archive', 'sosreport-node1.tar.xz'))
+        sharded.results.put(('done', 0, 1, 1, 0.1,
+                             [('node1', ('collected', None))], None))
+        sharded._check_workers(workers)
+        self.assertEquals(workers, {})
+        self.assertEquals(sharded.retrieved, 1)
+        self.assertEquals(self.collector.archived,
+                          ['sosreport-node1.tar.xz'])
+        self.assertEquals(self.collector.manifest.get_missing(),
+                          [('node2', 'worker process exited')])
+        # a late done from a worker already given up on is ignored
+        sharded._handle_result(('done', 1, 0, 0, 0.1, [], None), workers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,15 @@
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 
-from soscollector.sosnode import SosNode
+from soscollector.sosnode import SOS_INFO_SCRIPT, SosInfoRegistry, SosNode
 from soscollector.configuration import Configuration
+from soscollector.factcache import FactCache
+from soscollector.planner import SosInfoSets
+from soscollector.paramiko_transport import ParamikoTransport
+from soscollector.transports import TransferStats
 
 class SosNodeTests(unittest.TestCase):
 
@@ -22,3 +30,348 @@ class SosNodeTests(unittest.TestCase):
         out = self.node.run_command('echo sos-collector')
         self.assertEquals(out['status'], 0)
         self.assertEquals(out['stdout'], 'sos-collector\n')
+
+
+class FakeChannel():
+    '''Minimal stand-in for a paramiko Channel that replays canned output'''
+
+    def __init__(self, output, rc=0):
+        self.output = list(output)
+        self.sent = []
+        self.eof_received = False
+        self.closed = False
+        self.status_event = threading.Event()
+        self.rc = rc
+        self.rsock, self.wsock = socket.socketpair()
+        self.wsock.send(b'x')
+
+    def fileno(self):
+        return self.rsock.fileno()
+
+    def recv_ready(self):
+        return bool(self.output)
+
+    def recv(self, size):
+        data = self.output.pop(0)
+        if not self.output and not self.prompting():
+            self.finish()
+        return data
+
+    def recv_stderr_ready(self):
+        return False
+
+    def prompting(self):
+        return b'assword' in b''.join(self.output)
+
+    def sendall(self, data):
+        self.sent.append(data)
+        self.output.append(b'done\n')
+
+    def finish(self):
+        self.eof_received = True
+        self.status_event.set()
+
+    def recv_exit_status(self):
+        return self.rc
+
+
+class SosNodeChannelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.node = SosNode('localhost', self.config, load_facts=False)
+        self.transport = ParamikoTransport(self.node)
+
+    def test_channel_output(self):
+        chan = FakeChannel([b'sos-', b'collector\n'])
+        out = self.transport._wait_for_channel(chan, 5)
+        self.assertEquals(out['status'], 0)
+        self.assertEquals(out['stdout'], 'sos-collector\n')
+
+    def test_channel_password_prompt(self):
+        chan = FakeChannel([b'[sudo] password for foo: '])
+        out = self.transport._wait_for_channel(chan, 5, password='bar')
+        self.assertEquals(chan.sent, [b'bar\n'])
+        self.assertTrue(out['stdout'].endswith('done\n'))
+
+    def test_channel_no_prompt_no_password(self):
+        chan = FakeChannel([b'output\n'])
+        self.transport._wait_for_channel(chan, 5, password='bar')
+        self.assertEquals(chan.sent, [])
+
+
+PROBE_OUTPUT = '''[sudo] password for foo: \r
+@@sos-collector:hostname\r
+node1.example.com\r
+@@sos-collector:release\r
+Red Hat Enterprise Linux Server release 7.5 (Maipo)\r
+@@sos-collector:packages\r
+sos 3.6-11.el7\r
+package pacemaker is not installed\r
+@@sos-collector:plugins\r
+The following plugins are currently enabled:\r
+\r
+ kernel               system kernel\r
+\r
+The following plugins are currently disabled:\r
+\r
+ kubernetes           inactive     Kubernetes plugin\r
+\r
+The following plugin options are available:\r
+\r
+ kernel.with-timer    off  gather /proc/timer* statistics\r
+\r
+Profiles:\r
+\r
+ system               kernel\r
+\r
+@@sos-collector:presets\r
+name: none\r
+name: ocp\r
+@@sos-collector:end\r
+'''
+
+
+class SosNodeFactProbeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.config['probe_packages'] = ['pacemaker']
+        self.node = SosNode('localhost', self.config, load_facts=False)
+
+    def test_fact_probe(self):
+        def run_command(cmd, need_root=False, **kwargs):
+            # the sos plugins are listed along with the other facts
+            self.assertTrue(need_root)
+            return {'status': 0, 'stdout': PROBE_OUTPUT, 'stderr': ''}
+        self.node.run_command = run_command
+        self.assertTrue(self.node.probe_host_facts())
+        self.assertEquals(self.node.hostname, 'node1.example.com')
+        self.assertEquals(self.node.host_facts['distro'], 'Red Hat')
+        self.assertEquals(self.node.sos_info['version'], '3.6')
+        self.assertEquals(self.node.sos_info['enabled'], ['kernel'])
+        self.assertEquals(self.node.sos_info['disabled'], ['kubernetes'])
+        self.assertEquals(self.node.sos_info['presets'], ['none', 'ocp'])
+        self.assertFalse(self.node.is_installed('pacemaker'))
+        self.assertTrue(self.node.is_installed('sos'))
+
+    def test_fact_probe_incomplete(self):
+        self.node.run_command = lambda cmd, **kwargs: {
+            'status': 1, 'stdout': PROBE_OUTPUT.split('@@sos-collector:pa')[0],
+            'stderr': ''}
+        self.assertFalse(self.node.probe_host_facts())
+
+
+class SosNodeFactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.config['fact_cache'] = FactCache(self.tmpdir)
+        node = SosNode('localhost', self.config, load_facts=False)
+        node.run_command = lambda cmd, **kwargs: {
+            'status': 0, 'stdout': PROBE_OUTPUT, 'stderr': ''}
+        node.probe_host_facts()
+        node.cache_facts()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _load_cached(self, sos_package):
+        node = SosNode('localhost', self.config, load_facts=False)
+        node.run_command = lambda cmd, **kwargs: {
+            'status': 0, 'stdout': sos_package, 'stderr': ''}
+        return node, node.load_cached_facts()
+
+    def test_cached_facts(self):
+        node, loaded = self._load_cached('3.6-11.el7\n')
+        self.assertTrue(loaded)
+        self.assertEquals(node.hostname, 'node1.example.com')
+        self.assertEquals(node.host_facts['distro'], 'Red Hat')
+        self.assertEquals(node.sos_info['version'], '3.6')
+        self.assertEquals(node.sos_info['presets'], ['none', 'ocp'])
+
+    def test_cluster_packages_not_cached(self):
+        node, loaded = self._load_cached('3.6-11.el7\n')
+        self.assertEquals(node.host_facts['packages'], {'sos': '3.6-11.el7'})
+        node.run_command = lambda cmd, **kwargs: {
+            'status': 0, 'stdout': 'pacemaker 1.1.19-8.el7\n', 'stderr': ''}
+        self.assertTrue(node.is_installed('pacemaker'))
+
+    def test_sos_package_changed(self):
+        node, loaded = self._load_cached('3.7-1.el7\n')
+        self.assertFalse(loaded)
+        self.assertEquals(node.hostname, None)
+
+    def test_refresh_facts(self):
+        self.config['refresh_facts'] = True
+        self.assertFalse(self._load_cached('3.6-11.el7\n')[1])
+
+
+class SosNodeSharedSosInfoTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.config['sos_info_registry'] = SosInfoRegistry()
+        self.sos_info_probes = 0
+
+    def _node(self, sos_package='sos 3.6-11.el7', fail_sos_info=False):
+        facts, sos_info = PROBE_OUTPUT.split('@@sos-collector:plugins')
+        facts = facts.replace('sos 3.6-11.el7', sos_package)
+
+        def run_command(cmd, need_root=False, **kwargs):
+            if cmd != node._fmt_script_cmd(SOS_INFO_SCRIPT):
+                self.assertFalse(need_root)
+                out = facts + '@@sos-collector:end\r\n'
+            elif fail_sos_info:
+                out = '@@sos-collector:plugins\r\n'
+            else:
+                self.assertTrue(need_root)
+                self.sos_info_probes += 1
+                out = '@@sos-collector:plugins' + sos_info
+            return {'status': 0, 'stdout': out, 'stderr': ''}
+
+        node = SosNode('localhost', self.config, load_facts=False)
+        node.run_command = run_command
+        return node
+
+    def test_shared_probe(self):
+        nodes = [self._node() for i in range(3)]
+        for node in nodes:
+            self.assertTrue(node.probe_host_facts())
+        self.assertEquals(self.sos_info_probes, 1)
+        self.assertFalse(nodes[0].sos_info['shared'])
+        for node in nodes[1:]:
+            self.assertTrue(node.sos_info['shared'])
+            self.assertEquals(node.sos_info['presets'], ['none', 'ocp'])
+            info = SosInfoSets(node.sos_info)
+            self.assertTrue(info.plugin_exists('kubernetes'))
+            self.assertTrue(info.check_disabled('kubernetes'))
+            self.assertTrue(info.plugin_option_exists('kernel.with-timer', []))
+
+    def test_sos_versions_differ(self):
+        self._node().probe_host_facts()
+        node = self._node(sos_package='sos 3.7-1.el7')
+        self.assertTrue(node.probe_host_facts())
+        self.assertEquals(self.sos_info_probes, 2)
+        self.assertFalse(node.sos_info['shared'])
+
+    def test_failed_probe(self):
+        self._node(fail_sos_info=True).probe_host_facts()
+        node = self._node()
+        node.probe_host_facts()
+        self.assertEquals(self.sos_info_probes, 1)
+        self.assertFalse(node.sos_info['shared'])
+        self.assertEquals(node.sos_info['enabled'], ['kernel'])
+
+    def test_concurrent_probe(self):
+        nodes = [self._node() for i in range(8)]
+        threads = [threading.Thread(target=node.probe_host_facts)
+                   for node in nodes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(self.sos_info_probes, 1)
+        for node in nodes:
+            self.assertEquals(node.sos_info['presets'], ['none', 'ocp'])
+
+
+class SosNodePackageQueryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.node = SosNode('localhost', self.config, load_facts=False)
+        self.node.host_facts['distro'] = 'Red Hat'
+        self.node.set_package_manager()
+        self.node.host_facts['packages'] = {'sos': '3.6-11.el7'}
+        self.commands = []
+
+    def _run_command(self, stdout):
+        def run_command(cmd, **kwargs):
+            self.commands.append(cmd)
+            return {'status': 1, 'stdout': stdout, 'stderr': ''}
+        return run_command
+
+    def test_query_packages(self):
+        self.node.run_command = self._run_command(
+            'atomic-openshift 3.9.31-1.git.0.ef9737b.el7\n'
+            'package kubernetes-master is not installed\n'
+            'package pacemaker is not installed\n')
+        self.node.query_packages(['pacemaker', 'sos', 'kubernetes-master',
+                                  'atomic-openshift', 'pacemaker'])
+        self.assertEquals(len(self.commands), 1)
+        self.assertTrue(self.commands[0].endswith(
+            'atomic-openshift kubernetes-master pacemaker'))
+        self.assertTrue(self.node.is_installed('atomic-openshift'))
+        self.assertFalse(self.node.is_installed('kubernetes-master'))
+        self.assertFalse(self.node.is_installed('pacemaker'))
+        self.assertEquals(len(self.commands), 1)
+        self.node.query_packages(['sos', 'pacemaker'])
+        self.assertEquals(len(self.commands), 1)
+
+    def test_query_packages_incomplete(self):
+        self.node.run_command = self._run_command('')
+        self.node.query_packages(['pacemaker'])
+        self.assertNotIn('pacemaker', self.node.host_facts['packages'])
+
+
+class FakeCluster():
+
+    def get_cleanup_cmd(self, facts):
+        return None
+
+
+class FakeTransport():
+
+    def retrieve_file(self, path, dest, checksum=None):
+        self.checksum = checksum
+        return TransferStats(1024, 1)
+
+
+class SosNodeRetrieveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = Configuration(args={'nodes': 'localhost'})
+        self.config['tmp_dir'] = self.tmpdir
+        self.config['cluster'] = FakeCluster()
+        self.node = SosNode('localhost', self.config, load_facts=False)
+        self.node.local = False
+        self.node.transport = FakeTransport()
+        self.node.sos_path = '/var/tmp/sosreport-node1.tar.xz'
+        self.node.archive = 'sosreport-node1.tar.xz'
+        self.commands = []
+
+        def run_command(cmd, **kwargs):
+            self.commands.append(cmd)
+            return {'status': 0, 'stdout': '', 'stderr': ''}
+        self.node.run_command = run_command
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _retrieve(self, checksum):
+        self.node.get_remote_checksum = lambda path: checksum
+        self.assertTrue(self.node.retrieve_sosreport())
+        self.assertEquals(self.node.transport.checksum, checksum)
+        self.node.cleanup()
+        return [c for c in self.commands if c.startswith('rm -f')]
+
+    def test_verified(self):
+        removed = self._retrieve(('sha256', 'abc'))
+        self.assertTrue(self.node.verified)
+        self.assertEquals(len(removed), 1)
+
+    def test_unverified(self):
+        # without a checksum the remote archive is the only copy known to
+        # be good, so it is left on the node
+        removed = self._retrieve(None)
+        self.assertFalse(self.node.verified)
+        self.assertEquals(removed, [])
+
+    def test_no_transfer_verify(self):
+        self.config['no_transfer_verify'] = True
+        removed = self._retrieve(None)
+        self.assertFalse(self.node.verified)
+        self.assertEquals(len(removed), 1)
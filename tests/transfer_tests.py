@@ -0,0 +1,121 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from soscollector.transfer import ChecksumMismatch, SftpTransfer
+
+
+class FakeStat():
+
+    def __init__(self, size):
+        self.st_size = size
+
+
+class FakeRemoteFile():
+
+    def __init__(self, data, fail_at):
+        self.data = data
+        self.fail_at = fail_at
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            if self.fail_at is not None and offset >= self.fail_at:
+                raise EOFError('connection lost')
+            yield self.data[offset:offset + length]
+
+    def close(self):
+        pass
+
+
+class FakeSftp():
+
+    opened = 0
+
+    def __init__(self, data, fail_at=None):
+        self.data = data
+        self.fail_at = fail_at
+        FakeSftp.opened += 1
+
+    def stat(self, path):
+        return FakeStat(len(self.data))
+
+    def open(self, path, mode):
+        return FakeRemoteFile(self.data, self.fail_at)
+
+    def close(self):
+        pass
+
+
+class FakeTransfer(SftpTransfer):
+
+    def __init__(self, data, *args, **kwargs):
+        self.data = data
+        self.fail_at = None
+        super(FakeTransfer, self).__init__(None, *args, **kwargs)
+
+    def open_sftp(self):
+        return FakeSftp(self.data, self.fail_at)
+
+
+class SftpTransferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmpdir, 'sosreport-test.tar.xz')
+        self.data = os.urandom(5 * 1024 * 1024 + 123)
+        FakeSftp.opened = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read_dest(self):
+        with open(self.dest, 'rb') as dfile:
+            return dfile.read()
+
+    def test_single_stream(self):
+        xfer = FakeTransfer(self.data, '/var/tmp/sos', self.dest)
+        xfer.run()
+        self.assertEquals(self._read_dest(), self.data)
+        self.assertEquals(xfer.size, len(self.data))
+        self.assertEquals(FakeSftp.opened, 1)
+
+    def test_multiple_streams(self):
+        xfer = FakeTransfer(self.data, '/var/tmp/sos', self.dest, streams=4,
+                            segment_size=1024 * 1024)
+        xfer.run()
+        self.assertEquals(self._read_dest(), self.data)
+        self.assertEquals(FakeSftp.opened, 4)
+
+    def test_empty_file(self):
+        xfer = FakeTransfer(b'', '/var/tmp/sos', self.dest, streams=4)
+        xfer.run()
+        self.assertEquals(self._read_dest(), b'')
+
+    def test_checksum_verified(self):
+        digest = hashlib.sha256(self.data).hexdigest()
+        xfer = FakeTransfer(self.data, '/var/tmp/sos', self.dest, streams=3,
+                            segment_size=1024 * 1024,
+                            checksum=('sha256', digest))
+        self.assertTrue(xfer.run())
+        self.assertEquals(self._read_dest(), self.data)
+
+    def test_checksum_mismatch(self):
+        xfer = FakeTransfer(self.data, '/var/tmp/sos', self.dest,
+                            checksum=('md5', '0' * 32))
+        self.assertRaises(ChecksumMismatch, xfer.run)
+        self.assertFalse(os.path.exists(self.dest))
+
+    def test_resume(self):
+        digest = hashlib.sha256(self.data).hexdigest()
+        xfer = FakeTransfer(self.data, '/var/tmp/sos', self.dest, streams=2,
+                            segment_size=1024 * 1024,
+                            checksum=('sha256', digest))
+        xfer.fail_at = 3 * 1024 * 1024
+        self.assertRaises(EOFError, xfer.run)
+        self.assertTrue(0 < xfer.committed <= 3 * 1024 * 1024)
+        xfer.fail_at = None
+        self.assertTrue(xfer.run())
+        self.assertEquals(self._read_dest(), self.data)
+        self.assertTrue(xfer.transferred < len(self.data) * 2)
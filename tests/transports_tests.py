@@ -0,0 +1,312 @@
+import hashlib
+import os
+import paramiko
+import shutil
+import socket
+import subprocess
+import tempfile
+import unittest
+
+from soscollector import transports
+from soscollector.configuration import Configuration
+from soscollector.paramiko_transport import HostKeyIndex, ParamikoTransport
+from soscollector.transfer import ChecksumMismatch
+from soscollector.transports import OpenSSHTransport, SosTransport
+
+
+class FakeNode():
+
+    def __init__(self, address, port):
+        self.address = address
+        self.config = Configuration(args={'nodes': address})
+        self.config['ssh_port'] = port
+
+
+class HostKeyIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.known_hosts = os.path.join(self.tmpdir, 'known_hosts')
+        self.keys = [paramiko.ECDSAKey.generate() for i in range(3)]
+        hashed = paramiko.HostKeys.hash_host('node3.example.com')
+        with open(self.known_hosts, 'w') as known_hosts:
+            known_hosts.write('# comment\n')
+            known_hosts.write('node1.example.com,10.0.0.1 %s %s\n'
+                              % (self.keys[0].get_name(),
+                                 self.keys[0].get_base64()))
+            known_hosts.write('[node2.example.com]:2222 %s %s\n'
+                              % (self.keys[1].get_name(),
+                                 self.keys[1].get_base64()))
+            known_hosts.write('%s %s %s\n'
+                              % (hashed, self.keys[2].get_name(),
+                                 self.keys[2].get_base64()))
+        self.index = HostKeyIndex()
+        self.index.load(self.known_hosts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _key(self, hostname, key):
+        return self.index.lookup(hostname)[key.get_name()]
+
+    def test_lookup(self):
+        self.assertEquals(self._key('node1.example.com', self.keys[0]),
+                          self.keys[0])
+        self.assertEquals(self._key('10.0.0.1', self.keys[0]), self.keys[0])
+        self.assertEquals(self._key('[node2.example.com]:2222',
+                                    self.keys[1]), self.keys[1])
+        self.assertEquals(self.index.lookup('node2.example.com'), None)
+
+    def test_hashed_lookup(self):
+        self.assertEquals(self._key('node3.example.com', self.keys[2]),
+                          self.keys[2])
+        self.assertTrue(self.index.check('node3.example.com', self.keys[2]))
+        self.assertFalse(self.index.check('node3.example.com', self.keys[0]))
+
+    def test_hashed_names(self):
+        # one entry for a host under several hashed names, each with its own
+        # salt, is only found once
+        key = paramiko.ECDSAKey.generate()
+        names = [paramiko.HostKeys.hash_host(n)
+                 for n in ('node5.example.com', '10.0.0.5')]
+        with open(self.known_hosts, 'a') as known_hosts:
+            known_hosts.write('%s %s %s\n' % (
+                ','.join(names), key.get_name(), key.get_base64()))
+        index = HostKeyIndex()
+        index.load(self.known_hosts)
+        self.assertEquals(len(index._hashed), 3)
+        for name in ('node5.example.com', '10.0.0.5'):
+            self.assertEquals(list(index.lookup(name).keys()),
+                              [key.get_name()])
+            self.assertEquals(len(index._cache[name]), 1)
+            self.assertTrue(index.check(name, key))
+
+    def test_save_new(self):
+        key = paramiko.ECDSAKey.generate()
+        self.assertEquals(self.index.lookup('node4.example.com'), None)
+        self.index.add('node4.example.com', key.get_name(), key)
+        self.assertEquals(self._key('node4.example.com', key), key)
+        self.assertEquals(self.index.save_new(self.known_hosts), 1)
+        self.assertEquals(self.index.save_new(self.known_hosts), 0)
+        reloaded = HostKeyIndex()
+        reloaded.load(self.known_hosts)
+        self.assertTrue(reloaded.check('node4.example.com', key))
+        self.assertTrue(reloaded.check('node1.example.com', self.keys[0]))
+
+    def test_client_host_keys(self):
+        for address, port, key in (('node1.example.com', '22', self.keys[0]),
+                                   ('node2.example.com', '2222',
+                                    self.keys[1])):
+            transport = ParamikoTransport(FakeNode(address, port))
+            transport.client = paramiko.SSHClient()
+            transport._load_host_keys(self.index)
+            keys = transport.client.get_host_keys()
+            name = address if port == '22' else '[%s]:%s' % (address, port)
+            self.assertEquals(keys.lookup(name)[key.get_name()], key)
+            self.assertEquals(len(keys.keys()), 1)
+
+
+class FakeSshNode():
+
+    def __init__(self):
+        self.address = 'node1.example.com'
+        self.config = Configuration(args={'nodes': self.address})
+        self.config['ssh_port'] = '2222'
+        self.config['ssh_user'] = 'admin'
+        self.connected = True
+        self.errors = []
+        self.reconnects = 0
+
+    def log_debug(self, msg):
+        pass
+
+    def log_info(self, msg):
+        pass
+
+    def log_error(self, msg):
+        self.errors.append(msg)
+
+    def reconnect(self):
+        self.reconnects += 1
+        return True
+
+    def _fmt_output(self, stdout=None, stderr=None, rc=0):
+        return {'status': rc, 'stdout': stdout, 'stderr': stderr}
+
+
+class FakeProc():
+    '''A finished ssh or sftp process'''
+
+    def __init__(self, rc, err=b''):
+        self.returncode = rc
+        self.err = err
+
+    def wait(self):
+        return self.returncode
+
+    def communicate(self, data=None):
+        return b'', self.err
+
+
+class OpenSSHTransportTests(unittest.TestCase):
+    '''The OpenSSH transport, with the ssh and sftp processes it starts
+    replaced by handle_popen()'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.node = FakeSshNode()
+        self.transport = OpenSSHTransport(self.node)
+        self.calls = []
+        self.popen = transports.Popen
+        transports.Popen = self._popen
+        # the master is running unless a test says otherwise
+        open(self.transport.control_path, 'w').close()
+
+    def tearDown(self):
+        transports.Popen = self.popen
+        if os.path.exists(self.transport.control_path):
+            os.remove(self.transport.control_path)
+        shutil.rmtree(self.tmpdir)
+
+    def _popen(self, args, **kwargs):
+        self.calls.append((args, kwargs))
+        return self.handle_popen(args, **kwargs)
+
+    def handle_popen(self, args, **kwargs):
+        '''Start the master successfully, and run commands locally'''
+        if '-M' in args:
+            return FakeProc(0)
+        return subprocess.Popen(['sh', '-c', args[-1]], **kwargs)
+
+    def _connect_error(self, err):
+        def handle_popen(args, stderr=None, **kwargs):
+            stderr.write(err)
+            return FakeProc(255)
+        self.handle_popen = handle_popen
+        self.assertRaises(Exception, self.transport.connect)
+        return self.node.errors[-1]
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, SosTransport, self.node)
+
+    def test_ssh_args(self):
+        control_path = 'ControlPath=%s' % self.transport.control_path
+        self.assertEquals(self.transport._ssh_args('-O', 'exit'),
+                          ['ssh', '-p', '2222', '-l', 'admin', '-o',
+                           control_path, '-O', 'exit'])
+        other = FakeSshNode()
+        other.config['ssh_port'] = '22'
+        self.assertNotEqual(OpenSSHTransport(other).control_path,
+                            self.transport.control_path)
+
+    def test_connect(self):
+        self.handle_popen = lambda args, **kwargs: FakeProc(0)
+        self.assertTrue(self.transport.connect())
+        args, kwargs = self.calls[0]
+        self.assertEquals(args[-1], self.node.address)
+        self.assertIn('-M', args)
+        self.assertIn('ControlPersist=%d' % transports.CONTROL_PERSIST, args)
+        self.assertIn('BatchMode=yes', args)
+        self.assertNotIn('SOS_COLLECTOR_PASSWORD', kwargs['env'])
+
+    def test_connect_password(self):
+        self.node.config['password'] = 'secret'
+        self.handle_popen = lambda args, **kwargs: FakeProc(0)
+        self.transport.connect()
+        args, kwargs = self.calls[0]
+        self.assertNotIn('BatchMode=yes', args)
+        env = kwargs['env']
+        self.assertEquals(env['SOS_COLLECTOR_PASSWORD'], 'secret')
+        self.assertEquals(env['SSH_ASKPASS_REQUIRE'], 'force')
+        askpass = subprocess.Popen([env['SSH_ASKPASS']], env=env,
+                                   stdout=subprocess.PIPE)
+        self.assertEquals(askpass.communicate()[0], b'secret\n')
+
+    def test_connect_errors(self):
+        self.assertIn('SSH keys', self._connect_error(
+            b'admin@node1: Permission denied (publickey).'))
+        self.assertIn('did not resolve', self._connect_error(
+            b'ssh: Could not resolve hostname node1: Name or service not '
+            b'known'))
+        self.assertIn('known_hosts', self._connect_error(
+            b'Host key verification failed.'))
+        self.assertIn('Connection refused', self._connect_error(
+            b'ssh: connect to host node1 port 2222: Connection refused'))
+        self.node.config['password'] = 'secret'
+        self.assertIn('Incorrect password', self._connect_error(
+            b'admin@node1: Permission denied (password).'))
+
+    def test_run_command(self):
+        res = self.transport.run_command('echo hello; exit 3', 5)
+        self.assertEquals(res['status'], 3)
+        self.assertEquals(res['stdout'], 'hello\n')
+        args = self.calls[0][0]
+        self.assertEquals(args[-3:], ['--', self.node.address,
+                                      'echo hello; exit 3'])
+        self.assertIn('ControlMaster=no', args)
+
+    def test_password_prompt(self):
+        cmd = "printf 'Password: ' >&2; read pw; echo got $pw"
+        res = self.transport.run_command(cmd, 5, get_pty=True,
+                                         password='secret')
+        self.assertEquals(res['status'], 0)
+        self.assertEquals(res['stdout'], 'got secret\n')
+        self.assertIn('-tt', self.calls[0][0])
+
+    def test_timeout(self):
+        self.assertRaises(socket.timeout, self.transport.run_command,
+                          'sleep 10', 0.2)
+
+    def test_master_exited(self):
+        os.remove(self.transport.control_path)
+        self.transport.run_command('true', 5)
+        self.assertIn('-M', self.calls[0][0])
+        self.assertIn('ControlMaster=no', self.calls[1][0])
+
+    def _retrieve(self, data, checksum=None):
+        '''Retrieve data over sftp, with the first attempt interrupted
+        part way through'''
+        dest = os.path.join(self.tmpdir, 'sosreport-node1.tar.xz')
+        batches = []
+
+        def handle_popen(args, **kwargs):
+            proc = FakeProc(0)
+
+            def communicate(batch):
+                batches.append(batch.decode('utf-8'))
+                get = batch.split()[0]
+                with open(dest, 'ab' if get == b'reget' else 'wb') as out:
+                    if len(batches) == 1:
+                        out.write(data[:len(data) // 2])
+                        proc.returncode = 1
+                        return b'', b'Connection closed'
+                    out.seek(0, os.SEEK_END)
+                    out.write(data[out.tell():])
+                return b'', b''
+            proc.communicate = communicate
+            return proc
+        self.handle_popen = handle_popen
+        xfer = self.transport.retrieve_file('/var/tmp/sosreport.tar.xz',
+                                            dest, checksum=checksum)
+        return dest, batches, xfer
+
+    def test_retrieve_resume(self):
+        data = os.urandom(1024 * 1024 + 7)
+        checksum = ('sha256', hashlib.sha256(data).hexdigest())
+        dest, batches, xfer = self._retrieve(data, checksum)
+        self.assertEquals(batches, [
+            'get "/var/tmp/sosreport.tar.xz" "%s"\n' % dest,
+            'reget "/var/tmp/sosreport.tar.xz" "%s"\n' % dest])
+        self.assertEquals(self.node.reconnects, 1)
+        self.assertEquals(xfer.size, len(data))
+        with open(dest, 'rb') as retrieved:
+            self.assertEquals(retrieved.read(), data)
+
+    def test_retrieve_mismatch(self):
+        self.assertRaises(ChecksumMismatch, self._retrieve, b'x' * 1024,
+                          ('md5', '0' * 32))
+        self.assertFalse(os.listdir(self.tmpdir))
+
+
+if __name__ == '__main__':
+    unittest.main()